@@ -366,126 +366,6 @@ async def approve_payment(callback: types.CallbackQuery, bot):
     await callback.answer(f"✅ {driver_name} төлемі расталды!", show_alert=True)
     await admin_payments(callback)
 
-# Кезек басқару
-async def admin_queue_management(callback: types.CallbackQuery):
-    """Кезекті басқару интерфейсі"""
-    if not is_admin(callback.from_user.id):
-        await callback.answer("❌ Сізде құқық жоқ", show_alert=True)
-        return
-    
-    conn = sqlite3.connect('taxi_bot.db')
-    c = conn.cursor()
-    c.execute('''SELECT user_id, full_name, car_number, direction, queue_position
-                 FROM drivers
-                 WHERE is_active=1
-                 ORDER BY direction, queue_position''')
-    drivers = c.fetchall()
-    conn.close()
-    
-    if not drivers:
-        await callback.message.edit_text(
-            "❌ Белсенді жүргізушілер жоқ.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Артқа", callback_data="admin_back")]
-            ])
-        )
-        return
-    
-    msg = "🔧 <b>Кезек басқару</b>\n\n"
-    
-    current_direction = None
-    keyboard_buttons = []
-    
-    for driver in drivers:
-        if driver[3] != current_direction:
-            current_direction = driver[3]
-            msg += f"\n📍 <b>{current_direction}</b>\n\n"
-        
-        msg += f"№{driver[4]} - {driver[1]} ({driver[2]})\n"
-        
-        keyboard_buttons.append([
-            InlineKeyboardButton(text=f"⬆️ №{driver[4]}", callback_data=f"queue_up_{driver[0]}"),
-            InlineKeyboardButton(text=f"⬇️ №{driver[4]}", callback_data=f"queue_down_{driver[0]}")
-        ])
-    
-    keyboard_buttons.append([InlineKeyboardButton(text="🔙 Артқа", callback_data="admin_back")])
-    
-    await callback.message.edit_text(
-        msg,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard_buttons),
-        parse_mode="HTML"
-    )
-    await callback.answer()
-
-# Кезекті жоғары жылжыту
-async def queue_move_up(callback: types.CallbackQuery):
-    """Жүргізушіді кезекте жоғары көтереді"""
-    if not is_admin(callback.from_user.id):
-        await callback.answer("❌ Сізде құқық жоқ", show_alert=True)
-        return
-    
-    driver_id = int(callback.data.split("_")[2])
-    
-    conn = sqlite3.connect('taxi_bot.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT queue_position, direction FROM drivers WHERE user_id=?", (driver_id,))
-    current = c.fetchone()
-    
-    if current[0] <= 1:
-        await callback.answer("❌ Бұл бірінші орында!", show_alert=True)
-        conn.close()
-        return
-    
-    c.execute('''UPDATE drivers SET queue_position = queue_position + 1 
-                 WHERE direction=? AND queue_position=?''', 
-              (current[1], current[0] - 1))
-    
-    c.execute("UPDATE drivers SET queue_position=? WHERE user_id=?", 
-              (current[0] - 1, driver_id))
-    
-    conn.commit()
-    conn.close()
-    
-    await callback.answer("✅ Кезек жоғары жылжыды!")
-    await admin_queue_management(callback)
-
-# Кезекті төмен жылжыту
-async def queue_move_down(callback: types.CallbackQuery):
-    """Жүргізушіді кезекте төмен түсіреді"""
-    if not is_admin(callback.from_user.id):
-        await callback.answer("❌ Сізде құқық жоқ", show_alert=True)
-        return
-    
-    driver_id = int(callback.data.split("_")[2])
-    
-    conn = sqlite3.connect('taxi_bot.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT queue_position, direction FROM drivers WHERE user_id=?", (driver_id,))
-    current = c.fetchone()
-    
-    c.execute("SELECT MAX(queue_position) FROM drivers WHERE direction=?", (current[1],))
-    max_pos = c.fetchone()[0]
-    
-    if current[0] >= max_pos:
-        await callback.answer("❌ Бұл соңғы орында!", show_alert=True)
-        conn.close()
-        return
-    
-    c.execute('''UPDATE drivers SET queue_position = queue_position - 1 
-                 WHERE direction=? AND queue_position=?''', 
-              (current[1], current[0] + 1))
-    
-    c.execute("UPDATE drivers SET queue_position=? WHERE user_id=?", 
-              (current[0] + 1, driver_id))
-    
-    conn.commit()
-    conn.close()
-    
-    await callback.answer("✅ Кезек төмен жылжыды!")
-    await admin_queue_management(callback)
-
 # Админдер тізімі
 async def admin_list_view(callback: types.CallbackQuery):
     """Барлық админдерді көрсетеді"""
@@ -1,47 +1,99 @@
 import asyncio
-import sqlite3
-import aiosqlite
-import os
+import functools
+import signal
 import logging
 import aiohttp
 import urllib.parse
 from datetime import datetime
-from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Router, types, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from contextlib import asynccontextmanager
+from config import Config
+from database.db import get_db, after_commit, on_commit, WriteConflict
+from services.app import App, AppAttr, current_app
+from services.dispatch import WaitingOrder, DriverSeats
+from services.idempotency import callback_key, record_result
+from services.notifications import OutgoingMessage
+from services.webhook import build_webhook_app, serve_webhook, build_forwarding_app
+from services.sharding import (ShardedFront, UserLanes, EpochWatcher,
+                               consume_updates, poll_into)
+from services.lifecycle import stop_on_signals, remaining
+from services.throttling import ThrottleGroup
+from utils.logging import run_log_retention, search_archives, setup_logging
+from utils.routes import (ROUTES, ROUTES_BY_ID, DIRECTION_KEYBOARD,
+                          CHANGE_DIRECTION_KEYBOARD, TARIFF_LINES,
+                          route_by_key, route_by_cities)
+from utils.callbacks import (CallbackIndex, IndexedRouter, PickRoute,
+                             ChangeRoute, AcceptOrder, RejectOrder,
+                             AcceptClientOrders, CancelOrder, PickSeats,
+                             CompleteTrip, QuickRate, RateTrip, PickRating,
+                             MoveDriver)
+from database.models import ACTIVE_ORDER_STATUSES
+from database.queries import (fetch_driver, fetch_client, fetch_trip,
+                              fetch_order, fetch_client_orders,
+                              count_client_orders, fetch_all_drivers,
+                              fetch_active_orders, claim_order, close_order,
+                              reserve_seats, next_queue_position, queue_order,
+                              waiting_place, move_driver_in_queue,
+                              add_driver_rating, fetch_stats,
+                              recompute_stats, get_drivers_by_ids,
+                              get_client_names_by_ids)
 import random
+import secrets
 import string
 import time
 
-load_dotenv()
+# Handlers are grouped by subsystem. A callback goes only to the routers
+# that registered its key, instead of through every handler's filter;
+# router order keeps the FSM steps ahead of commands and menu buttons.
+# These are templates: each app's dispatcher gets copies (see create_app)
+callback_index = CallbackIndex()
+driver_router = IndexedRouter("driver", callback_index)
+client_router = IndexedRouter("client", callback_index)
+rating_router = IndexedRouter("rating", callback_index)
+common_router = IndexedRouter("common", callback_index)
+admin_router = IndexedRouter("admin", callback_index)
+fallback_router = Router(name="fallback")  # must stay last
+ROUTERS = (driver_router, client_router, rating_router, common_router,
+           admin_router, fallback_router)
+
+# Taps per user beyond these rates are answered with a notice and dropped
+# before they reach the database. State changes and heavy lists get the
+# tight limits, everything else the default
+THROTTLE_GROUPS = (
+    ThrottleGroup("orders", rate=0.5, burst=3,
+                  keys=("confirm_order", CancelOrder, AcceptOrder,
+                        AcceptClientOrders, RejectOrder, CompleteTrip,
+                        "add_another_yes", "add_another_no")),
+    ThrottleGroup("lists", rate=0.5, burst=4,
+                  keys=("driver_available_orders", "driver_passengers",
+                        "view_my_orders", "admin_drivers", "admin_clients",
+                        "admin_queue",
+                        "admin_stats", "admin_logs")),
+)
+THROTTLE_DEFAULT = ThrottleGroup("default", rate=2, burst=6)
+
+# Handlers use the current app's bot and services through these names,
+# so importing this module builds nothing (see services/app.py)
+config = AppAttr("config")
+bot = AppAttr("bot")
+action_log = AppAttr("action_log")
+dispatch = AppAttr("dispatch")
+broadcaster = AppAttr("broadcaster")
+outbox = AppAttr("outbox")
+
+
+def create_app(config: Config = None) -> App:
+    """A new bot instance with its own dispatcher, database pool and
+    services, built when first used. ``config`` defaults to the environment"""
+    return App(config or Config.from_env(), ROUTERS, callback_index,
+               THROTTLE_GROUPS, THROTTLE_DEFAULT)
 
-BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
-DATABASE_FILE = os.getenv("DATABASE_FILE", "taxi_bot.db")
-DB_TIMEOUT = 30.0
-
-ADMIN_PHONE = os.getenv("ADMIN_PHONE", "")
-ADMIN_USER_LOGIN = os.getenv("ADMIN_USER_LOGIN", "")
-
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-db_lock = asyncio.Lock()
-
-# Connection pool
-db_lock = asyncio.Lock()
 
 # ==================== LOGGING ====================
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler('taxi_bot.log'),
-              logging.StreamHandler()])
 logger = logging.getLogger(__name__)
 
 
@@ -85,127 +137,6 @@ class ChatState(StatesGroup):
     waiting_message_to_client = State()
 
 
-# ==================== DATABASE AND MIGRATIONS ====================
-
-
-async def init_db():
-    """Initialize database if not exists, otherwise reuse existing."""
-    if os.path.exists(DATABASE_FILE):
-        logger.info("ℹ️ Existing database found — skipping initialization.")
-        return
-
-    # Create a new database only if missing
-    conn = sqlite3.connect(DATABASE_FILE)
-    c = conn.cursor()
-
-    # === Tables ===
-    c.execute('''CREATE TABLE IF NOT EXISTS drivers
-                 (user_id INTEGER PRIMARY KEY,
-                  full_name TEXT NOT NULL,
-                  phone TEXT NOT NULL,
-                  car_number TEXT NOT NULL,
-                  car_model TEXT NOT NULL,
-                  total_seats INTEGER NOT NULL,
-                  direction TEXT NOT NULL,
-                  queue_position INTEGER NOT NULL,
-                  is_active INTEGER DEFAULT 0,
-                  is_verified INTEGER DEFAULT 0,
-                  verification_code TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  avg_rating REAL DEFAULT 0,
-                  rating_count INTEGER DEFAULT 0,
-                  occupied_seats INTEGER DEFAULT 0,
-                  is_on_trip INTEGER DEFAULT 0,
-                  payment_methods TEXT DEFAULT '')''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS clients
-                 (user_id INTEGER PRIMARY KEY,
-                  full_name TEXT NOT NULL,
-                  phone TEXT NOT NULL,
-                  direction TEXT NOT NULL,
-                  queue_position INTEGER NOT NULL,
-                  passengers_count INTEGER DEFAULT 1,
-                  is_verified INTEGER DEFAULT 0,
-                  verification_code TEXT,
-                  status TEXT DEFAULT 'waiting',
-                  assigned_driver_id INTEGER,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  avg_rating REAL DEFAULT 0,
-                  rating_count INTEGER DEFAULT 0,
-                  cancellation_count INTEGER DEFAULT 0,
-                  order_for TEXT DEFAULT 'self',
-                  order_number INTEGER DEFAULT 1,
-                  parent_user_id INTEGER,
-                  from_city TEXT DEFAULT '',
-                  to_city TEXT DEFAULT '')''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS admins
-                 (user_id INTEGER PRIMARY KEY,
-                  added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS ratings
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  from_user_id INTEGER,
-                  to_user_id INTEGER,
-                  user_type TEXT,
-                  trip_id INTEGER,
-                  rating INTEGER CHECK(rating >= 1 AND rating <= 5),
-                  review TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS trips
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  driver_id INTEGER,
-                  client_id INTEGER,
-                  direction TEXT,
-                  passengers_count INTEGER,
-                  status TEXT,
-                  driver_arrived_at TIMESTAMP,
-                  trip_started_at TIMESTAMP,
-                  trip_completed_at TIMESTAMP,
-                  cancelled_by TEXT,
-                  cancelled_at TIMESTAMP,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS actions_log
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  action TEXT,
-                  details TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS blacklist
-                 (user_id INTEGER PRIMARY KEY,
-                  reason TEXT,
-                  cancellation_count INTEGER DEFAULT 0,
-                  banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-    # === Indexes and pragmas ===
-    c.execute("CREATE INDEX IF NOT EXISTS idx_clients_status ON clients(status)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_clients_direction ON clients(direction)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_drivers_direction ON drivers(direction)")
-    c.execute("PRAGMA journal_mode=WAL")
-    c.execute("PRAGMA busy_timeout=30000")
-
-    conn.commit()
-    conn.close()
-    logger.info("✅ Database initialized successfully (first-time creation).")
-
-
-@asynccontextmanager
-async def get_db(write: bool = False):
-    """Async context manager for working with SQLite database"""
-    async with db_lock:
-        db = await aiosqlite.connect(DATABASE_FILE, timeout=DB_TIMEOUT)
-        await db.execute("PRAGMA foreign_keys = ON;")
-        try:
-            yield db
-            if write:
-                await db.commit()
-        finally:
-            await db.close()
-
-
 # ==================== UTILITIES ====================
 
 
@@ -218,48 +149,68 @@ async def is_admin(user_id: int) -> bool:
 
 
 async def save_log_action(user_id: int, action: str, details: str = ""):
-    """Save action log - ASYNC VERSION"""
-    try:
-        async with get_db(write=True) as db:
-            await db.execute(
-                '''INSERT INTO actions_log (user_id, action, details) 
-                               VALUES (?, ?, ?)''', (user_id, action, details))
-        log_action(user_id, action, details)
-    except Exception as e:
-        logger.error(f"Failed to save log: {e}")
+    """Save action log; the row is written in the background by action_log"""
+    if not action_log.add(user_id, action, details):
+        logger.warning(f"Action log queue full, dropped: {action} ({user_id})")
+    log_action(user_id, action, details)
 
 
-async def get_driver_available_seats(driver_id: int) -> tuple:
-    """Returns (occupied seats, total seats, available seats) - ASYNC VERSION"""
-    async with get_db() as db:
-        # Check for column existence
-        async with db.execute("PRAGMA table_info(drivers)") as cursor:
-            columns = [col[1] for col in await cursor.fetchall()]
+def idempotent(handler=None, *, nonce=None):
+    """A repeated tap on the same button gets the first tap's answer and
+    the handler does not run again (see services/idempotency.py); the
+    handler stores that answer with record_result().
 
-        if 'occupied_seats' in columns and 'total_seats' in columns:
-            async with db.execute(
-                    "SELECT total_seats, COALESCE(occupied_seats, 0) FROM drivers WHERE user_id=?",
-                (driver_id, )) as cursor:
-                result = await cursor.fetchone()
+    ``nonce(callback, ...)`` (async, gets the handler's arguments) names
+    the flow the tap is for; the same button tapped in a later flow runs
+    the handler again.
+    """
+    if handler is None:
+        return functools.partial(idempotent, nonce=nonce)
+
+    @functools.wraps(handler)
+    async def wrapper(callback: types.CallbackQuery, *args, **kwargs):
+        key = callback_key(callback, await nonce(callback, *args, **kwargs) if nonce else "")
+        async with current_app().idempotency.claim(key) as result:
+            if result is not None:
+                await callback.answer(result)
+                return
+            return await handler(callback, *args, **kwargs)
+    return wrapper
 
-            if not result:
-                return (0, 0, 0)
 
-            total = result[0]
-            occupied = result[1]
-            available = total - occupied
-            return (occupied, total, available)
-        else:
-            async with db.execute(
-                    "SELECT total_seats FROM drivers WHERE user_id=?",
-                (driver_id, )) as cursor:
-                result = await cursor.fetchone()
+async def order_draft(callback: types.CallbackQuery, state: FSMContext) -> str:
+    """Nonce of the order being confirmed, set when its seats were picked"""
+    return (await state.get_data()).get("draft_id", "")
+
+
+async def active_trip(callback: types.CallbackQuery, callback_data: CompleteTrip) -> str:
+    """Nonce of the trip being completed.
+
+    Menus carry the trip id in the button, so it is already in the key.
+    Old buttons (and menus sent before any trip) fall back to the driver's
+    newest trip: trips of a ride are completed together and new ones get
+    larger ids, so it is the same before and after completion.
+    """
+    if callback_data.trip_id:
+        return ""
+    async with get_db() as db:
+        async with db.execute(
+                '''SELECT MAX(id) FROM trips WHERE driver_id=?
+                   AND status IN ('accepted', 'driver_arrived', 'completed')''',
+            (callback.from_user.id, )) as cursor:
+            row = await cursor.fetchone()
+    return str(row[0] or "")
 
-            if not result:
-                return (0, 0, 0)
 
-            total = result[0]
-            return (0, total, total)
+async def get_cached_stats():
+    """Dashboard counters, re-read at most once per config.stats_cache_ttl seconds"""
+    cache = current_app().stats_cache
+    now = time.monotonic()
+    if cache["stats"] is None or now >= cache["expires"]:
+        async with get_db() as db:
+            cache["stats"] = await fetch_stats(db)
+        cache["expires"] = now + config.stats_cache_ttl
+    return cache["stats"]
 
 
 async def check_blacklist(user_id: int) -> tuple:
@@ -290,36 +241,25 @@ async def add_to_blacklist(user_id: int, reason: str, cancellation_count: int):
     """Adds a user to the blacklist"""
     async with get_db(write=True) as db:
         await db.execute(
-            '''INSERT OR REPLACE INTO blacklist (user_id, reason, cancellation_count)
-               VALUES (?, ?, ?)''', (user_id, reason, cancellation_count))
+            '''INSERT INTO blacklist (user_id, reason, cancellation_count)
+               VALUES (?, ?, ?)
+               ON CONFLICT (user_id) DO UPDATE
+               SET reason=excluded.reason,
+                   cancellation_count=excluded.cancellation_count,
+                   banned_at=CURRENT_TIMESTAMP''', (user_id, reason, cancellation_count))
     await save_log_action(user_id, "blacklisted", reason)
 
 
 async def get_user_active_orders(user_id: int) -> list:
-    """Returns all active orders for the user (excluding profile)"""
+    """Returns all active orders of the user as OrderRow"""
     async with get_db() as db:
-        async with db.execute(
-                '''SELECT user_id, full_name, order_for, order_number, status, 
-                      direction, passengers_count, from_city, to_city,
-                      assigned_driver_id
-               FROM clients 
-               WHERE (parent_user_id=? OR (user_id=? AND parent_user_id IS NULL))
-               AND status != 'registered'
-               ORDER BY order_number''', (user_id, user_id)) as cursor:
-            return await cursor.fetchall()
+        return await fetch_client_orders(db, user_id)
 
 
 async def count_user_orders(user_id: int) -> int:
-    """Counts the number of active orders for the user (excluding profile)"""
+    """Counts the number of active orders for the user"""
     async with get_db() as db:
-        async with db.execute(
-                '''SELECT COUNT(*) FROM clients 
-               WHERE (parent_user_id=? OR (user_id=? AND parent_user_id IS NULL)) 
-               AND status IN ('waiting', 'accepted', 'driver_arrived')
-               AND status != 'registered' ''',
-            (user_id, user_id)) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+        return await count_client_orders(db, user_id)
 
 
 def main_menu_keyboard():
@@ -333,13 +273,7 @@ def main_menu_keyboard():
 
 def from_city_keyboard():
     """Choosing the direction for clients"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Ақтау → Жаңаөзен", callback_data="dir_aktau_janaozen")],
-        [InlineKeyboardButton(text="Жаңаөзен → Ақтау", callback_data="dir_janaozen_aktau")],
-        [InlineKeyboardButton(text="Ақтау → Шетпе", callback_data="dir_aktau_shetpe")],
-        [InlineKeyboardButton(text="Шетпе → Ақтау", callback_data="dir_shetpe_aktau")],
-        [InlineKeyboardButton(text="🔙 Артқа", callback_data="back_main")]
-    ])
+    return DIRECTION_KEYBOARD
 
 
 def get_rating_stars(rating: float) -> str:
@@ -352,7 +286,7 @@ def get_rating_stars(rating: float) -> str:
 # ==================== DRIVERS ====================
 
 
-@dp.message(F.text == "🚗 Жүргізуші ретінде кіру")
+@driver_router.message(F.text == "🚗 Жүргізуші ретінде кіру")
 async def driver_start_telegram_auth(message: types.Message,
                                      state: FSMContext):
     user_id = message.from_user.id
@@ -391,7 +325,7 @@ async def driver_start_telegram_auth(message: types.Message,
     await state.set_state(DriverReg.confirm_data)
 
 
-@dp.callback_query(DriverReg.confirm_data, F.data == "confirm_telegram_data")
+@driver_router.callback("confirm_telegram_data", DriverReg.confirm_data)
 async def confirm_telegram_data(callback: types.CallbackQuery,
                                 state: FSMContext):
     await callback.message.edit_text("✅ Керемет! Тіркеуді жалғастырамыз...")
@@ -401,14 +335,14 @@ async def confirm_telegram_data(callback: types.CallbackQuery,
     await callback.answer()
 
 
-@dp.message(DriverReg.phone_number)
+@driver_router.message(DriverReg.phone_number)
 async def driver_phone_number(message: types.Message, state: FSMContext):
     await state.update_data(phone_number=message.text.strip())
     await message.answer("🚗 Көлік нөмірі (мысалы: 870 ABC 09)")
     await state.set_state(DriverReg.car_number)
 
 
-@dp.callback_query(DriverReg.confirm_data, F.data == "continue_no_username")
+@driver_router.callback("continue_no_username", DriverReg.confirm_data)
 async def continue_without_username(callback: types.CallbackQuery,
                                     state: FSMContext):
     """Continue without username"""
@@ -418,21 +352,21 @@ async def continue_without_username(callback: types.CallbackQuery,
     await callback.answer()
 
 
-@dp.message(DriverReg.car_number)
+@driver_router.message(DriverReg.car_number)
 async def driver_car_number(message: types.Message, state: FSMContext):
     await state.update_data(car_number=message.text)
     await message.answer("Көлік маркасы (мысалы: Toyota Camry)")
     await state.set_state(DriverReg.car_model)
 
 
-@dp.message(DriverReg.car_model)
+@driver_router.message(DriverReg.car_model)
 async def driver_car_model(message: types.Message, state: FSMContext):
     await state.update_data(car_model=message.text)
     await message.answer("Көлікте қанша орын бар? (1-8)")
     await state.set_state(DriverReg.seats)
 
 
-@dp.message(DriverReg.seats)
+@driver_router.message(DriverReg.seats)
 async def driver_seats(message: types.Message, state: FSMContext):
     try:
         seats = int(message.text)
@@ -447,26 +381,19 @@ async def driver_seats(message: types.Message, state: FSMContext):
         await message.answer("Сан енгізіңіз!")
 
 
-@dp.callback_query(DriverReg.current_city, F.data.startswith("dir_"))
-async def driver_current_city(callback: types.CallbackQuery, state: FSMContext):
-    direction_map = {
-        "dir_aktau_janaozen": "Ақтау → Жаңаөзен",
-        "dir_janaozen_aktau": "Жаңаөзен → Ақтау",
-        "dir_aktau_shetpe": "Ақтау → Шетпе",
-        "dir_shetpe_aktau": "Шетпе → Ақтау"
-    }
-    
-    direction = direction_map.get(callback.data, "Ақтау → Жаңаөзен")
+@driver_router.callback(PickRoute, DriverReg.current_city)
+async def driver_current_city(callback: types.CallbackQuery,
+                              callback_data: PickRoute, state: FSMContext):
+    route = route_by_key(callback_data.route) or ROUTES[0]
+    direction = route.direction
     data = await state.get_data()
-    
-    # Extract from_city from direction
-    from_city = direction.split(" → ")[0]
 
     # Use provided phone number
     phone = data.get('phone_number', f"tg_{callback.from_user.id}")
 
     async with get_db(write=True) as db:
         # Driver registers with chosen direction
+        queue_pos = await next_queue_position(db, "drivers", direction)
         await db.execute(
             '''INSERT INTO drivers 
                      (user_id, full_name, phone, car_number, car_model, total_seats, 
@@ -474,7 +401,9 @@ async def driver_current_city(callback: types.CallbackQuery, state: FSMContext):
                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
             (callback.from_user.id, data['full_name'], phone,
              data['car_number'], data['car_model'], data['seats'],
-             direction, 0, 1, 1, 0))
+             direction, queue_pos, 1, 1, 0))
+        on_commit(dispatch.put_driver,
+                  DriverSeats(callback.from_user.id, direction, data['seats'], 0, 1))
 
     await save_log_action(callback.from_user.id, "driver_registered",
                           f"Direction: {direction}")
@@ -499,49 +428,27 @@ async def driver_current_city(callback: types.CallbackQuery, state: FSMContext):
 
 def current_city_keyboard():
     """Choosing the direction for the driver"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Ақтау → Жаңаөзен", callback_data="dir_aktau_janaozen")],
-        [InlineKeyboardButton(text="Жаңаөзен → Ақтау", callback_data="dir_janaozen_aktau")],
-        [InlineKeyboardButton(text="Ақтау → Шетпе", callback_data="dir_aktau_shetpe")],
-        [InlineKeyboardButton(text="Шетпе → Ақтау", callback_data="dir_shetpe_aktau")],
-        [InlineKeyboardButton(text="🔙 Артқа", callback_data="back_main")]
-    ])
+    return DIRECTION_KEYBOARD
 
 
 async def show_driver_menu(message: types.Message, user_id: int):
     async with get_db() as db:
-        async with db.execute("PRAGMA table_info(drivers)") as cursor:
-            columns = [col[1] for col in await cursor.fetchall()]
-
-        async with db.execute("SELECT * FROM drivers WHERE user_id=?",
-                              (user_id, )) as cursor:
-            driver = await cursor.fetchone()
+        driver = await fetch_driver(db, user_id)
+        # The trip "Сапарды аяқтау" completes, fixed in the button
+        async with db.execute(
+                '''SELECT MAX(id) FROM trips WHERE driver_id=?
+                   AND status IN ('accepted', 'driver_arrived')''',
+            (user_id, )) as cursor:
+            trip_id = (await cursor.fetchone())[0] or 0
 
     if not driver:
         await message.answer("Қате: сіз тіркелмегенсіз",
                              reply_markup=main_menu_keyboard())
         return
 
-    full_name_idx = columns.index('full_name') if 'full_name' in columns else 1
-    car_number_idx = columns.index(
-        'car_number') if 'car_number' in columns else 2
-    car_model_idx = columns.index('car_model') if 'car_model' in columns else 3
-    direction_idx = columns.index(
-        'direction') if 'direction' in columns else 6
-
-    if 'occupied_seats' in columns and 'total_seats' in columns:
-        occupied, total, available = await get_driver_available_seats(user_id)
-        seats_text = f"💺 Бос емес: {occupied}/{total} (бос: {available})\n"
-    else:
-        total_seats_idx = columns.index(
-            'total_seats') if 'total_seats' in columns else 5
-        total = driver[total_seats_idx] if len(driver) > total_seats_idx else 4
-        seats_text = f"💺 Мест: {total}\n"
-
-    avg_rating_idx = columns.index(
-        'avg_rating') if 'avg_rating' in columns else None
-    rating_text = get_rating_stars(driver[avg_rating_idx] if avg_rating_idx
-                                   and len(driver) > avg_rating_idx else 0)
+    seats_text = (f"💺 Бос емес: {driver.occupied_seats}/{driver.total_seats} "
+                  f"(бос: {driver.available_seats})\n")
+    rating_text = get_rating_stars(driver.avg_rating)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Статус", callback_data="driver_status")],
@@ -555,7 +462,7 @@ async def show_driver_menu(message: types.Message, user_id: int):
         ],
         [
             InlineKeyboardButton(text="✅ Сапарды аяқтау",
-                                 callback_data="driver_complete_trip")
+                                 callback_data=CompleteTrip(trip_id=trip_id).pack())
         ],
         [
             InlineKeyboardButton(text="🔄 Бағытты өзгерту",
@@ -566,51 +473,49 @@ async def show_driver_menu(message: types.Message, user_id: int):
 
     await message.answer(
         f"🚗 <b>Жүргізуші профилі</b>\n\n"
-        f"👤 {driver[full_name_idx]}\n"
-        f"🚗 {driver[car_model_idx]} ({driver[car_number_idx]})\n"
+        f"👤 {driver.full_name}\n"
+        f"🚗 {driver.car_model} ({driver.car_number})\n"
         f"{seats_text}"
-        f"📍 Бағыт: {driver[direction_idx]}\n"
+        f"📍 Бағыт: {driver.direction}\n"
         f"{rating_text}\n\n"
         "Сіз өз бағытыңыз бойынша тапсырыстарды көре аласыз",
         reply_markup=keyboard,
         parse_mode="HTML")
 
 
-@dp.callback_query(F.data == "driver_status")
+@driver_router.callback("driver_status")
 async def driver_status(callback: types.CallbackQuery):
     async with get_db() as db:
-        async with db.execute("SELECT * FROM drivers WHERE user_id=?",
-                              (callback.from_user.id, )) as cursor:
-            driver = await cursor.fetchone()
+        driver = await fetch_driver(db, callback.from_user.id)
 
-        # Counting waiting orders on same direction
-        async with db.execute(
-                "SELECT COUNT(*) FROM clients WHERE direction=? AND status='waiting'",
-            (driver[6], )) as cursor:
-            waiting = (await cursor.fetchone())[0]
+    if not driver:
+        await callback.answer("❌ Жүргізуші табылмады", show_alert=True)
+        return
 
-    occupied, total, available = await get_driver_available_seats(
-        callback.from_user.id)
+    # Counting waiting orders on same direction
+    waiting = dispatch.waiting_count(driver.direction)
 
     await callback.message.edit_text(
         f"📊 <b>Статус</b>\n\n"
-        f"🚗 {driver[4]} ({driver[3]})\n"
-        f"📍 Бағыт: {driver[6]}\n"
-        f"💺 Бос емес: {occupied}/{total}\n"
-        f"💺 Бос орындар: {available}\n"
+        f"🚗 {driver.car_model} ({driver.car_number})\n"
+        f"📍 Бағыт: {driver.direction}\n"
+        f"💺 Бос емес: {driver.occupied_seats}/{driver.total_seats}\n"
+        f"💺 Бос орындар: {driver.available_seats}\n"
         f"⏳ Сіздің бағытыңыз бойынша тапсырыстар: {waiting}\n"
-        f"{get_rating_stars(driver[13] if len(driver) > 13 else 0)}",
+        f"{get_rating_stars(driver.avg_rating)}",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
             InlineKeyboardButton(text="🔙 Артқа", callback_data="driver_menu")
         ]]),
         parse_mode="HTML")
     await callback.answer()
 
-@dp.callback_query(F.data == "driver_passengers")
+@driver_router.callback("driver_passengers")
 async def driver_passengers(callback: types.CallbackQuery):
     async with get_db() as db:
         async with db.execute(
-                '''SELECT user_id, full_name, from_city, to_city, passengers_count FROM clients WHERE assigned_driver_id=? AND status='accepted' ''',
+                '''SELECT o.id, c.full_name, o.from_city, o.to_city, o.passengers_count
+                   FROM orders o JOIN clients c ON c.user_id = o.client_id
+                   WHERE o.assigned_driver_id=? AND o.status='accepted' ''',
             (callback.from_user.id, )) as cursor:
             clients = await cursor.fetchall()
 
@@ -632,41 +537,25 @@ async def driver_passengers(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(F.data == "driver_available_orders")
+@driver_router.callback("driver_available_orders")
 async def driver_available_orders(callback: types.CallbackQuery):
     """Show available orders for the driver based on their direction"""
     # Answer immediately to prevent timeout
     await callback.answer("⏳ Жүктелуде...")
     
     try:
-        async with get_db() as db:
-            # Get driver's direction
-            async with db.execute("SELECT direction FROM drivers WHERE user_id=?",
-                                  (callback.from_user.id, )) as cursor:
-                result = await cursor.fetchone()
-                
-            if not result:
-                await callback.message.edit_text("❌ Жүргізуші табылмады")
-                return
-                
-            driver_direction = result[0]
-            logger.info(f"Driver {callback.from_user.id} direction: {driver_direction}")
+        # Direction, seats and the queue all come from memory
+        driver = dispatch.driver(callback.from_user.id)
 
-        # Get available seats (outside the db context)
-        occupied, total, available = await get_driver_available_seats(callback.from_user.id)
-        logger.info(f"Driver seats: {occupied}/{total}, available: {available}")
+        if not driver:
+            await callback.message.edit_text("❌ Жүргізуші табылмады")
+            return
 
-        # Get waiting clients with same direction
-        async with get_db() as db:
-            async with db.execute(
-                '''SELECT user_id, full_name, passengers_count, queue_position, 
-                          direction, from_city, to_city
-                   FROM clients
-                   WHERE direction=? AND status='waiting'
-                   ORDER BY queue_position''', (driver_direction,)) as cursor:
-                clients = await cursor.fetchall()
+        driver_direction = driver.direction
+        available = driver.available_seats
 
-        logger.info(f"Found {len(clients)} waiting clients")
+        # Waiting clients with same direction, in queue order
+        clients = dispatch.waiting_orders(driver_direction)
 
         if not clients:
             msg = f"❌ Сіздің бағытыңыз бойынша тапсырыстар жоқ: {driver_direction}\n\n💺 Бос орындар: {available}"
@@ -682,20 +571,21 @@ async def driver_available_orders(callback: types.CallbackQuery):
         msg += f"💺 Бос орындар: {available}\n\n"
 
         keyboard_buttons = []
-        for client in clients:
-            can_fit = client[2] <= available
+        for place, client in enumerate(clients, 1):
+            can_fit = client.passengers_count <= available
             fit_emoji = "✅" if can_fit else "⚠️"
             warning = "" if can_fit else " (орын жетпейді!)"
 
-            msg += f"{fit_emoji} №{client[3]} - {client[1]} ({client[2]} адам.){warning}\n"
-            msg += f"   🎯 {client[4]}\n\n"
+            msg += f"{fit_emoji} №{place} - {client.client_name} ({client.passengers_count} адам.){warning}\n"
+            msg += f"   🎯 {client.direction}\n\n"
 
-            button_text = f"✅ №{client[3]} алу ({client[2]} адам.)"
+            button_text = f"✅ №{place} алу ({client.passengers_count} адам.)"
             if not can_fit:
-                button_text = f"⚠️ №{client[3]} алу ({client[2]} адам.) - орын жетпейді!"
+                button_text = f"⚠️ №{place} алу ({client.passengers_count} адам.) - орын жетпейді!"
 
             keyboard_buttons.append([
-                InlineKeyboardButton(text=button_text, callback_data=f"accept_client_{client[0]}")
+                InlineKeyboardButton(text=button_text,
+                                     callback_data=AcceptOrder(order_id=client.id).pack())
             ])
 
         keyboard_buttons.append([
@@ -712,164 +602,133 @@ async def driver_available_orders(callback: types.CallbackQuery):
         await callback.message.answer(f"❌ Қате: {str(e)}")
 
 
-@dp.callback_query(F.data.startswith("accept_client_"))
-async def accept_client(callback: types.CallbackQuery):
+@driver_router.callback(AcceptOrder)
+@idempotent
+async def accept_client(callback: types.CallbackQuery, callback_data: AcceptOrder):
     """Driver accepts a client"""
-    client_id = int(callback.data.split("_")[2])
+    order_id = callback_data.order_id
     driver_id = callback.from_user.id
 
     try:
-        async with get_db() as db:
-            # Get client data - remove order_for
-            async with db.execute(
-                '''SELECT passengers_count, full_name, direction, from_city, to_city, phone, parent_user_id
-                   FROM clients 
-                   WHERE user_id=? AND status='waiting' ''',
-                (client_id,)) as cursor:
-                client = await cursor.fetchone()
-
-            if not client:
-                await callback.answer("❌ Клиентті басқа жүргізуші алып қойды!", show_alert=True)
+        # Checks and updates run in one BEGIN IMMEDIATE transaction; the
+        # conditional UPDATEs are the real guard against a double accept
+        async with get_db(write=True) as db:
+            order = await fetch_order(db, order_id)
+            client = await fetch_client(db, order.client_id) if order else None
+            driver = await fetch_driver(db, driver_id)
+
+            if not client or order.status != 'waiting':
+                after_commit(callback.answer,
+                             "❌ Клиентті басқа жүргізуші алып қойды!",
+                             show_alert=True)
                 return
 
-            passengers_count = client[0]
-            client_name = client[1]
-            direction = client[2]
-            from_city = client[3]
-            to_city = client[4]
-            client_phone = client[5] if client[5] and not client[5].startswith("tg_") else "Нөмір көрсетілмеген"
-            parent_user_id = client[6] if len(client) > 6 else client_id
-
-            # Check driver's available seats
-            async with db.execute(
-                "SELECT total_seats, COALESCE(occupied_seats, 0), car_model, car_number, phone FROM drivers WHERE user_id=?",
-                (driver_id,)) as cursor:
-                driver_data = await cursor.fetchone()
-
-            if not driver_data:
-                await callback.answer("❌ Қате: жүргізуші жоқ", show_alert=True)
+            if not driver:
+                after_commit(callback.answer, "❌ Қате: жүргізуші жоқ",
+                             show_alert=True)
                 return
 
-            total, occupied, car_model, car_number, driver_phone = driver_data
-            available = total - occupied
-
-            if passengers_count > available:
-                await callback.answer(
-                    f"❌ Орын жетпейді! {passengers_count} орын қажет, {available} орын бар",
+            passengers_count = order.passengers_count
+            if passengers_count > driver.available_seats:
+                after_commit(
+                    callback.answer,
+                    f"❌ Орын жетпейді! {passengers_count} орын қажет, "
+                    f"{driver.available_seats} орын бар",
                     show_alert=True)
                 return
 
-        async with get_db(write=True) as db:
-            await db.execute(
-                "UPDATE clients SET status='accepted', assigned_driver_id=? WHERE user_id=?",
-                (driver_id, client_id))
+            if not await claim_order(db, order_id, driver_id):
+                raise WriteConflict("❌ Клиентті басқа жүргізуші алып қойды!")
 
-            await db.execute(
-                '''UPDATE drivers 
-                   SET occupied_seats = COALESCE(occupied_seats, 0) + ? 
-                   WHERE user_id=?''', (passengers_count, driver_id))
+            if not await reserve_seats(db, driver_id, passengers_count):
+                raise WriteConflict("❌ Орын жетпейді!")
+            on_commit(dispatch.remove_order, order_id)
+            on_commit(dispatch.add_occupied, driver_id, passengers_count)
 
             await db.execute(
-                '''INSERT INTO trips (driver_id, client_id, direction, status, passengers_count)
-                   VALUES (?, ?, ?, 'accepted', ?)''',
-                (driver_id, client_id, direction, passengers_count))
-
-        await save_log_action(driver_id, "client_accepted", f"Client: {client_id}")
-
-        # Notify client
-        try:
-            await bot.send_message(
-                client_id, 
+                '''INSERT INTO trips (driver_id, client_id, order_id, direction, status, passengers_count)
+                   VALUES (?, ?, ?, ?, 'accepted', ?)''',
+                (driver_id, client.user_id, order_id, order.direction, passengers_count))
+            await record_result(db, f"✅ Клиент {client.full_name} қосылды!")
+
+            # Notify client
+            await outbox.enqueue(db, OutgoingMessage(
+                client.user_id,
                 f"✅ <b>Жүргізуші тапсырысыңызды қабылдады!</b>\n\n"
-                f"🚗 {car_model} ({car_number})\n"
-                f"📍 {from_city} → {to_city}\n\n"
-                f"📞 Жүргізуші байланысы: {driver_phone}\n\n"
+                f"🚗 {driver.car_model} ({driver.car_number})\n"
+                f"📍 {order.from_city} → {order.to_city}\n\n"
+                f"📞 Жүргізуші байланысы: {driver.phone}\n\n"
                 f"Жүргізушінің қоңырауын күтіңіз!",
-                parse_mode="HTML")
-        except Exception as e:
-            logger.warning(f"Couldn't notify client {client_id}: {e}")
+                parse_mode="HTML"), f"order_accepted:{order_id}")
+
+        await save_log_action(driver_id, "client_accepted",
+                              f"Client: {client.user_id}, Order: {order_id}")
+
+        client_phone = client.phone if client.phone and not client.phone.startswith(
+            "tg_") else "Нөмір көрсетілмеген"
 
         # Notify driver
         await callback.message.edit_text(
             f"✅ <b>Тапсырыс қабылданды!</b>\n\n"
-            f"👤 Жолаушы: {client_name}\n"
+            f"👤 Жолаушы: {client.full_name}\n"
             f"📞 Байланыс: {client_phone}\n"
-            f"📍 {from_city} → {to_city}\n"
+            f"📍 {order.from_city} → {order.to_city}\n"
             f"👥 Орын: {passengers_count}",
             parse_mode="HTML")
 
-        await callback.answer(f"✅ Клиент {client_name} қосылды!", show_alert=True)
+        await callback.answer(f"✅ Клиент {client.full_name} қосылды!", show_alert=True)
 
+    except WriteConflict as e:
+        await callback.answer(str(e), show_alert=True)
     except Exception as e:
         logger.error(f"Error in accept_client: {e}", exc_info=True)
         await callback.answer("❌ Қате. Тағы бір рет көріңіз.", show_alert=True)
 
 
-@dp.callback_query(F.data == "driver_change_direction")
+@driver_router.callback("driver_change_direction")
 async def driver_change_direction(callback: types.CallbackQuery):
     """Driver changes direction"""
     async with get_db() as db:
         # Check active trips
         async with db.execute(
-                '''SELECT COUNT(*) FROM clients 
+                '''SELECT COUNT(*) FROM orders 
                      WHERE assigned_driver_id=? AND status IN ('accepted', 'driver_arrived')''',
             (callback.from_user.id, )) as cursor:
             active_trips = (await cursor.fetchone())[0]
 
-        if active_trips > 0:
-            await callback.answer(
-                "❌ Бағытты өзгерту мүмкін емес - белсенді сапарлар бар!",
-                show_alert=True)
-            return
+    if active_trips > 0:
+        await callback.answer(
+            "❌ Бағытты өзгерту мүмкін емес - белсенді сапарлар бар!",
+            show_alert=True)
+        return
 
     await callback.message.edit_text(
         "📍 <b>Бағытты өзгерту</b>\n\n"
         "Жаңа бағытты таңдаңыз:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Ақтау → Жаңаөзен", callback_data="change_dir_aktau_janaozen")],
-            [InlineKeyboardButton(text="Жаңаөзен → Ақтау", callback_data="change_dir_janaozen_aktau")],
-            [InlineKeyboardButton(text="Ақтау → Шетпе", callback_data="change_dir_aktau_shetpe")],
-            [InlineKeyboardButton(text="Шетпе → Ақтау", callback_data="change_dir_shetpe_aktau")],
-            [InlineKeyboardButton(text="🔙 Артқа", callback_data="driver_menu")]
-        ]),
+        reply_markup=CHANGE_DIRECTION_KEYBOARD,
         parse_mode="HTML")
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("change_dir_"))
-async def confirm_change_direction(callback: types.CallbackQuery):
+@driver_router.callback(ChangeRoute)
+async def confirm_change_direction(callback: types.CallbackQuery,
+                                   callback_data: ChangeRoute):
     """Verify and change driver's direction"""
-    direction_map = {
-        "change_dir_aktau_janaozen": "Ақтау → Жаңаөзен",
-        "change_dir_janaozen_aktau": "Жаңаөзен → Ақтау",
-        "change_dir_aktau_shetpe": "Ақтау → Шетпе",
-        "change_dir_shetpe_aktau": "Шетпе → Ақтау"
-    }
+    route = route_by_key(callback_data.route)
+    if not route:
+        await callback.answer("❌ Бағыт табылмады", show_alert=True)
+        return
 
-    new_direction = direction_map[callback.data]
+    new_direction = route.direction
 
     async with get_db(write=True) as db:
-        # Get old direction
-        async with db.execute("SELECT direction FROM drivers WHERE user_id=?",
-                              (callback.from_user.id, )) as cursor:
-            old_direction = (await cursor.fetchone())[0]
-
-        # Update driver direction
+        # Driver joins the end of the new direction's queue; the old one
+        # just keeps a gap
+        queue_pos = await next_queue_position(db, "drivers", new_direction)
         await db.execute(
-            "UPDATE drivers SET direction=?, queue_position=0 WHERE user_id=?",
-            (new_direction, callback.from_user.id))
-
-        # Reorder queues for both old and new directions
-        for direction in [old_direction, new_direction]:
-            async with db.execute(
-                    "SELECT user_id FROM drivers WHERE direction=? ORDER BY queue_position",
-                (direction, )) as cursor:
-                drivers = await cursor.fetchall()
-
-            for pos, (driver_id, ) in enumerate(drivers, 1):
-                await db.execute(
-                    "UPDATE drivers SET queue_position=? WHERE user_id=?",
-                    (pos, driver_id))
+            "UPDATE drivers SET direction=?, queue_position=? WHERE user_id=?",
+            (new_direction, queue_pos, callback.from_user.id))
+        on_commit(dispatch.move_driver, callback.from_user.id, new_direction)
 
     await save_log_action(callback.from_user.id, "direction_changed",
                           f"New direction: {new_direction}")
@@ -885,30 +744,31 @@ async def confirm_change_direction(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(F.data == "driver_complete_trip")
-async def driver_complete_trip(callback: types.CallbackQuery):
+@driver_router.callback(CompleteTrip)
+@idempotent(nonce=active_trip)
+async def driver_complete_trip(callback: types.CallbackQuery, callback_data: CompleteTrip):
     """Driver completes the trip"""
     async with get_db(write=True) as db:
-        # Get all clients in the trip
+        # Get all orders in the trip
         async with db.execute(
-                '''SELECT user_id, passengers_count, full_name, parent_user_id
-                     FROM clients 
+                '''SELECT id, passengers_count, client_id
+                     FROM orders 
                      WHERE assigned_driver_id=? AND status IN ('accepted', 'driver_arrived')''',
             (callback.from_user.id, )) as cursor:
-            clients = await cursor.fetchall()
+            orders = await cursor.fetchall()
 
-        if not clients:
-            await callback.answer("❌ Белсенді сапар жоқ!", show_alert=True)
+        if not orders:
+            after_commit(callback.answer, "❌ Белсенді сапар жоқ!", show_alert=True)
             return
 
-        total_freed = sum(c[1] for c in clients)
+        total_freed = sum(o[1] for o in orders)
 
         # Get trip IDs before completing
         async with db.execute(
-            '''SELECT id FROM trips 
+            '''SELECT order_id, id FROM trips 
                WHERE driver_id=? AND status IN ('accepted', 'driver_arrived')''',
             (callback.from_user.id,)) as cursor:
-            trip_ids = await cursor.fetchall()
+            trip_ids = dict(await cursor.fetchall())
 
         # End trips
         await db.execute(
@@ -917,9 +777,9 @@ async def driver_complete_trip(callback: types.CallbackQuery):
                      WHERE driver_id=? AND status IN ('accepted', 'driver_arrived')''',
             (callback.from_user.id, ))
 
-        # Delete clients from active trips
+        # Close the orders (kept for history)
         await db.execute(
-            '''DELETE FROM clients 
+            '''UPDATE orders SET status='completed'
                      WHERE assigned_driver_id=? AND status IN ('accepted', 'driver_arrived')''',
             (callback.from_user.id, ))
 
@@ -928,59 +788,47 @@ async def driver_complete_trip(callback: types.CallbackQuery):
             '''UPDATE drivers 
                      SET occupied_seats = COALESCE(occupied_seats, 0) - ? 
                      WHERE user_id=?''', (total_freed, callback.from_user.id))
+        on_commit(dispatch.add_occupied, callback.from_user.id, -total_freed)
+        await record_result(db, f"✅ Сапар аяқталды! {total_freed} орын босады")
+
+        # Notify clients with rating buttons (delivered by the outbox)
+        for order_id, _, client_id in orders:
+            trip_id = trip_ids.get(order_id)
+            if not trip_id:
+                # No trip row to rate (should not happen for new orders)
+                await outbox.enqueue(db, OutgoingMessage(
+                    client_id, "✅ <b>Сапар аяқталды!</b>", parse_mode="HTML"),
+                    f"order_completed:{order_id}")
+                continue
 
-    await save_log_action(callback.from_user.id, "trip_completed",
-                          f"Freed {total_freed} seats")
-
-    # Notify clients with rating buttons
-    for client in clients:
-        client_user_id = client[0]
-        parent_user_id = client[3] if len(client) > 3 else client_user_id
-        
-        # Notify the actual passenger (if it's a sub-order)
-        if client_user_id != parent_user_id:
-            try:
-                await bot.send_message(
-                    client_user_id,
-                    f"✅ <b>Сапар аяқталды!</b>\n\n"
-                    f"Рақмет, жолаушы!",
-                    parse_mode="HTML")
-            except:
-                pass
-        
-        # Notify parent user (who made the order) with rating option
-        if trip_ids:
-            trip_id = trip_ids[0][0]  # Get first trip ID
-            
             rating_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⭐", callback_data=f"quick_rate_{trip_id}_1")],
-                [InlineKeyboardButton(text="⭐⭐", callback_data=f"quick_rate_{trip_id}_2")],
-                [InlineKeyboardButton(text="⭐⭐⭐", callback_data=f"quick_rate_{trip_id}_3")],
-                [InlineKeyboardButton(text="⭐⭐⭐⭐", callback_data=f"quick_rate_{trip_id}_4")],
-                [InlineKeyboardButton(text="⭐⭐⭐⭐⭐", callback_data=f"quick_rate_{trip_id}_5")],
+                [InlineKeyboardButton(text="⭐", callback_data=QuickRate(trip_id=trip_id, rating=1).pack())],
+                [InlineKeyboardButton(text="⭐⭐", callback_data=QuickRate(trip_id=trip_id, rating=2).pack())],
+                [InlineKeyboardButton(text="⭐⭐⭐", callback_data=QuickRate(trip_id=trip_id, rating=3).pack())],
+                [InlineKeyboardButton(text="⭐⭐⭐⭐", callback_data=QuickRate(trip_id=trip_id, rating=4).pack())],
+                [InlineKeyboardButton(text="⭐⭐⭐⭐⭐", callback_data=QuickRate(trip_id=trip_id, rating=5).pack())],
                 [InlineKeyboardButton(text="❌ Кейінірек", callback_data="rate_later")]
             ])
-            
-            try:
-                await bot.send_message(
-                    parent_user_id,
-                    f"✅ <b>Сапар аяқталды!</b>\n\n"
-                    f"Жүргізушіге баға беріңіз:",
-                    reply_markup=rating_keyboard,
-                    parse_mode="HTML")
-            except Exception as e:
-                logger.warning(f"Couldn't notify client {parent_user_id}: {e}")
+
+            await outbox.enqueue(db, OutgoingMessage(
+                client_id,
+                f"✅ <b>Сапар аяқталды!</b>\n\n"
+                f"Жүргізушіге баға беріңіз:",
+                rating_keyboard, "HTML"), f"order_completed:{order_id}")
+
+    await save_log_action(callback.from_user.id, "trip_completed",
+                          f"Freed {total_freed} seats")
 
     await callback.answer(f"✅ Сапар аяқталды! {total_freed} орын босады",
                           show_alert=True)
     await show_driver_menu(callback.message, callback.from_user.id)
     
-@dp.callback_query(F.data.startswith("quick_rate_"))
-async def quick_rate_handler(callback: types.CallbackQuery, state: FSMContext):
+@rating_router.callback(QuickRate)
+async def quick_rate_handler(callback: types.CallbackQuery,
+                             callback_data: QuickRate, state: FSMContext):
     """Handle quick rating from notification"""
-    parts = callback.data.split("_")
-    trip_id = int(parts[2])
-    rating = int(parts[3])
+    trip_id = callback_data.trip_id
+    rating = callback_data.rating
     
     # Store trip_id and rating in state
     await state.update_data(trip_id=trip_id, rating=rating)
@@ -998,7 +846,7 @@ async def quick_rate_handler(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query(F.data == "add_comment")
+@rating_router.callback("add_comment")
 async def add_comment_prompt(callback: types.CallbackQuery, state: FSMContext):
     """Prompt user to write a comment"""
     data = await state.get_data()
@@ -1011,7 +859,7 @@ async def add_comment_prompt(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query(F.data == "skip_comment")
+@rating_router.callback("skip_comment")
 async def skip_comment_handler(callback: types.CallbackQuery, state: FSMContext):
     """Submit rating without comment"""
     data = await state.get_data()
@@ -1027,7 +875,7 @@ async def skip_comment_handler(callback: types.CallbackQuery, state: FSMContext)
     await callback.answer("Баға сақталды!")
 
 
-@dp.callback_query(F.data == "rate_later")
+@rating_router.callback("rate_later")
 async def rate_later_handler(callback: types.CallbackQuery):
     """User chooses to rate later"""
     await callback.message.edit_text(
@@ -1040,17 +888,14 @@ async def save_rating_to_db(user_id: int, trip_id: int, rating: int, review: str
     """Helper function to save rating to database"""
     async with get_db(write=True) as db:
         # Получаем данные о поездке
-        async with db.execute(
-            '''SELECT driver_id, client_id FROM trips WHERE id=?''',
-            (trip_id,)) as cursor:
-            trip = await cursor.fetchone()
-        
+        trip = await fetch_trip(db, trip_id)
+
         if not trip:
             logger.error(f"Trip {trip_id} not found")
             return
-        
-        driver_id = trip[0]
-        client_id = trip[1]
+
+        driver_id = trip.driver_id
+        client_id = trip.client_id
         
         # ТОЛЬКО клиенты могут оценивать водителей
         if user_id != client_id:
@@ -1075,68 +920,85 @@ async def save_rating_to_db(user_id: int, trip_id: int, rating: int, review: str
             (user_id, driver_id, trip_id, rating, review))
         
         # Обновляем средний рейтинг водителя
-        await db.execute(
-            '''UPDATE drivers 
-                SET avg_rating = (SELECT AVG(rating) FROM ratings WHERE to_user_id=? AND user_type='driver'),
-                    rating_count = (SELECT COUNT(*) FROM ratings WHERE to_user_id=? AND user_type='driver')
-                WHERE user_id=?''', (driver_id, driver_id, driver_id))
+        await add_driver_rating(db, driver_id, rating)
     
     await save_log_action(user_id, "rating_submitted", f"Driver: {driver_id}, Rating: {rating}")
 
-@dp.callback_query(F.data == "driver_menu")
+@driver_router.callback("driver_menu")
 async def driver_menu_back(callback: types.CallbackQuery):
     await show_driver_menu(callback.message, callback.from_user.id)
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("driver_accept_"))
-async def driver_accept_new_order(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    # data format: driver_accept_<client_id>_<from_city>_<to_city>_<count>
-    if len(parts) < 6:
+@driver_router.callback(AcceptClientOrders)
+@idempotent
+async def driver_accept_new_order(callback: types.CallbackQuery,
+                                  callback_data: AcceptClientOrders):
+    route = route_by_key(callback_data.route)
+    if not route:
         await callback.answer("Қате дерек!", show_alert=True)
         return
 
-    client_id = int(parts[2])
-    from_city = parts[3]
-    to_city = parts[4]
-    passengers_count = int(parts[5])
+    client_id = callback_data.client_id
+    from_city = route.from_city
+    to_city = route.to_city
     driver_id = callback.from_user.id
 
-    async with get_db(write=True) as db:
-        # Ensure client still waiting
-        async with db.execute(
-                "SELECT c.parent_user_id, u.full_name, u.phone FROM clients c JOIN clients u ON u.user_id = c.parent_user_id WHERE c.parent_user_id=? AND c.from_city=? AND c.to_city=? AND c.status='waiting'",
-            (client_id, from_city, to_city)) as cursor:
-            client = await cursor.fetchone()
-
-        if not client:
-            await callback.answer("❌ Бұл тапсырыс енді қолжетімді емес",
-                                  show_alert=True)
-            return
+    try:
+        async with get_db(write=True) as db:
+            # Ensure client still waiting
+            async with db.execute(
+                    "SELECT o.id, o.passengers_count, c.full_name, c.phone, o.direction FROM orders o JOIN clients c ON c.user_id = o.client_id WHERE o.client_id=? AND o.from_city=? AND o.to_city=? AND o.status='waiting'",
+                (client_id, from_city, to_city)) as cursor:
+                orders = await cursor.fetchall()
 
-        # Assign driver
-        await db.execute(
-            "UPDATE clients SET status='accepted', assigned_driver_id=? WHERE parent_user_id=? AND status='waiting'",
-            (driver_id, client_id))
+            if not orders:
+                after_commit(callback.answer, "❌ Бұл тапсырыс енді қолжетімді емес",
+                             show_alert=True)
+                return
 
-        # Update occupied seats
-        await db.execute(
-            "UPDATE drivers SET occupied_seats = COALESCE(occupied_seats, 0) + ? WHERE user_id=?",
-            (passengers_count, driver_id))
+            # Seats come from the rows being claimed, not from callback data
+            passengers_count = sum(order[1] or 1 for order in orders)
+
+            # Assign driver
+            for order in orders:
+                if not await claim_order(db, order[0], driver_id):
+                    raise WriteConflict("❌ Бұл тапсырыс енді қолжетімді емес")
+
+            # Update occupied seats
+            if not await reserve_seats(db, driver_id, passengers_count):
+                raise WriteConflict(
+                    f"❌ Орын жетпейді! {passengers_count} орын қажет")
+            for order in orders:
+                on_commit(dispatch.remove_order, order[0])
+            on_commit(dispatch.add_occupied, driver_id, passengers_count)
+
+            await db.executemany(
+                '''INSERT INTO trips (driver_id, client_id, order_id, direction, status, passengers_count)
+                   VALUES (?, ?, ?, ?, 'accepted', ?)''',
+                [(driver_id, client_id, order[0], order[4], order[1] or 1)
+                 for order in orders])
+            await record_result(db, "Тапсырыс қабылданды!")
+
+            driver = await fetch_driver(db, driver_id)
+
+            # ✅ Notify client
+            await outbox.enqueue(db, OutgoingMessage(
+                client_id, f"✅ <b>Жүргізуші тапсырысыңызды қабылдады!</b>\n\n"
+                f"🚗 {driver.car_model} ({driver.car_number})\n"
+                f"👤 {driver.full_name}\n"
+                f"📞 Телефон: {driver.phone}\n"
+                f"📍 Маршрут: {from_city} → {to_city}\n\n"
+                f"Жүргізушінің қоңырауын күтіңіз немесе өзіңіз хабарласа аласыз.",
+                parse_mode="HTML"), f"order_accepted:{orders[0][0]}")
+    except WriteConflict as e:
+        await callback.answer(str(e), show_alert=True)
+        return
 
-        # Get driver info
-        async with db.execute(
-            "SELECT full_name, phone, car_model, car_number FROM drivers WHERE user_id=?",
-            (driver_id, )) as cursor:
-            driver_data = await cursor.fetchone()
-
-    # ====== Notify both sides ======
-    client_user_id = client[0]
-    client_name = client[1]
-    client_phone = client[2] if client[2] and not client[2].startswith(
+    # ====== Notify driver ======
+    client_name = orders[0][2]
+    client_phone = orders[0][3] if orders[0][3] and not orders[0][3].startswith(
         "tg_") else "Нөмір көрсетілмеген"
-    driver_name, driver_phone, car_model, car_number = driver_data
 
     # ✅ Notify driver
     await callback.message.edit_text(
@@ -1147,23 +1009,10 @@ async def driver_accept_new_order(callback: types.CallbackQuery):
         f"📞 Телефон: {client_phone}",
         parse_mode="HTML")
 
-    # ✅ Notify client
-    try:
-        await bot.send_message(
-            client_user_id, f"✅ <b>Жүргізуші тапсырысыңызды қабылдады!</b>\n\n"
-            f"🚗 {car_model} ({car_number})\n"
-            f"👤 {driver_name}\n"
-            f"📞 Телефон: {driver_phone}\n"
-            f"📍 Маршрут: {from_city} → {to_city}\n\n"
-            f"Жүргізушінің қоңырауын күтіңіз немесе өзіңіз хабарласа аласыз.",
-            parse_mode="HTML")
-    except Exception as e:
-        logger.warning(f"Couldn't notify client {client_user_id}: {e}")
-
     await callback.answer("Тапсырыс қабылданды!")
 
 
-@dp.callback_query(F.data.startswith("driver_reject_"))
+@driver_router.callback(RejectOrder)
 async def driver_reject_new_order(callback: types.CallbackQuery):
     await callback.message.edit_text("❌ Сіз бұл тапсырыстан бас тарттыңыз.")
     await callback.answer("Тапсырыс қабылданбады")
@@ -1172,7 +1021,7 @@ async def driver_reject_new_order(callback: types.CallbackQuery):
 # ==================== CLIENTS ====================
 
 
-@dp.message(F.text == "🧍‍♂️ Такси шақыру")
+@client_router.message(F.text == "🧍‍♂️ Такси шақыру")
 async def client_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     
@@ -1182,7 +1031,7 @@ async def client_start(message: types.Message, state: FSMContext):
     # Check if client profile exists
     async with get_db() as db:
         async with db.execute(
-                "SELECT user_id, full_name, phone FROM clients WHERE user_id=? AND status='registered'",
+                "SELECT user_id, full_name, phone FROM clients WHERE user_id=?",
             (user_id,)) as cursor:
             client = await cursor.fetchone()
 
@@ -1217,25 +1066,15 @@ async def client_start(message: types.Message, state: FSMContext):
 
 async def start_new_order(message: types.Message, state: FSMContext):
     """Helper function to start a new order"""
-    # Use the same direction keyboard as drivers
-    direction_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Ақтау → Жаңаөзен", callback_data="dir_aktau_janaozen")],
-        [InlineKeyboardButton(text="Жаңаөзен → Ақтау", callback_data="dir_janaozen_aktau")],
-        [InlineKeyboardButton(text="Ақтау → Шетпе", callback_data="dir_aktau_shetpe")],
-        [InlineKeyboardButton(text="Шетпе → Ақтау", callback_data="dir_shetpe_aktau")],
-        [InlineKeyboardButton(text="🔙 Артқа", callback_data="back_main")]
-    ])
-
     await message.answer(
         "🧍‍♂️ <b>Такси шақыру</b>\n\nБағытты таңдаңыз:",
-        reply_markup=direction_keyboard,
+        reply_markup=DIRECTION_KEYBOARD,
         parse_mode="HTML")
     await state.set_state(ClientOrder.from_city)
 
 
 
-@dp.callback_query(ClientOrder.confirm_data,
-                   F.data == "confirm_client_telegram_data")
+@client_router.callback("confirm_client_telegram_data", ClientOrder.confirm_data)
 async def confirm_client_telegram_data(callback: types.CallbackQuery,
                                        state: FSMContext):
     await callback.message.edit_text("✅ Керемет! Тіркеуді жалғастырамыз...")
@@ -1245,7 +1084,7 @@ async def confirm_client_telegram_data(callback: types.CallbackQuery,
     await callback.answer()
 
 
-@dp.message(ClientOrder.phone_number)
+@client_router.message(ClientOrder.phone_number)
 async def client_phone_number(message: types.Message, state: FSMContext):
     data = await state.get_data()
     phone = message.text.strip()
@@ -1257,7 +1096,7 @@ async def client_phone_number(message: types.Message, state: FSMContext):
     async with get_db(write=True) as db:
         # Проверяем, есть ли уже профиль
         async with db.execute(
-            "SELECT user_id FROM clients WHERE user_id=? AND status='registered'",
+            "SELECT user_id FROM clients WHERE user_id=?",
             (message.from_user.id,)) as cursor:
             existing = await cursor.fetchone()
         
@@ -1278,11 +1117,13 @@ async def client_phone_number(message: types.Message, state: FSMContext):
             await db.execute(
                 '''UPDATE clients 
                 SET full_name=?, phone=?, is_verified=1 
-                WHERE user_id=? AND status='registered' ''',
+                WHERE user_id=?''',
                 (data.get('full_name', message.from_user.full_name or "Клиент"),
                  phone,
                  message.from_user.id)
             )
+            on_commit(dispatch.rename_client, message.from_user.id,
+                      data.get('full_name', message.from_user.full_name or "Клиент"))
     
     await state.clear()
     await save_log_action(message.from_user.id, "client_registered", f"Phone: {phone}")
@@ -1298,27 +1139,19 @@ async def client_phone_number(message: types.Message, state: FSMContext):
 
 
 
-@dp.callback_query(F.data == "add_new_order")
+@client_router.callback("add_new_order")
 async def add_new_order(callback: types.CallbackQuery, state: FSMContext):
     """Add new taxi order"""
-    direction_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Ақтау → Жаңаөзен", callback_data="dir_aktau_janaozen")],
-        [InlineKeyboardButton(text="Жаңаөзен → Ақтау", callback_data="dir_janaozen_aktau")],
-        [InlineKeyboardButton(text="Ақтау → Шетпе", callback_data="dir_aktau_shetpe")],
-        [InlineKeyboardButton(text="Шетпе → Ақтау", callback_data="dir_shetpe_aktau")],
-        [InlineKeyboardButton(text="🔙 Артқа", callback_data="back_main")]
-    ])
-    
     await callback.message.edit_text(
         "🧍‍♂️ <b>Жаңа такси шақыру</b>\n\nБағытты таңдаңыз:",
-        reply_markup=direction_keyboard,
+        reply_markup=DIRECTION_KEYBOARD,
         parse_mode="HTML")
     await state.set_state(ClientOrder.from_city)
     await callback.answer()
 
 
 
-@dp.callback_query(F.data == "view_my_orders")
+@client_router.callback("view_my_orders")
 async def view_my_orders(callback: types.CallbackQuery):
     """Show user's active orders"""
     active_orders = await get_user_active_orders(callback.from_user.id)
@@ -1349,23 +1182,23 @@ async def view_my_orders(callback: types.CallbackQuery):
             'driver_arrived': '🚗 Жүргізуші келді'
         }
         status_emoji = {'waiting': '⏳', 'accepted': '✅', 'driver_arrived': '🚗'}
-        emoji = status_emoji.get(order[4], '❓')
-        status_text = status_map.get(order[4], '❓ Белгісіз')
+        emoji = status_emoji.get(order.status, '❓')
+        status_text = status_map.get(order.status, '❓ Белгісіз')
 
-        msg += f"{emoji} <b>Тапсырыс #{order[3]}</b>\n"
+        msg += f"{emoji} <b>Тапсырыс #{order.order_number}</b>\n"
         msg += f"   Статус: {status_text}\n"
-        msg += f"   👥 {order[6]} адам\n"
-        msg += f"   📍 {order[7]} → {order[8]}\n"
+        msg += f"   👥 {order.passengers_count} адам\n"
+        msg += f"   📍 {order.from_city} → {order.to_city}\n"
         
-        if order[9]:  # assigned_driver_id
+        if order.assigned_driver_id:
             msg += f"   🚗 Жүргізуші тағайындалды\n"
         
         msg += "\n"
 
         keyboard_buttons.append([
             InlineKeyboardButton(
-                text=f"❌ Тапсырысты жою #{order[3]}",
-                callback_data=f"cancel_order_{order[0]}")
+                text=f"❌ Тапсырысты жою #{order.order_number}",
+                callback_data=CancelOrder(order_id=order.id).pack())
         ])
 
     keyboard_buttons.append(
@@ -1378,111 +1211,80 @@ async def view_my_orders(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("cancel_order_"))
-async def cancel_specific_order(callback: types.CallbackQuery):
+@client_router.callback(CancelOrder)
+async def cancel_specific_order(callback: types.CallbackQuery,
+                                callback_data: CancelOrder):
     """Cancel a specific order"""
-    order_user_id = int(callback.data.split("_")[2])
+    order_id = callback_data.order_id
     parent_user_id = callback.from_user.id
 
     try:
-        # Получаем данные клиента
+        # Получаем заказ и профиль клиента
         async with get_db() as db:
-            async with db.execute("PRAGMA table_info(clients)") as cursor:
-                columns = [col[1] for col in await cursor.fetchall()]
-            
-            async with db.execute("SELECT * FROM clients WHERE user_id=?",
-                                  (order_user_id, )) as cursor:
-                client = await cursor.fetchone()
+            order = await fetch_order(db, order_id)
+            client = await fetch_client(db, parent_user_id)
 
-        if not client:
+        if not order:
             await callback.answer("❌ Тапсырыс табылмады", show_alert=True)
             return
 
-        # Получаем ВСЕ необходимые индексы колонок
-        user_id_idx = columns.index('user_id')
-        status_idx = columns.index('status')
-        parent_user_id_idx = columns.index('parent_user_id') if 'parent_user_id' in columns else None
-        assigned_driver_id_idx = columns.index('assigned_driver_id') if 'assigned_driver_id' in columns else None
-        passengers_count_idx = columns.index('passengers_count')
-        direction_idx = columns.index('direction')
-        order_number_idx = columns.index('order_number') if 'order_number' in columns else None
-        full_name_idx = columns.index('full_name')
-        
-        # ИСПРАВЛЕНИЕ: Проверяем, что это НЕ профиль (status != 'registered')
-        if client[status_idx] == 'registered':
-            await callback.answer("❌ Тапсырысты жою мүмкін емес! Тек белсенді тапсырыстарды жоюға болады.", show_alert=True)
-            return
-        
         # Проверка владельца заказа
-        if parent_user_id_idx and len(client) > parent_user_id_idx and client[parent_user_id_idx]:
-            order_owner = client[parent_user_id_idx]
-        else:
-            order_owner = client[user_id_idx]
-        
-        if order_owner != parent_user_id:
+        if order.client_id != parent_user_id:
             await callback.answer("❌ Бұл сіздің тапсырысыңыз емес!", show_alert=True)
             return
 
-        # Извлекаем данные заказа
-        driver_id = client[assigned_driver_id_idx] if assigned_driver_id_idx and len(client) > assigned_driver_id_idx and client[assigned_driver_id_idx] else None
-        passengers_count = client[passengers_count_idx]
-        direction = client[direction_idx]
-        order_number = client[order_number_idx] if order_number_idx and len(client) > order_number_idx else 1
-        client_name = client[full_name_idx]
+        # Только активные заказы можно отменить
+        if order.status not in ACTIVE_ORDER_STATUSES:
+            await callback.answer("❌ Тапсырысты жою мүмкін емес! Тек белсенді тапсырыстарды жоюға болады.", show_alert=True)
+            return
 
-        # Получаем текущее количество отмен
-        cancellation_count = await get_cancellation_count(parent_user_id)
-        new_count = cancellation_count + 1
+        order_number = order.order_number
+        client_name = client.full_name if client else callback.from_user.full_name
 
         # Выполняем операции записи
         async with get_db(write=True) as db:
+            # Заказ мог быть закрыт или принят водителем, пока мы читали:
+            # водитель и места берутся из закрытой строки
+            closed = await close_order(db, order_id, 'cancelled')
+            if not closed:
+                after_commit(callback.answer, "❌ Тапсырыс табылмады",
+                             show_alert=True)
+                return
+            driver_id, passengers_count = closed
+            on_commit(dispatch.remove_order, order_id)
+
             # Если назначен водитель, освобождаем места
             if driver_id:
                 await db.execute(
                     '''UPDATE drivers 
                        SET occupied_seats = COALESCE(occupied_seats, 0) - ? 
                        WHERE user_id=?''', (passengers_count, driver_id))
+                on_commit(dispatch.add_occupied, driver_id, -passengers_count)
 
-                # Уведомляем водителя
-                try:
-                    await bot.send_message(
-                        driver_id, 
-                        f"⚠️ <b>Клиент тапсырысты жойды</b>\n\n"
-                        f"👤 {client_name}\n"
-                        f"👥 Босатылған орындар: {passengers_count}",
-                        parse_mode="HTML")
-                except Exception as e:
-                    logger.warning(f"Couldn't notify driver {driver_id}: {e}")
+                # Уведомляем водителя (доставка через outbox)
+                await outbox.enqueue(db, OutgoingMessage(
+                    driver_id,
+                    f"⚠️ <b>Клиент тапсырысты жойды</b>\n\n"
+                    f"👤 {client_name}\n"
+                    f"👥 Босатылған орындар: {passengers_count}",
+                    parse_mode="HTML"), f"order_cancelled:{order_id}")
 
             # Обновляем статус поездки
             await db.execute(
                 '''UPDATE trips SET status='cancelled', cancelled_by='client', 
                    cancelled_at=CURRENT_TIMESTAMP 
-                   WHERE client_id=? AND status IN ('waiting', 'accepted', 'driver_arrived')''',
-                (order_user_id, ))
-
-            # Обновляем счетчик отмен ПЕРЕД удалением
-            await db.execute(
-                '''UPDATE clients SET cancellation_count=? 
-                   WHERE user_id=?''',
-                (new_count, parent_user_id))
-
-            # Удаляем заказ клиента
-            await db.execute("DELETE FROM clients WHERE user_id=?",
-                             (order_user_id, ))
+                   WHERE order_id=? AND status IN ('waiting', 'accepted', 'driver_arrived')''',
+                (order_id, ))
 
-            # Переупорядочиваем очередь
+            # Обновляем счетчик отмен; заказ остаётся в истории со
+            # статусом 'cancelled', очередь не перенумеровываем
             async with db.execute(
-                '''SELECT user_id FROM clients 
-                   WHERE direction=? AND status='waiting'
-                   ORDER BY queue_position''',
-                (direction, )) as cursor:
-                clients = await cursor.fetchall()
-
-            for pos, (client_id,) in enumerate(clients, 1):
-                await db.execute(
-                    "UPDATE clients SET queue_position=? WHERE user_id=?",
-                    (pos, client_id))
+                    '''UPDATE clients
+                       SET cancellation_count = COALESCE(cancellation_count, 0) + 1
+                       WHERE user_id=? RETURNING cancellation_count''',
+                (parent_user_id, )) as cursor:
+                row = await cursor.fetchone()
+            new_count = row[0] if row else 1
 
         await save_log_action(parent_user_id, "order_cancelled",
                               f"Order #{order_number}, Cancellation #{new_count}")
@@ -1519,8 +1321,8 @@ async def cancel_specific_order(callback: types.CallbackQuery):
                 "📵 Сіз 2 рет тапсырыс жойдыңыз.\n"
                 "Енді бот сізге қолжетімді емес.\n\n"
                 f"✅ Бұғаттан шығу үшін админге хабарласыңыз:\n"
-                f"👤 {ADMIN_USER_LOGIN}\n"
-                f"📞 {ADMIN_PHONE}",
+                f"👤 {config.admin_user_login}\n"
+                f"📞 {config.admin_phone}",
                 parse_mode="HTML")
             await callback.answer("🚫 БҰҒАТТАЛДЫҢЫЗ!", show_alert=True)
         else:
@@ -1538,8 +1340,9 @@ async def cancel_specific_order(callback: types.CallbackQuery):
         logger.error(f"Error in cancel_specific_order: {e}", exc_info=True)
         await callback.answer("❌ Қате орын алды. Қайта көріңіз немесе админге хабарласыңыз.", show_alert=True)
 
-@dp.callback_query(ClientOrder.from_city, F.data.startswith("dir_"))
-async def client_from_city(callback: types.CallbackQuery, state: FSMContext):
+@client_router.callback(PickRoute, ClientOrder.from_city)
+async def client_from_city(callback: types.CallbackQuery,
+                           callback_data: PickRoute, state: FSMContext):
     # Проверка на блокировку
     is_banned, ban_reason = await check_blacklist(callback.from_user.id)
     if is_banned:
@@ -1547,42 +1350,30 @@ async def client_from_city(callback: types.CallbackQuery, state: FSMContext):
             f"🚫 <b>Сіз бұғатталғансыз!</b>\n\n"
             f"Себеп: {ban_reason}\n\n"
             f"Админге хабарласыңыз:\n"
-            f"👤 {ADMIN_USER_LOGIN}\n"
-            f"📞 {ADMIN_PHONE}",
+            f"👤 {config.admin_user_login}\n"
+            f"📞 {config.admin_phone}",
             parse_mode="HTML")
         await state.clear()
         await callback.answer("❌ Бұғатталған!", show_alert=True)
         return
 
-    direction_map = {
-        "dir_aktau_janaozen": "Ақтау → Жаңаөзен",
-        "dir_janaozen_aktau": "Жаңаөзен → Ақтау",
-        "dir_aktau_shetpe": "Ақтау → Шетпе",
-        "dir_shetpe_aktau": "Шетпе → Ақтау"
-    }
-    
-    direction = direction_map[callback.data]
-    from_city, to_city = direction.split(" → ")
-    
-    await state.update_data(from_city=from_city, to_city=to_city, direction=direction)
+    route = route_by_key(callback_data.route)
+    if not route:
+        await callback.answer("❌ Бағыт табылмады", show_alert=True)
+        return
 
-    # Show available drivers and seats
-    async with get_db() as db:
-        async with db.execute(
-            '''SELECT COUNT(*), SUM(total_seats - COALESCE(occupied_seats, 0))
-               FROM drivers 
-               WHERE direction=? AND is_active=1''',
-            (direction,)) as cursor:
-            result = await cursor.fetchone()
+    direction = route.direction
+    await state.update_data(route_id=route.id, from_city=route.from_city,
+                            to_city=route.to_city, direction=direction)
 
-    drivers_count = result[0] or 0
-    available_seats = result[1] or 0
+    # Show available drivers and seats
+    drivers_count, available_seats = dispatch.capacity(direction)
 
     # Create seat selection buttons (1-7)
     seat_buttons = []
     for i in range(1, 8):  # Changed from 9 to 8
         seat_buttons.append([
-            InlineKeyboardButton(text=f"👥 {i} орын", callback_data=f"seats_{i}")
+            InlineKeyboardButton(text=f"👥 {i} орын", callback_data=PickSeats(count=i).pack())
         ])
     
     seat_buttons.append([
@@ -1599,33 +1390,25 @@ async def client_from_city(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 # Add new callback handler for seat buttons
-@dp.callback_query(ClientOrder.passengers_count, F.data.startswith("seats_"))
-async def client_select_seats(callback: types.CallbackQuery, state: FSMContext):
-    count = int(callback.data.split("_")[1])
+@client_router.callback(PickSeats, ClientOrder.passengers_count)
+async def client_select_seats(callback: types.CallbackQuery,
+                              callback_data: PickSeats, state: FSMContext):
+    count = callback_data.count
     data = await state.get_data()
     from_city = data.get("from_city")
     to_city = data.get("to_city")
     direction = data.get("direction")
 
     # Calculate price
-    if {"Ақтау", "Шетпе"} == {from_city, to_city}:
-        price = 2000 * count
-    elif {"Ақтау", "Жаңаөзен"} == {from_city, to_city}:
-        price = 2500 * count
-    else:
-        price = 0
+    route = ROUTES_BY_ID.get(data.get("route_id")) or route_by_cities(from_city, to_city)
+    price = route.price(count) if route else 0
 
-    # ✅ Save passengers_count WITHOUT order_for
-    await state.update_data(passengers_count=count)
+    # ✅ Save passengers_count WITHOUT order_for; a new draft_id makes the
+    # confirm button a new tap even on the message of the previous order
+    await state.update_data(passengers_count=count, draft_id=secrets.token_hex(4))
     
     # Check suitable drivers
-    async with get_db() as db:
-        async with db.execute(
-            '''SELECT COUNT(*) FROM drivers 
-               WHERE direction=? AND is_active=1 
-               AND (total_seats - COALESCE(occupied_seats, 0)) >= ?''',
-            (direction, count)) as cursor:
-            suitable_cars = (await cursor.fetchone())[0]
+    suitable_cars = dispatch.suitable_drivers(direction, count)
 
     if suitable_cars == 0:
         msg = (f"⚠️ Жолаушылар саны: {count}\n"
@@ -1648,108 +1431,97 @@ async def client_select_seats(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(msg, reply_markup=keyboard)
     await callback.answer()
 
-@dp.callback_query(F.data == "back_from_city")
+@client_router.callback("back_from_city")
 async def back_from_city(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("Қай қаладан шығасыз?",
                                      reply_markup=from_city_keyboard())
     await state.set_state(ClientOrder.from_city)
     await callback.answer()
 
-async def finalize_order(callback: types.CallbackQuery, state: FSMContext):
-    """Finalize the order and offer to add another"""
-    data = await state.get_data()
-    
+def notify_drivers_about_order(order_id: int, driver_ids: list,
+                               passengers_count: int, from_city: str, to_city: str):
+    """Send the new order with accept/reject buttons to every driver at once"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(
+            text="✅ Қабылдау",
+            callback_data=AcceptOrder(order_id=order_id).pack()),
+        InlineKeyboardButton(
+            text="❌ Бас тарту",
+            callback_data=RejectOrder(order_id=order_id).pack())
+    ]])
+    text = (f"🔔 <b>Жаңа тапсырыс!</b>\n\n"
+            f"👥 Жолаушылар саны: {passengers_count}\n"
+            f"📍 {from_city} → {to_city}\n\n"
+            f"Төмендегі батырмалардың бірін таңдаңыз:")
+
+    broadcaster.submit(
+        [OutgoingMessage(driver_id, text, keyboard, "HTML") for driver_id in driver_ids],
+        label=f"new order {order_id}")
+
+
+async def create_order(client_id: int, data: dict) -> tuple:
+    """Create the order described by the FSM ``data`` and notify drivers.
+
+    Returns (order_number, queue_place, suitable drivers), or None if the
+    client has no profile
+    """
     direction = data.get(
         'direction',
         f"{data.get('from_city', '')} → {data.get('to_city', '')}")
     from_city = data.get('from_city', '')
     to_city = data.get('to_city', '')
-
-    # Count existing orders to assign order number
-    current_orders = await count_user_orders(callback.from_user.id)
-    order_number = current_orders + 1
-    
-    # Generate unique user_id for this order
-    import time
-    order_user_id = int(f"{callback.from_user.id}{int(time.time() * 1000) % 100000}")
+    seats = data['passengers_count']
 
     async with get_db(write=True) as db:
-        # Set queue position
-        async with db.execute(
-                "SELECT MAX(queue_position) FROM clients WHERE direction=?",
-            (direction, )) as cursor:
-            max_pos = (await cursor.fetchone())[0]
-
-        queue_pos = (max_pos or 0) + 1
-
         # Get client profile - должен уже существовать!
         async with db.execute(
-                "SELECT full_name, phone FROM clients WHERE user_id=? AND status='registered'",
-            (callback.from_user.id,)) as cursor:
+                "SELECT full_name FROM clients WHERE user_id=?",
+            (client_id, )) as cursor:
             profile = await cursor.fetchone()
-    
         if not profile:
-            await callback.answer("❌ Ошибка: профиль не найден. Попробуйте /start", show_alert=True)
-            await state.clear()
-            return
-    
-        client_name, client_phone = profile
+            return None
+
+        # Order number: the client's active orders plus this one, counted
+        # under the write lock so two orders never get the same number
+        order_number = await count_client_orders(db, client_id) + 1
 
         # Create new order entry (separate from profile)
-        await db.execute(
-            '''INSERT INTO clients 
-            (user_id, full_name, phone, direction, from_city, to_city, 
-             queue_position, passengers_count, 
-             is_verified, status, order_number, parent_user_id)
-             VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, 'waiting', ?, ?)''',
-             (order_user_id,  # unique ID for this order
-             client_name,
-             client_phone,
-             direction, from_city, to_city,
-             queue_pos, data['passengers_count'], 
-             order_number, callback.from_user.id))  # parent_user_id = actual user
-
-        # Check suitable drivers
+        queue_pos = await next_queue_position(db, "orders", direction)
         async with db.execute(
-            '''SELECT COUNT(*) FROM drivers 
-               WHERE direction=? AND is_active=1 
-               AND (total_seats - COALESCE(occupied_seats, 0)) >= ?''',
-            (direction, data['passengers_count'])) as cursor:
-            suitable = (await cursor.fetchone())[0]
+                '''INSERT INTO orders
+                (client_id, direction, from_city, to_city,
+                 queue_position, passengers_count, order_number)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (client_id, direction, from_city, to_city,
+             queue_pos, seats, order_number)) as cursor:
+            order_id = cursor.lastrowid
+        on_commit(dispatch.add_order,
+                  WaitingOrder(queue_pos, order_id, direction, client_id,
+                               profile[0], seats))
+        await record_result(db, f"✅ Тапсырыс #{order_number} жасалды!")
 
-        # Get drivers to notify
-        async with db.execute(
-                '''SELECT user_id FROM drivers 
-               WHERE direction=? AND is_active=1 
-               AND (total_seats - COALESCE(occupied_seats, 0)) >= ?''',
-            (direction, data['passengers_count'])) as cursor:
-            drivers = await cursor.fetchall()
+        queue_place = await waiting_place(db, direction, queue_pos, order_id)
 
-    await save_log_action(callback.from_user.id, "order_created",
-                          f"Order #{order_number}")
+    # Drivers to notify, from the dispatch state (current as of the commit)
+    driver_ids = [driver.user_id
+                  for driver in dispatch.drivers_with_seats(direction, seats)]
 
-    # Notify drivers
-    for driver in drivers:
-        try:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(
-                    text="✅ Қабылдау",
-                    callback_data=f"accept_client_{order_user_id}"),  # use order_user_id
-                InlineKeyboardButton(
-                    text="❌ Бас тарту",
-                    callback_data=f"driver_reject_{order_user_id}")  # use order_user_id
-            ]])
+    await save_log_action(client_id, "order_created", f"Order #{order_number}")
 
-            await bot.send_message(
-                driver[0], f"🔔 <b>Жаңа тапсырыс!</b>\n\n"
-                f"👥 Жолаушылар саны: {data['passengers_count']}\n"
-                f"📍 {from_city} → {to_city}\n\n"
-                f"Төмендегі батырмалардың бірін таңдаңыз:",
-                reply_markup=keyboard,
-                parse_mode="HTML")
+    # Notify drivers in the background; the client doesn't wait for it
+    notify_drivers_about_order(order_id, driver_ids, seats, from_city, to_city)
+    return order_number, queue_place, len(driver_ids)
 
-        except:
-            pass
+
+async def finalize_order(callback: types.CallbackQuery, state: FSMContext):
+    """Finalize the order and offer to add another"""
+    data = await state.get_data()
+    created = await create_order(callback.from_user.id, data)
+    if created is None:
+        await callback.answer("❌ Ошибка: профиль не найден. Попробуйте /start", show_alert=True)
+        await state.clear()
+        return
+    order_number, queue_place, suitable = created
 
     # Offer to add another order
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[
@@ -1760,148 +1532,34 @@ async def finalize_order(callback: types.CallbackQuery, state: FSMContext):
 
     await callback.message.edit_text(
         f"✅ <b>Тапсырыс #{order_number} жасалды!</b>\n\n"
-        f"📍 {from_city} → {to_city}\n"
+        f"📍 {data.get('from_city', '')} → {data.get('to_city', '')}\n"
         f"👥 Жолаушылар саны: {data['passengers_count']}\n"
-        f"📊 Кезектегі орын: №{queue_pos}\n\n"
+        f"📊 Кезектегі орын: №{queue_place}\n\n"
         f"🚗 Бос жүргізушілер: {suitable}\n\n"
         f"Тағы бір тапсырыс жасағыңыз келеді ме?",
         reply_markup=keyboard,
         parse_mode="HTML")
     await state.set_state(ClientOrder.add_another)
     
-@dp.callback_query(F.data == "confirm_order")
+@client_router.callback("confirm_order")
+@idempotent(nonce=order_draft)
 async def confirm_order(callback: types.CallbackQuery, state: FSMContext):
     """Confirm and finalize order"""
     await callback.answer()
     await finalize_order(callback, state)
 
-async def finalize_order_from_message(message: types.Message, state: FSMContext):
-    """Same as finalize_order but from message context"""
-    data = await state.get_data()
-    
-    from_city = data.get('from_city', '')
-    to_city = data.get('to_city', '')
-    
-    current_orders = await count_user_orders(message.from_user.id)
-    order_number = current_orders + 1
-    
-    order_user_id = int(f"{message.from_user.id}{int(time.time() * 1000) % 100000}")
-
-    async with get_db(write=True) as db:
-
-        direction = data.get(
-            'direction',
-            f"{data.get('from_city', '')} → {data.get('to_city', '')}")
-
-        async with db.execute(
-                "SELECT MAX(queue_position) FROM clients WHERE direction=?",
-            (direction, )) as cursor:
-            max_pos = (await cursor.fetchone())[0]
-
-        queue_pos = (max_pos or 0) + 1
-        
-        # Get client profile data
-        async with db.execute(
-                "SELECT full_name, phone FROM clients WHERE user_id=? AND status='registered'",
-            (message.from_user.id,)) as cursor:
-            profile = await cursor.fetchone()
-        
-        if not profile:
-            await message.answer("❌ Профиль табылмады! /start командасын пайдаланыңыз", show_alert=True)
-            return
-        
-        client_name, client_phone = profile
-
-        # Create new order entry (separate from profile)
-        await db.execute(
-            '''INSERT INTO clients 
-            (user_id, full_name, phone, direction, from_city, to_city, 
-             queue_position, passengers_count, 
-             is_verified, status, order_number, parent_user_id)
-             VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, 'waiting', ?, ?)''',
-            (order_user_id,  # unique ID for this order
-             client_name,
-             client_phone,
-             direction, from_city, to_city,
-             queue_pos, data['passengers_count'],
-             order_number, message.from_user.id))  # parent_user_id = actual user
-
-        async with db.execute(
-                '''SELECT COUNT(*) FROM drivers 
-               WHERE direction=? AND is_active=1 
-               AND (total_seats - COALESCE(occupied_seats, 0)) >= ?''',
-            (direction, data['passengers_count'])) as cursor:
-            suitable = (await cursor.fetchone())[0]
-
-        async with db.execute(
-                '''SELECT user_id FROM drivers 
-               WHERE direction=? AND is_active=1 
-               AND (total_seats - COALESCE(occupied_seats, 0)) >= ?''',
-            (direction, data['passengers_count'])) as cursor:
-            drivers = await cursor.fetchall()
-
-    await save_log_action(message.from_user.id, "order_created",
-                          f"Order #{order_number}")
-
-    # Notify drivers
-    for driver in drivers:
-        try:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(
-                    text="✅ Қабылдау",
-                    callback_data=f"accept_client_{order_user_id}"),
-                InlineKeyboardButton(
-                    text="❌ Бас тарту",
-                    callback_data=f"driver_reject_{order_user_id}")
-            ]])
-
-            await bot.send_message(
-                driver[0], f"🔔 <b>Жаңа тапсырыс!</b>\n\n"
-                f"👥 Жолаушылар саны: {data['passengers_count']}\n"
-                f"📍 {from_city} → {to_city}\n\n"
-                f"Төмендегі батырмалардың бірін таңдаңыз:",
-                reply_markup=keyboard,
-                parse_mode="HTML")
-        except Exception as e:
-            logger.warning(f"Couldn't notify driver {driver[0]}: {e}")
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text="➕ Жаңа тапсырыс жасау",
-                             callback_data="add_another_yes")
-    ], [InlineKeyboardButton(text="✅ Аяқтау", callback_data="add_another_no")]
-                                                     ])
-
-    await message.answer(
-        f"✅ <b>Тапсырыс #{order_number} жасалды!</b>\n\n"
-        f"📍 {from_city} → {to_city}\n"
-        f"👥 Жолаушылар саны: {data['passengers_count']}\n"
-        f"📊 Кезектгі орын: №{queue_pos}\n\n"
-        f"🚗 Бос жүргізушілер: {suitable}\n\n"
-        f"Тағы бір тапсырыс жасағыңыз келеді ме?",
-        reply_markup=keyboard,
-        parse_mode="HTML")
-    await state.set_state(ClientOrder.add_another)
-
-@dp.callback_query(F.data == "add_another_yes")
+@client_router.callback("add_another_yes")
 async def add_another_order_callback(callback: types.CallbackQuery, state: FSMContext):
     """Add another taxi order"""
-    direction_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Ақтау → Жаңаөзен", callback_data="dir_aktau_janaozen")],
-        [InlineKeyboardButton(text="Жаңаөзен → Ақтау", callback_data="dir_janaozen_aktau")],
-        [InlineKeyboardButton(text="Ақтау → Шетпе", callback_data="dir_aktau_shetpe")],
-        [InlineKeyboardButton(text="Шетпе → Ақтау", callback_data="dir_shetpe_aktau")],
-        [InlineKeyboardButton(text="🔙 Артқа", callback_data="back_main")]
-    ])
-    
     await callback.message.edit_text(
         "🧍‍♂️ <b>Жаңа тапсырыс</b>\n\nБағытты таңдаңыз:",
-        reply_markup=direction_keyboard,
+        reply_markup=DIRECTION_KEYBOARD,
         parse_mode="HTML")
     await state.set_state(ClientOrder.from_city)
     await callback.answer()
 
 
-@dp.callback_query(F.data == "add_another_no")
+@client_router.callback("add_another_no")
 async def finish_ordering(callback: types.CallbackQuery, state: FSMContext):
     """End order process"""
     total_orders = await count_user_orders(callback.from_user.id)
@@ -1916,7 +1574,7 @@ async def finish_ordering(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer()
     
-@dp.message(Command("client"))
+@client_router.message(Command("client"))
 async def cmd_client(message: types.Message):
     """Client menu shortcut"""
     await show_client_menu(message, message.from_user.id)
@@ -1926,7 +1584,7 @@ async def show_client_menu(message: types.Message, user_id: int):
     """Show client profile and menu"""
     async with get_db() as db:
         async with db.execute(
-            "SELECT full_name, phone, avg_rating, rating_count FROM clients WHERE user_id=? AND status='registered'",
+            "SELECT full_name, phone, avg_rating, rating_count FROM clients WHERE user_id=?",
             (user_id,)) as cursor:
             client = await cursor.fetchone()
     
@@ -1941,11 +1599,8 @@ async def show_client_menu(message: types.Message, user_id: int):
     # Get completed trips count
     async with get_db() as db:
         async with db.execute(
-            '''SELECT COUNT(*) FROM trips 
-               WHERE client_id IN (
-                   SELECT user_id FROM clients WHERE parent_user_id=? OR user_id=?
-               ) AND status='completed' ''',
-            (user_id, user_id)) as cursor:
+            "SELECT COUNT(*) FROM trips WHERE client_id=? AND status='completed'",
+            (user_id, )) as cursor:
             completed = (await cursor.fetchone())[0]
     
     msg = f"🧍‍♂️ <b>Клиент профилі</b>\n\n"
@@ -1969,7 +1624,7 @@ async def show_client_menu(message: types.Message, user_id: int):
 # ==================== RATINGS ====================
 
 
-@dp.message(F.text == "⭐ Профиль")
+@common_router.message(F.text == "⭐ Профиль")
 async def show_profile(message: types.Message):
     user_id = message.from_user.id
     
@@ -1982,7 +1637,7 @@ async def show_profile(message: types.Message):
 
         # Check if user is a client - ИСПРАВЛЕНО ТУТ!
         async with db.execute(
-                "SELECT user_id FROM clients WHERE user_id=? AND status='registered'",
+                "SELECT user_id FROM clients WHERE user_id=?",
             (user_id,)) as cursor:
             client = await cursor.fetchone()
 
@@ -2013,7 +1668,7 @@ async def show_profile(message: types.Message):
         await show_client_menu(message, user_id)
         return
     
-@dp.callback_query(F.data == "profile_driver")
+@common_router.callback("profile_driver")
 async def show_driver_profile(callback: types.CallbackQuery):
     """Show driver profile from profile selection"""
     await callback.message.delete()
@@ -2021,14 +1676,14 @@ async def show_driver_profile(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(F.data == "profile_client")
+@common_router.callback("profile_client")
 async def show_client_profile(callback: types.CallbackQuery):
     """Show client profile from profile selection"""
     await callback.message.delete()
     await show_client_menu(callback.message, callback.from_user.id)
     await callback.answer()
 
-@dp.callback_query(F.data == "rate_start")
+@rating_router.callback("rate_start")
 async def rate_start(callback: types.CallbackQuery, state: FSMContext):
     # Получаем поездки, где пользователь был КЛИЕНТОМ
     async with get_db() as db:
@@ -2055,7 +1710,7 @@ async def rate_start(callback: types.CallbackQuery, state: FSMContext):
         keyboard_buttons.append([
             InlineKeyboardButton(
                 text=f"⭐ {driver_name} ({direction})",
-                callback_data=f"rate_trip_{trip[0]}")
+                callback_data=RateTrip(trip_id=trip[0]).pack())
         ])
     
     keyboard_buttons.append([
@@ -2070,18 +1725,19 @@ async def rate_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("rate_trip_"))
-async def rate_trip(callback: types.CallbackQuery, state: FSMContext):
-    trip_id = int(callback.data.split("_")[2])
+@rating_router.callback(RateTrip)
+async def rate_trip(callback: types.CallbackQuery, callback_data: RateTrip,
+                    state: FSMContext):
+    trip_id = callback_data.trip_id
 
     await state.update_data(trip_id=trip_id)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⭐", callback_data="rating_1")],
-        [InlineKeyboardButton(text="⭐⭐", callback_data="rating_2")],
-        [InlineKeyboardButton(text="⭐⭐⭐", callback_data="rating_3")],
-        [InlineKeyboardButton(text="⭐⭐⭐⭐", callback_data="rating_4")],
-        [InlineKeyboardButton(text="⭐⭐⭐⭐⭐", callback_data="rating_5")]
+        [InlineKeyboardButton(text="⭐", callback_data=PickRating(rating=1).pack())],
+        [InlineKeyboardButton(text="⭐⭐", callback_data=PickRating(rating=2).pack())],
+        [InlineKeyboardButton(text="⭐⭐⭐", callback_data=PickRating(rating=3).pack())],
+        [InlineKeyboardButton(text="⭐⭐⭐⭐", callback_data=PickRating(rating=4).pack())],
+        [InlineKeyboardButton(text="⭐⭐⭐⭐⭐", callback_data=PickRating(rating=5).pack())]
     ])
 
     await callback.message.edit_text("⭐ Бағаны таңдаңыз:",
@@ -2090,9 +1746,10 @@ async def rate_trip(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query(RatingStates.select_rating, F.data.startswith("rating_"))
-async def save_rating(callback: types.CallbackQuery, state: FSMContext):
-    rating = int(callback.data.split("_")[1])
+@rating_router.callback(PickRating, RatingStates.select_rating)
+async def save_rating(callback: types.CallbackQuery, callback_data: PickRating,
+                      state: FSMContext):
+    rating = callback_data.rating
     await state.update_data(rating=rating)
 
     await callback.message.edit_text(
@@ -2102,7 +1759,7 @@ async def save_rating(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message(RatingStates.write_review)
+@rating_router.message(RatingStates.write_review)
 async def save_review(message: types.Message, state: FSMContext):
     """Save rating with review"""
     data = await state.get_data()
@@ -2128,7 +1785,7 @@ async def save_review(message: types.Message, state: FSMContext):
 # ==================== GENERAL ====================
 
 
-@dp.message(Command("start"))
+@common_router.message(Command("start"))
 async def cmd_start(message: types.Message):
     await save_log_action(message.from_user.id, "bot_started", "")
 
@@ -2140,13 +1797,13 @@ async def cmd_start(message: types.Message):
         parse_mode="HTML")
 
 
-@dp.message(Command("driver"))
+@driver_router.message(Command("driver"))
 async def cmd_driver(message: types.Message):
     """Driver menu shortcut"""
     await show_driver_menu(message, message.from_user.id)
 
 
-@dp.message(Command("rate"))
+@rating_router.message(Command("rate"))
 async def cmd_rate(message: types.Message, state: FSMContext):
     """Rate menu shortcut"""
     async with get_db() as db:
@@ -2161,30 +1818,27 @@ async def cmd_rate(message: types.Message, state: FSMContext):
             (message.from_user.id, message.from_user.id, message.from_user.id)) as cursor:
             trips = await cursor.fetchall()
 
+        # Counterpart names for all trips at once
+        client_names = await get_client_names_by_ids(
+            db, [trip[2] for trip in trips if trip[1] == message.from_user.id])
+        drivers = await get_drivers_by_ids(
+            db, [trip[1] for trip in trips if trip[1] != message.from_user.id])
+
     if not trips:
         await message.answer("❌ Бағалау үшін сапарлар жоқ")
         return
 
     keyboard_buttons = []
     for trip in trips:
-        is_driver = trip[1] == message.from_user.id
-        
-        # Get target user info
-        target_id = trip[2] if is_driver else trip[1]
-        
-        async with get_db() as db:
-            if is_driver:
-                async with db.execute("SELECT full_name FROM clients WHERE user_id=?", (target_id,)) as cur:
-                    target = await cur.fetchone()
-                    target_name = f"Клиентті {target[0] if target else 'N/A'}"
-            else:
-                async with db.execute("SELECT full_name FROM drivers WHERE user_id=?", (target_id,)) as cur:
-                    target = await cur.fetchone()
-                    target_name = f"Жүргізушіні {target[0] if target else 'N/A'}"
-        
+        if trip[1] == message.from_user.id:
+            target_name = f"Клиентті {client_names.get(trip[2], 'N/A')}"
+        else:
+            driver = drivers.get(trip[1])
+            target_name = f"Жүргізушіні {driver.full_name if driver else 'N/A'}"
+
         keyboard_buttons.append([
             InlineKeyboardButton(text=f"⭐ {target_name}",
-                               callback_data=f"rate_trip_{trip[0]}")
+                               callback_data=RateTrip(trip_id=trip[0]).pack())
         ])
     
     keyboard_buttons.append([
@@ -2197,24 +1851,23 @@ async def cmd_rate(message: types.Message, state: FSMContext):
         parse_mode="HTML")
 
 
-@dp.message(F.text == "ℹ️ Ақпарат")
+@common_router.message(F.text == "ℹ️ Ақпарат")
 async def info_command(message: types.Message):
     await message.answer(
         "ℹ️ <b>Құрметті такси бот желісін қолданушылар назарына! 🚖</b>\n"
         "Біздің желіні пайдаланып отырғандарыңызға зор алғыс білдіреміз.\n"
         "Назар аударыңыз, төмендегі ақпаратпен мұқият танысып шығыңыздар:\n\n"
         "📍 Бағыттар мен тарифтер:\n"
-        "- Ақтау – Жаңаөзен – Ақтау → 1 орын – 2500 тг\n"
-        "- Ақтау – Шетпе – Ақтау → 1 орын – 2000 тг\n\n"
+        f"{TARIFF_LINES}\n\n"
         "⚠️ Маңызды:\n"
         "Жалған тапсырыс беру батырмасын негізсіз басу жағдайлары анықталған қолданушыларға 2 айға желіні пайдалану шектеуі қойылады.\n\n"
         "Сапарларыңыз сәтті, жолдарыңыз ашық болсын! 🚗💨\n\n"
-        f"❌ Қате орын алған жағдайда админге хабарласыңыз: {ADMIN_USER_LOGIN} немесе Whatsapp: {ADMIN_PHONE}",
+        f"❌ Қате орын алған жағдайда админге хабарласыңыз: {config.admin_user_login} немесе Whatsapp: {config.admin_phone}",
         reply_markup=main_menu_keyboard(),
         parse_mode="HTML")
 
 
-@dp.callback_query(F.data == "back_main")
+@common_router.callback("back_main")
 async def back_main(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.delete()
@@ -2254,12 +1907,16 @@ def admin_keyboard():
         [
             InlineKeyboardButton(text="📊 Статистика",
                                  callback_data="admin_stats")
+        ],
+        [
+            InlineKeyboardButton(text="🔧 Кезек басқару",
+                                 callback_data="admin_queue")
         ], [InlineKeyboardButton(text="📜 Логтар", callback_data="admin_logs")],
         [InlineKeyboardButton(text="🔙 Артқа", callback_data="back_main")]
     ])
 
 
-@dp.message(Command("admin"))
+@admin_router.message(Command("admin"))
 async def admin_panel(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("❌ Тыйым салынған")
@@ -2270,129 +1927,169 @@ async def admin_panel(message: types.Message):
                          parse_mode="HTML")
 
 
-@dp.callback_query(F.data == "admin_drivers")
+@admin_router.callback("admin_drivers")
 async def admin_drivers(callback: types.CallbackQuery):
     if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Тыйым салынған", show_alert=True)
         return
 
     async with get_db() as db:
-        async with db.execute(
-                "SELECT * FROM drivers ORDER BY direction, queue_position"
-        ) as cursor:
-            drivers = await cursor.fetchall()
+        drivers = await fetch_all_drivers(db)
 
     if not drivers:
         msg = "❌ Жүргізушілер жоқ"
     else:
         msg = "👥 <b>Жүргізушілер:</b>\n\n"
         for driver in drivers:
-            occupied, total, available = await get_driver_available_seats(
-                driver[0])
-            msg += f"№{driver[7]} - {driver[1]}\n"
-            msg += f"   🚗 {driver[4]} ({driver[3]})\n"
-            msg += f"   💺 {occupied}/{total} (бос: {available})\n"
-            msg += f"   📍 {driver[6]}\n"
-            msg += f"   {get_rating_stars(driver[13] if len(driver) > 13 else 0)}\n\n"
+            msg += f"№{driver.queue_position} - {driver.full_name}\n"
+            msg += f"   🚗 {driver.car_model} ({driver.car_number})\n"
+            msg += f"   💺 {driver.occupied_seats}/{driver.total_seats} (бос: {driver.available_seats})\n"
+            msg += f"   📍 {driver.direction}\n"
+            msg += f"   {get_rating_stars(driver.avg_rating)}\n\n"
 
     await safe_edit_message(callback, msg, reply_markup=admin_keyboard())
     await callback.answer()
 
 
-@dp.callback_query(F.data == "admin_clients")
+@admin_router.callback("admin_clients")
 async def admin_clients(callback: types.CallbackQuery):
     if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Тыйым салынған", show_alert=True)
         return
 
     async with get_db() as db:
-        async with db.execute(
-                "SELECT * FROM clients ORDER BY direction, queue_position"
-        ) as cursor:
-            clients = await cursor.fetchall()
+        orders = await fetch_active_orders(db)
 
-    if not clients:
+    if not orders:
         msg = "❌ Клиенттер жоқ"
     else:
         msg = "🧍‍♂️ <b>Кезектегі клиенттер:</b>\n\n"
-        for client in clients:
+        for order, client_name in orders:
             status_emoji = {
                 "waiting": "⏳",
                 "accepted": "✅",
                 "driver_arrived": "🚗"
             }
-            msg += f"№{client[4]} {status_emoji.get(client[10], '❓')} - {client[1]}\n"
-            msg += f"   📍 {client[3]}\n"
-            msg += f"   👥 {client[5]} адам.\n"
-            if client[11]:
-                msg += f"   🚗 Жүргізуші: ID {client[11]}\n"
+            msg += f"№{order.queue_position} {status_emoji.get(order.status, '❓')} - {client_name}\n"
+            msg += f"   📍 {order.direction}\n"
+            msg += f"   👥 {order.passengers_count} адам.\n"
+            if order.assigned_driver_id:
+                msg += f"   🚗 Жүргізуші: ID {order.assigned_driver_id}\n"
             msg += "\n"
 
     await safe_edit_message(callback, msg, reply_markup=admin_keyboard())
     await callback.answer()
 
 
-@dp.callback_query(F.data == "admin_stats")
-async def admin_stats(callback: types.CallbackQuery):
+@admin_router.callback("admin_back")
+async def admin_back(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Тыйым салынған", show_alert=True)
+        return
+
+    await safe_edit_message(callback, "🔐 <b>Админ панелі</b>",
+                            reply_markup=admin_keyboard())
+    await callback.answer()
+
+
+@admin_router.callback("admin_queue")
+async def admin_queue(callback: types.CallbackQuery):
+    """Active drivers of each direction, with buttons to reorder them"""
     if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Тыйым салынған", show_alert=True)
         return
 
     async with get_db() as db:
-        async with db.execute("SELECT COUNT(*) FROM drivers") as cursor:
-            total_drivers = (await cursor.fetchone())[0]
+        drivers = await fetch_all_drivers(db, active_only=True)
 
-        async with db.execute(
-                "SELECT COUNT(*) FROM clients WHERE status='waiting'"
-        ) as cursor:
-            waiting_clients = (await cursor.fetchone())[0]
+    if not drivers:
+        await safe_edit_message(callback, "❌ Белсенді жүргізушілер жоқ.",
+                                reply_markup=admin_keyboard())
+        await callback.answer()
+        return
 
-        async with db.execute(
-                "SELECT COUNT(*) FROM clients WHERE status='accepted'"
-        ) as cursor:
-            accepted_clients = (await cursor.fetchone())[0]
+    msg = "🔧 <b>Кезек басқару</b>\n"
+    buttons = []
+    direction = None
+    for driver in drivers:
+        if driver.direction != direction:
+            direction = driver.direction
+            msg += f"\n📍 <b>{direction}</b>\n\n"
+        msg += f"№{driver.queue_position} - {driver.full_name} ({driver.car_number})\n"
+        buttons.append([
+            InlineKeyboardButton(text=f"⬆️ №{driver.queue_position}",
+                                 callback_data=MoveDriver(driver_id=driver.user_id, up=True).pack()),
+            InlineKeyboardButton(text=f"⬇️ №{driver.queue_position}",
+                                 callback_data=MoveDriver(driver_id=driver.user_id, up=False).pack())
+        ])
+    buttons.append([InlineKeyboardButton(text="🔙 Артқа", callback_data="admin_back")])
 
-        async with db.execute(
-                "SELECT COUNT(*) FROM trips WHERE status='completed'"
-        ) as cursor:
-            completed_trips = (await cursor.fetchone())[0]
+    await safe_edit_message(callback, msg,
+                            reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    await callback.answer()
 
-        async with db.execute(
-                "SELECT COUNT(*) FROM trips WHERE cancelled_by IS NOT NULL"
-        ) as cursor:
-            cancelled_trips = (await cursor.fetchone())[0]
 
-        async with db.execute("SELECT AVG(rating) FROM ratings") as cursor:
-            avg_rating = (await cursor.fetchone())[0] or 0
+@admin_router.callback(MoveDriver)
+async def admin_move_driver(callback: types.CallbackQuery, callback_data: MoveDriver):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Тыйым салынған", show_alert=True)
+        return
+
+    async with get_db(write=True) as db:
+        moved = await move_driver_in_queue(db, callback_data.driver_id, callback_data.up)
+    if not moved:
+        await callback.answer("❌ Бұл бірінші орында!" if callback_data.up
+                              else "❌ Бұл соңғы орында!", show_alert=True)
+        return
 
-        async with db.execute(
-                "SELECT SUM(total_seats - COALESCE(occupied_seats, 0)) FROM drivers WHERE is_active=1"
-        ) as cursor:
-            total_available_seats = (await cursor.fetchone())[0] or 0
+    await save_log_action(callback.from_user.id, "queue_move",
+                          f"driver {callback_data.driver_id} {'up' if callback_data.up else 'down'}")
+    await admin_queue(callback)
 
-        async with db.execute("SELECT COUNT(*) FROM blacklist") as cursor:
-            blacklisted_users = (await cursor.fetchone())[0]
+
+@admin_router.callback("admin_stats")
+async def admin_stats(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("❌ Тыйым салынған", show_alert=True)
+        return
+
+    stats = await get_cached_stats()
 
     msg = "📊 <b>Статистика:</b>\n\n"
-    msg += f"👥 Жүргізушілер: {total_drivers}\n"
-    msg += f"💺 Бос орындар: {total_available_seats}\n\n"
-    msg += f"🧍‍♂️ Күтімдегі клиенттер: {waiting_clients}\n"
-    msg += f"✅ Қабылданған клиенттер: {accepted_clients}\n\n"
-    msg += f"✅ Аяқталған сапарлар: {completed_trips}\n"
-    msg += f"❌ Жойылған сапарлар: {cancelled_trips}\n"
-    msg += f"⭐ Орташа рейтинг: {avg_rating:.1f}\n"
-    msg += f"🚫 Бұғатталған пайдаланушылар: {blacklisted_users}\n"
+    msg += f"👥 Жүргізушілер: {stats.drivers}\n"
+    msg += f"💺 Бос орындар: {stats.free_seats}\n\n"
+    msg += f"🧍‍♂️ Күтімдегі клиенттер: {stats.waiting_clients}\n"
+    msg += f"✅ Қабылданған клиенттер: {stats.accepted_clients}\n\n"
+    msg += f"✅ Аяқталған сапарлар: {stats.completed_trips}\n"
+    msg += f"❌ Жойылған сапарлар: {stats.cancelled_trips}\n"
+    msg += f"⭐ Орташа рейтинг: {stats.avg_rating:.1f}\n"
+    msg += f"🚫 Бұғатталған пайдаланушылар: {stats.blacklisted}\n"
+
+    log_stats = action_log.stats()
+    msg += f"\n📝 Лог: кезекте {log_stats['queued']}, жоғалған {log_stats['dropped']}\n"
+
+    outbox_counts = await outbox.counts()
+    msg += (f"📬 Хабарламалар: күтуде {outbox_counts.get('pending', 0)}, "
+            f"жеткізілмеген {outbox_counts.get('dead', 0)}\n")
+
+    throttle = current_app().throttle
+    if throttle is not None:
+        msg += f"🚦 Тежелген басулар: {throttle.rejected}\n"
+    msg += f"🔁 Қайталанған басулар: {current_app().idempotency.repeats}\n"
 
     await safe_edit_message(callback, msg, reply_markup=admin_keyboard())
     await callback.answer()
 
 
-@dp.callback_query(F.data == "admin_logs")
+@admin_router.callback("admin_logs")
 async def admin_logs(callback: types.CallbackQuery):
     if not await is_admin(callback.from_user.id):
         await callback.answer("❌ Тыйым салынған", show_alert=True)
         return
 
+    # Show the latest actions, not only the ones already flushed
+    await action_log.flush()
+
     async with get_db() as db:
         async with db.execute('''SELECT user_id, action, details, created_at 
                      FROM actions_log 
@@ -2414,7 +2111,7 @@ async def admin_logs(callback: types.CallbackQuery):
     await safe_edit_message(callback, msg, reply_markup=admin_keyboard())
     await callback.answer()
     
-@dp.message(Command("listadmins"))
+@admin_router.message(Command("listadmins"))
 async def list_admins_command(message: types.Message):
     """Показать всех админов (только для админов)"""
     if not await is_admin(message.from_user.id):
@@ -2448,7 +2145,7 @@ async def list_admins_command(message: types.Message):
     
     await message.answer(msg, parse_mode="HTML")
 
-@dp.message(Command("addadmin"))
+@admin_router.message(Command("addadmin"))
 async def add_admin_command(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("❌ Тыйым салынған")
@@ -2472,7 +2169,7 @@ async def add_admin_command(message: types.Message):
         await message.answer(f"❌ Қате: {e}")
 
 
-@dp.message(Command("blacklist"))
+@admin_router.message(Command("blacklist"))
 async def show_blacklist(message: types.Message):
     """Show blacklisted users (admin only)"""
     if not await is_admin(message.from_user.id):
@@ -2507,7 +2204,56 @@ async def show_blacklist(message: types.Message):
     await message.answer(msg, parse_mode="HTML")
 
 
-@dp.message(Command("unban"))
+@admin_router.message(Command("recomputestats"))
+async def recompute_stats_command(message: types.Message):
+    """Recount dashboard counters from the source tables (admin only)"""
+    if not await is_admin(message.from_user.id):
+        await message.answer("❌ Тыйым салынған")
+        return
+
+    async with get_db(write=True) as db:
+        await recompute_stats(db)
+    current_app().stats_cache["stats"] = None
+
+    await save_log_action(message.from_user.id, "stats_recomputed")
+    await message.answer("✅ Статистика қайта есептелді")
+
+
+@admin_router.message(Command("searchlogs"))
+async def search_logs_command(message: types.Message):
+    """Search archived actions by user ID or action name (admin only)"""
+    if not await is_admin(message.from_user.id):
+        await message.answer("❌ Тыйым салынған")
+        return
+
+    parts = message.text.split()
+    if len(parts) != 2:
+        await message.answer(
+            "Осы команданы пайдаланыңыз: /searchlogs USER_ID немесе /searchlogs ACTION")
+        return
+
+    query = parts[1]
+    if query.isdigit():
+        records = await search_archives(config.log_archive_dir, user_id=int(query))
+    else:
+        records = await search_archives(config.log_archive_dir, action=query)
+
+    if not records:
+        await message.answer("❌ Мұрағаттан ештеңе табылмады")
+        return
+
+    msg = f"🗄 <b>Мұрағат: {query}</b>\n\n"
+    for record in records:
+        msg += f"🕒 {record['created_at']}\n"
+        msg += f"👤 <code>{record['user_id']}</code> - {record['action']}\n"
+        if record['details']:
+            msg += f"   {record['details']}\n"
+        msg += "\n"
+
+    await message.answer(msg, parse_mode="HTML")
+
+
+@admin_router.message(Command("unban"))
 async def unban_user(message: types.Message):
     """Unban a user (admin only)"""
     if not await is_admin(message.from_user.id):
@@ -2553,7 +2299,7 @@ async def unban_user(message: types.Message):
         await message.answer(f"❌ Қате: {e}")
 
 
-@dp.message(Command("resetcancel"))
+@admin_router.message(Command("resetcancel"))
 async def reset_cancellation(message: types.Message):
     """Reset cancellation count for a user (admin only)"""
     if not await is_admin(message.from_user.id):
@@ -2584,7 +2330,7 @@ async def reset_cancellation(message: types.Message):
     except Exception as e:
         await message.answer(f"❌ Қате: {e}")
         
-@dp.message(Command("removedriver"))
+@admin_router.message(Command("removedriver"))
 async def remove_driver_command(message: types.Message):
     """Remove a driver (admin only)"""
     if not await is_admin(message.from_user.id):
@@ -2608,35 +2354,36 @@ async def remove_driver_command(message: types.Message):
                                  (driver_id,)) as cursor:
                 driver = await cursor.fetchone()
 
-            if not driver:
-                await message.answer(f"❌ Жүргізуші табылмады: {driver_id}")
-                return
-
-            driver_name = driver[0]
-            car_model = driver[1]
-            car_number = driver[2]
-
             # Check for active trips
             async with db.execute(
-                    '''SELECT COUNT(*) FROM clients 
+                    '''SELECT COUNT(*) FROM orders 
                        WHERE assigned_driver_id=? AND status IN ('accepted', 'driver_arrived')''',
                 (driver_id,)) as cursor:
                 active_trips = (await cursor.fetchone())[0]
 
-            if active_trips > 0:
-                await message.answer(
-                    f"⚠️ <b>Жүргізушіні жою мүмкін емес!</b>\n\n"
-                    f"👤 {driver_name}\n"
-                    f"🚗 {car_model} ({car_number})\n\n"
-                    f"Себебі: {active_trips} белсенді сапар бар.\n"
-                    f"Алдымен жүргізуші сапарларды аяқтауы керек.",
-                    parse_mode="HTML")
-                return
+        if not driver:
+            await message.answer(f"❌ Жүргізуші табылмады: {driver_id}")
+            return
+
+        driver_name = driver[0]
+        car_model = driver[1]
+        car_number = driver[2]
+
+        if active_trips > 0:
+            await message.answer(
+                f"⚠️ <b>Жүргізушіні жою мүмкін емес!</b>\n\n"
+                f"👤 {driver_name}\n"
+                f"🚗 {car_model} ({car_number})\n\n"
+                f"Себебі: {active_trips} белсенді сапар бар.\n"
+                f"Алдымен жүргізуші сапарларды аяқтауы керек.",
+                parse_mode="HTML")
+            return
 
         # Now remove driver in write mode
         async with get_db(write=True) as db:
             # Remove driver
             await db.execute("DELETE FROM drivers WHERE user_id=?", (driver_id,))
+            on_commit(dispatch.remove_driver, driver_id)
 
         await save_log_action(message.from_user.id, "driver_removed",
                              f"Removed driver: {driver_id} ({driver_name})")
@@ -2672,7 +2419,7 @@ async def remove_driver_command(message: types.Message):
         await message.answer(f"❌ Қате орын алды: {str(e)}")
 
 
-@dp.message(Command("listdrivers"))
+@admin_router.message(Command("listdrivers"))
 async def list_drivers_command(message: types.Message):
     """List all drivers with their IDs (admin only)"""
     if not await is_admin(message.from_user.id):
@@ -2681,10 +2428,10 @@ async def list_drivers_command(message: types.Message):
 
     async with get_db() as db:
         async with db.execute(
-                '''SELECT user_id, full_name, car_model, car_number, direction, 
+                f'''SELECT user_id, full_name, car_model, car_number, direction, 
                           is_active, occupied_seats, total_seats
                    FROM drivers 
-                   ORDER BY direction, queue_position''') as cursor:
+                   ORDER BY direction, {queue_order("drivers")}''') as cursor:
             drivers = await cursor.fetchall()
 
     if not drivers:
@@ -2731,7 +2478,7 @@ async def list_drivers_command(message: types.Message):
     else:
         await message.answer(msg, parse_mode="HTML")
 
-@dp.message()
+@fallback_router.message()
 async def handle_unknown(message: types.Message):
     logger.warning(
         f"Unhandled message from {message.from_user.id}: {message.text}")
@@ -2744,17 +2491,137 @@ async def handle_unknown(message: types.Message):
 # ==================== START ====================
 
 
-async def main():
-    await init_db()
-    logger.info("🚀 Бот запущен")
+async def main(config: Config):
+    app = create_app(config)
+    with app.bound():
+        await app.open()
+        app.action_log.start()
+        app.outbox.start()
+        app.storage.start()
+        retention = asyncio.create_task(
+            run_log_retention(config.log_archive_dir, config.log_retention_days))
+        logger.info("🚀 Бот запущен")
 
-    await bot.delete_webhook(drop_pending_updates=True)
+        dp, bot = app.dp, app.bot
+        handler = None
+        try:
+            if config.webhook_url:
+                stop_on_signals(asyncio.current_task().cancel)
+                # Without a configured secret only this process knows it;
+                # set_webhook tells Telegram
+                secret = config.webhook_secret or secrets.token_urlsafe(32)
+                webhook, handler = build_webhook_app(dp, bot, config.webhook_path, secret,
+                                                     config.webhook_max_tasks)
+                await serve_webhook(webhook, bot, config.webhook_url, config.webhook_host,
+                                    config.webhook_port, config.webhook_path, secret,
+                                    min(100, config.webhook_max_tasks),
+                                    dp.resolve_used_update_types())
+            else:
+                stop_on_signals(lambda: asyncio.create_task(dp.stop_polling()))
+                await bot.delete_webhook(drop_pending_updates=True)
 
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+                # Signals and the bot session are handled by shutdown()
+                await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(),
+                                       handle_signals=False, close_bot_session=False)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            deadline = time.monotonic() + config.shutdown_timeout
+            if handler is not None:
+                # The server takes no more requests; updates it already
+                # answered with 200 are not sent again, so finish them first
+                left = await handler.join(remaining(deadline))
+                logger.info(f"Webhook stopped: {handler.received} updates, "
+                            f"{handler.refused} refused, {handler.failed} failed, "
+                            f"{left} unfinished")
+            retention.cancel()
+            await app.shutdown(deadline)
+            logger.info("Бот остановлен")
+
+
+# ==================== MULTI-PROCESS ====================
+
+
+async def worker_main(config: Config, index: int, workers: int, updates):
+    """Handle the updates the front sends to this worker"""
+    # The bot's rate limit is shared by all workers
+    app = create_app(config._replace(broadcast_rate=config.broadcast_rate / workers))
+    with app.bound():
+        await app.open()
+        app.action_log.start()
+        app.storage.start()
+        # Other workers change orders and drivers too
+        watcher = EpochWatcher("dispatch", app.dispatch.load, app.dispatch.refresh)
+        watcher.start()
+        logger.info(f"Worker {index}/{workers} started")
+
+        dp, bot = app.dp, app.bot
+        lanes = UserLanes()
+        try:
+            await consume_updates(updates, lambda update: dp.feed_raw_update(bot, update),
+                                  lanes)
+        finally:
+            # The front sent everything it had; finish it within the deadline
+            deadline = time.monotonic() + config.shutdown_timeout
+            await lanes.join(remaining(deadline))
+            await watcher.stop()
+            await app.shutdown(deadline)
+
+
+def run_worker(config: Config, index: int, workers: int, updates):
+    # Signals reach the whole process group; the front stops us in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup_logging(config.log_file)
+    asyncio.run(worker_main(config, index, workers, updates))
+
+
+async def run_front(config: Config):
+    """Receive updates and route each user's to one of the worker processes"""
+    app = create_app(config)
+    with app.bound():
+        await app.open()
+        front = ShardedFront(functools.partial(run_worker, config), config.workers)
+        front.start()
+
+        # Notifications are delivered from here only. Workers can't wake this
+        # outbox, so it polls more often
+        app.outbox.poll_interval = min(app.outbox.poll_interval, 0.25)
+        app.outbox.start()
+        app.action_log.start()
+        retention = asyncio.create_task(
+            run_log_retention(config.log_archive_dir, config.log_retention_days))
+        bot = app.bot
+        allowed_updates = app.dp.resolve_used_update_types()
+        logger.info(f"🚀 Бот запущен ({config.workers} workers)")
+
+        stop_on_signals(asyncio.current_task().cancel)
+        try:
+            if config.webhook_url:
+                path = config.webhook_path
+                secret = config.webhook_secret or secrets.token_urlsafe(32)
+                await serve_webhook(build_forwarding_app(front, path, secret),
+                                    bot, config.webhook_url, config.webhook_host,
+                                    config.webhook_port, path, secret,
+                                    allowed_updates=allowed_updates)
+            else:
+                await bot.delete_webhook(drop_pending_updates=True)
+                await poll_into(front, bot, allowed_updates)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # Workers drain within their own shutdown_timeout; their last
+            # notifications are then delivered from here
+            await front.stop(timeout=config.shutdown_timeout + 5)
+            retention.cancel()
+            await app.shutdown(time.monotonic() + config.shutdown_timeout)
+            logger.info("Бот остановлен")
 
 
 if __name__ == "__main__":
+    config = Config.from_env()
+    setup_logging(config.log_file)
     try:
-        asyncio.run(main())
+        asyncio.run(run_front(config) if config.workers > 1 else main(config))
     except KeyboardInterrupt:
-        logger.info("Бот остановлен пользователем")
\ No newline at end of file
+        logger.info("Бот остановлен пользователем")
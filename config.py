@@ -0,0 +1,74 @@
+import os
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+
+
+class Config(NamedTuple):
+    """Settings of one bot instance; ``Config.from_env()`` reads them from
+    the environment (and .env), tests and benchmarks can pass their own"""
+    bot_token: str = ""
+    database_file: str = "taxi_bot.db"
+    db_readers: int = 4
+    log_file: str = "taxi_bot.log"
+    log_archive_dir: str = "log_archive"
+    log_retention_days: int = 30
+    log_batch_size: int = 100
+    log_flush_interval: float = 2.0
+    stats_cache_ttl: float = 10.0
+    fsm_cache_size: int = 10000
+    fsm_flush_interval: float = 1.0
+
+    # Webhook mode when webhook_url is set (public https base URL), else polling
+    webhook_url: str = ""
+    webhook_path: str = "/webhook"
+    webhook_secret: str = ""
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_max_tasks: int = 50
+
+    # More than one: a front process receives updates and shards them by
+    # user over this many worker processes
+    workers: int = 1
+    broadcast_rate: float = 30.0
+
+    # Seconds a stopping process waits for running handlers and
+    # notifications; keep it below the platform's kill timeout (10 s for
+    # docker stop)
+    shutdown_timeout: float = 8.0
+
+    # Per-user limits on button taps (groups are set in bot.py)
+    throttle: bool = True
+
+    admin_phone: str = ""
+    admin_user_login: str = ""
+
+    @classmethod
+    def from_env(cls, **overrides) -> "Config":
+        load_dotenv()
+        env = os.getenv
+        config = cls(
+            bot_token=env("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE"),
+            database_file=env("DATABASE_FILE", "taxi_bot.db"),
+            db_readers=int(env("DB_READERS", "4")),
+            log_file=env("LOG_FILE", "taxi_bot.log"),
+            log_archive_dir=env("LOG_ARCHIVE_DIR", "log_archive"),
+            log_retention_days=int(env("LOG_RETENTION_DAYS", "30")),
+            log_batch_size=int(env("LOG_BATCH_SIZE", "100")),
+            log_flush_interval=float(env("LOG_FLUSH_INTERVAL", "2")),
+            stats_cache_ttl=float(env("STATS_CACHE_TTL", "10")),
+            fsm_cache_size=int(env("FSM_CACHE_SIZE", "10000")),
+            fsm_flush_interval=float(env("FSM_FLUSH_INTERVAL", "1")),
+            webhook_url=env("WEBHOOK_URL", ""),
+            webhook_path=env("WEBHOOK_PATH", "/webhook"),
+            webhook_secret=env("WEBHOOK_SECRET", ""),
+            webhook_host=env("WEBHOOK_HOST", "0.0.0.0"),
+            webhook_port=int(env("PORT", "8080")),
+            webhook_max_tasks=int(env("WEBHOOK_MAX_TASKS", "50")),
+            workers=int(env("WORKERS", "1")),
+            broadcast_rate=float(env("BROADCAST_RATE", "30")),
+            shutdown_timeout=float(env("SHUTDOWN_TIMEOUT", "8")),
+            throttle=env("THROTTLE", "1") != "0",
+            admin_phone=env("ADMIN_PHONE", ""),
+            admin_user_login=env("ADMIN_USER_LOGIN", ""))
+        return config._replace(**overrides)
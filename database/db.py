@@ -0,0 +1,257 @@
+import asyncio
+import logging
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+DB_TIMEOUT = 30.0
+READER_CONNECTIONS = 4
+STATEMENT_CACHE_SIZE = 256
+
+# Side effects queued by after_commit() for the current write transaction
+_side_effects: ContextVar = ContextVar("db_side_effects", default=None)
+# Plain callbacks queued by on_commit(), run under the writer lock
+_commit_hooks: ContextVar = ContextVar("db_commit_hooks", default=None)
+
+
+class WriteConflict(Exception):
+    """A conditional write lost a race; raise inside get_db(write=True) to roll back."""
+
+
+class ConnectionPool:
+    """Long-lived SQLite connections: several readers and one writer.
+
+    The database runs in WAL mode, so readers never block each other or the
+    writer. All writes go through the single writer connection, serialized
+    by an asyncio lock, and each write block is one ``BEGIN IMMEDIATE``
+    transaction.
+    """
+
+    def __init__(self, path: str, readers: int = READER_CONNECTIONS,
+                 timeout: float = DB_TIMEOUT,
+                 cached_statements: int = STATEMENT_CACHE_SIZE):
+        self.path = path
+        self.readers = max(1, readers)
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._reader_queue = None
+        self._all_readers = []
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        # ``hook(db)`` async context managers wrapped around the body of
+        # every write transaction: entered after BEGIN, left before COMMIT
+        self.write_hooks = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self, read_only: bool) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.path,
+                                     timeout=self.timeout,
+                                     isolation_level=None,
+                                     cached_statements=self.cached_statements)
+        pragmas = ["foreign_keys = ON",
+                   f"busy_timeout = {int(self.timeout * 1000)}",
+                   "synchronous = NORMAL"]
+        if read_only:
+            pragmas.append("query_only = ON")
+        for pragma in pragmas:
+            async with db.execute(f"PRAGMA {pragma}"):
+                pass
+        return db
+
+    async def open(self):
+        async with self._open_lock:
+            if self.is_open:
+                return
+
+            writer = await self._connect(read_only=False)
+            async with writer.execute("PRAGMA journal_mode = WAL"):
+                pass
+
+            queue = asyncio.Queue()
+            readers = []
+            for _ in range(self.readers):
+                reader = await self._connect(read_only=True)
+                readers.append(reader)
+                queue.put_nowait(reader)
+
+            self._writer = writer
+            self._all_readers = readers
+            self._reader_queue = queue
+            logger.info(f"DB pool opened: {self.path} "
+                        f"({self.readers} readers, 1 writer)")
+
+    async def close(self):
+        async with self._open_lock:
+            if not self.is_open:
+                return
+
+            async with self._write_lock:
+                # Wait for borrowed readers to come back before closing them
+                for _ in self._all_readers:
+                    await self._reader_queue.get()
+                for db in self._all_readers:
+                    await db.close()
+                await self._checkpoint()
+                await self._writer.close()
+
+            self._writer = None
+            self._all_readers = []
+            self._reader_queue = None
+            logger.info("DB pool closed")
+
+    async def _checkpoint(self):
+        """Move the WAL into the main file, so the next start has nothing to replay"""
+        try:
+            async with self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cursor:
+                busy, _, _ = await cursor.fetchone()
+            if busy:
+                # Another process is still reading or writing
+                logger.info("WAL checkpoint incomplete: database busy")
+        except Exception as e:
+            logger.warning(f"WAL checkpoint failed: {e}")
+
+    @asynccontextmanager
+    async def reader(self):
+        if not self.is_open:
+            await self.open()
+
+        db = await self._reader_queue.get()
+        try:
+            yield db
+        finally:
+            self._reader_queue.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self, hooks: list = None):
+        if not self.is_open:
+            await self.open()
+
+        async with self._write_lock:
+            db = self._writer
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                if self.write_hooks:
+                    async with AsyncExitStack() as stack:
+                        for hook in self.write_hooks:
+                            await stack.enter_async_context(hook(db))
+                        yield db
+                else:
+                    yield db
+            except BaseException:
+                await db.rollback()
+                raise
+            else:
+                await db.commit()
+                _run_commit_hooks(hooks or [])
+
+
+_pool = None
+# Pool of the app this code runs for (services/app.py); else the one above
+_current_pool: ContextVar = ContextVar("db_pool", default=None)
+
+
+async def init_pool(path: str, **kwargs) -> ConnectionPool:
+    """Create and open the process-wide pool."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+    _pool = ConnectionPool(path, **kwargs)
+    await _pool.open()
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+@contextmanager
+def use_pool(pool: ConnectionPool):
+    """get_db() uses ``pool`` inside the block and in tasks started there"""
+    token = _current_pool.set(pool)
+    try:
+        yield pool
+    finally:
+        _current_pool.reset(token)
+
+
+def get_pool() -> ConnectionPool:
+    pool = _current_pool.get() or _pool
+    if pool is None:
+        raise RuntimeError("Database pool is not initialized, call init_pool() first")
+    return pool
+
+
+def after_commit(func, *args, **kwargs):
+    """Queue ``await func(*args, **kwargs)`` until the current write commits.
+
+    Use it for Telegram calls and other network I/O inside
+    ``get_db(write=True)``: they run only if the transaction commits, and
+    only after the writer connection has been released. Nothing runs on
+    rollback.
+    """
+    pending = _side_effects.get()
+    if pending is None:
+        raise RuntimeError("after_commit() is only allowed inside get_db(write=True)")
+    pending.append((func, args, kwargs))
+
+
+def on_commit(func, *args, **kwargs):
+    """Queue a plain ``func(*args, **kwargs)`` call for when the current write commits.
+
+    Hooks run right after COMMIT, before the writer lock is released, so
+    in-memory state kept this way changes in the same order as the
+    database. They must be fast and must not do I/O; nothing runs on
+    rollback.
+    """
+    hooks = _commit_hooks.get()
+    if hooks is None:
+        raise RuntimeError("on_commit() is only allowed inside get_db(write=True)")
+    hooks.append((func, args, kwargs))
+
+
+def _run_commit_hooks(hooks: list):
+    for func, args, kwargs in hooks:
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Commit hook {getattr(func, '__qualname__', func)} failed: {e}")
+
+
+async def _run_side_effects(pending: list):
+    for func, args, kwargs in pending:
+        try:
+            await func(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"Side effect {getattr(func, '__qualname__', func)} failed: {e}")
+
+
+@asynccontextmanager
+async def get_db(write: bool = False):
+    """Async context manager for working with SQLite database"""
+    pool = get_pool()
+    if not write:
+        async with pool.reader() as db:
+            yield db
+        return
+
+    pending, hooks = [], []
+    token = _side_effects.set(pending)
+    hooks_token = _commit_hooks.set(hooks)
+    try:
+        async with pool.writer(hooks) as db:
+            yield db
+    finally:
+        _commit_hooks.reset(hooks_token)
+        _side_effects.reset(token)
+
+    await _run_side_effects(pending)
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder
+
+from database.db import get_db
+
+logger = logging.getLogger(__name__)
+
+FSM_CACHE_SIZE = 10000
+FSM_FLUSH_INTERVAL = 1.0
+FSM_BATCH_SIZE = 200
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage kept in the fsm_state table, with an LRU cache in front.
+
+    Reads come from the cache (the last ``cache_size`` keys) and touch the
+    database only on a miss. Writes only mark the key dirty; dirty rows are
+    written in one transaction every ``interval`` seconds or once
+    ``batch_size`` are waiting, so a crash loses at most the last
+    ``interval`` of form steps. Clearing a key (no state, no data) is the
+    exception: it is written straight away, so a finished flow never comes
+    back after a restart.
+
+    The cache is only correct while each user is served by one process.
+    Don't use it inside get_db(write=True): clearing a key waits for the
+    writer.
+    """
+
+    def __init__(self, key_builder: KeyBuilder = None,
+                 cache_size: int = FSM_CACHE_SIZE,
+                 interval: float = FSM_FLUSH_INTERVAL,
+                 batch_size: int = FSM_BATCH_SIZE):
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.cache_size = cache_size
+        self.interval = interval
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self._cache = OrderedDict()  # key -> (state, data), oldest first
+        self._dirty = {}             # key -> (state, data) not written yet
+        self._write_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "dirty": len(self._dirty),
+                "hits": self.hits, "misses": self.misses, "written": self.written}
+
+    # ----- cache -----
+
+    def _remember(self, key: str, entry: tuple):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        # An evicted dirty entry is still found in _dirty until written
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: str) -> tuple:
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        entry = self._dirty.get(key)
+        if entry is None:
+            self.misses += 1
+            async with get_db() as db:
+                async with db.execute("SELECT state, data FROM fsm_state WHERE key = ?",
+                                      (key, )) as cursor:
+                    row = await cursor.fetchone()
+            # Changed by another handler while we were reading
+            if key in self._cache:
+                return self._cache[key]
+            entry = (row[0], json.loads(row[1])) if row else (None, {})
+
+        self._remember(key, entry)
+        return entry
+
+    # ----- writing -----
+
+    async def _store(self, items: list):
+        upserts = [(key, state, json.dumps(data, ensure_ascii=False))
+                   for key, (state, data) in items if state is not None or data]
+        deletes = [(key, ) for key, (state, data) in items if state is None and not data]
+        async with get_db(write=True) as db:
+            await db.executemany(
+                '''INSERT INTO fsm_state (key, state, data) VALUES (?, ?, ?)
+                   ON CONFLICT (key) DO UPDATE
+                   SET state = excluded.state, data = excluded.data,
+                       updated_at = CURRENT_TIMESTAMP''', upserts)
+            # Finished flows leave no row behind
+            await db.executemany("DELETE FROM fsm_state WHERE key = ?", deletes)
+        self.written += len(items)
+
+    def _mark(self, key: str, entry: tuple):
+        self._remember(key, entry)
+        self._dirty[key] = entry
+        if len(self._dirty) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _set(self, key: str, entry: tuple):
+        if entry[0] is None and not entry[1]:
+            await self._write(key, entry)
+        else:
+            self._mark(key, entry)
+
+    async def _write(self, key: str, entry: tuple):
+        self._remember(key, entry)
+        self._dirty.pop(key, None)
+        async with self._write_lock:
+            # update_data() may have run while we waited; write the newest
+            entry = self._dirty.pop(key, entry)
+            try:
+                await self._store([(key, entry)])
+            except Exception:
+                self._dirty.setdefault(key, entry)
+                raise
+
+    async def flush(self) -> int:
+        """Write every dirty key; returns how many were written"""
+        async with self._write_lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            try:
+                await self._store(list(batch.items()))
+            except Exception as e:
+                # Put them back unless they changed again meanwhile
+                self._dirty = {**batch, **self._dirty}
+                logger.error(f"Failed to write {len(batch)} FSM records: {e}")
+                return 0
+            return len(batch)
+
+    # ----- BaseStorage -----
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        _, data = await self._load(key)
+        await self._set(key, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key):
+        return (await self._load(self.key_builder.build(key)))[0]
+
+    async def set_data(self, key, data: dict):
+        key = self.key_builder.build(key)
+        state, _ = await self._load(key)
+        await self._set(key, (state, dict(data)))
+
+    async def get_data(self, key) -> dict:
+        return dict((await self._load(self.key_builder.build(key)))[1])
+
+    async def update_data(self, key, data: dict) -> dict:
+        key = self.key_builder.build(key)
+        state, current = await self._load(key)
+        entry = (state, {**current, **data})
+        self._mark(key, entry)
+        return dict(entry[1])
+
+    # ----- background write-back -----
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the background task and write whatever is still dirty"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
@@ -0,0 +1,576 @@
+import logging
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# Versions 1-6 were applied by the old setup.py scripts and only ever
+# recorded in PRAGMA user_version. Databases created by the old init_db()
+# stayed at 0. Both are brought to the same shape by migration 7.
+
+BASE_TABLES = {
+    "drivers": '''CREATE TABLE IF NOT EXISTS drivers
+                 (user_id INTEGER PRIMARY KEY,
+                  full_name TEXT NOT NULL,
+                  phone TEXT NOT NULL,
+                  car_number TEXT NOT NULL,
+                  car_model TEXT NOT NULL,
+                  total_seats INTEGER NOT NULL,
+                  direction TEXT NOT NULL,
+                  queue_position INTEGER NOT NULL,
+                  is_active INTEGER DEFAULT 0,
+                  is_verified INTEGER DEFAULT 0,
+                  verification_code TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  avg_rating REAL DEFAULT 0,
+                  rating_count INTEGER DEFAULT 0,
+                  occupied_seats INTEGER DEFAULT 0,
+                  is_on_trip INTEGER DEFAULT 0,
+                  payment_methods TEXT DEFAULT '')''',
+    "clients": '''CREATE TABLE IF NOT EXISTS clients
+                 (user_id INTEGER PRIMARY KEY,
+                  full_name TEXT NOT NULL,
+                  phone TEXT NOT NULL,
+                  direction TEXT NOT NULL,
+                  queue_position INTEGER NOT NULL,
+                  passengers_count INTEGER DEFAULT 1,
+                  pickup_location TEXT DEFAULT '',
+                  dropoff_location TEXT DEFAULT '',
+                  is_verified INTEGER DEFAULT 0,
+                  verification_code TEXT,
+                  status TEXT DEFAULT 'waiting',
+                  assigned_driver_id INTEGER,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  avg_rating REAL DEFAULT 0,
+                  rating_count INTEGER DEFAULT 0,
+                  cancellation_count INTEGER DEFAULT 0,
+                  order_for TEXT DEFAULT 'self',
+                  order_number INTEGER DEFAULT 1,
+                  parent_user_id INTEGER,
+                  from_city TEXT DEFAULT '',
+                  to_city TEXT DEFAULT '')''',
+    "admins": '''CREATE TABLE IF NOT EXISTS admins
+                 (user_id INTEGER PRIMARY KEY,
+                  added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    "ratings": '''CREATE TABLE IF NOT EXISTS ratings
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  from_user_id INTEGER,
+                  to_user_id INTEGER,
+                  user_type TEXT,
+                  trip_id INTEGER,
+                  rating INTEGER CHECK(rating >= 1 AND rating <= 5),
+                  review TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    "trips": '''CREATE TABLE IF NOT EXISTS trips
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  driver_id INTEGER,
+                  client_id INTEGER,
+                  direction TEXT,
+                  passengers_count INTEGER,
+                  status TEXT,
+                  driver_arrived_at TIMESTAMP,
+                  trip_started_at TIMESTAMP,
+                  trip_completed_at TIMESTAMP,
+                  cancelled_by TEXT,
+                  cancelled_at TIMESTAMP,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    "actions_log": '''CREATE TABLE IF NOT EXISTS actions_log
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  action TEXT,
+                  details TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    "blacklist": '''CREATE TABLE IF NOT EXISTS blacklist
+                 (user_id INTEGER PRIMARY KEY,
+                  reason TEXT,
+                  cancellation_count INTEGER DEFAULT 0,
+                  banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+}
+
+# Columns that older databases may lack, with the declaration used to add them
+BASE_COLUMNS = {
+    "drivers": [
+        ("avg_rating", "REAL DEFAULT 0"),
+        ("rating_count", "INTEGER DEFAULT 0"),
+        ("occupied_seats", "INTEGER DEFAULT 0"),
+        ("is_on_trip", "INTEGER DEFAULT 0"),
+        ("payment_methods", "TEXT DEFAULT ''"),
+    ],
+    "clients": [
+        ("pickup_location", "TEXT DEFAULT ''"),
+        ("dropoff_location", "TEXT DEFAULT ''"),
+        ("avg_rating", "REAL DEFAULT 0"),
+        ("rating_count", "INTEGER DEFAULT 0"),
+        ("cancellation_count", "INTEGER DEFAULT 0"),
+        ("order_for", "TEXT DEFAULT 'self'"),
+        ("order_number", "INTEGER DEFAULT 1"),
+        ("parent_user_id", "INTEGER"),
+        ("from_city", "TEXT DEFAULT ''"),
+        ("to_city", "TEXT DEFAULT ''"),
+    ],
+}
+
+
+async def _columns(db, table: str) -> list:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return [col[1] for col in await cursor.fetchall()]
+
+
+async def _add_missing_columns(db, table: str, columns: list):
+    existing = await _columns(db, table)
+    for name, declaration in columns:
+        if name not in existing:
+            await db.execute(
+                f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
+
+
+async def _execute_all(db, statements: list):
+    for sql in statements:
+        await db.execute(sql)
+
+
+# ==================== MIGRATIONS ====================
+
+
+async def migration_7_baseline(db):
+    """Create missing tables and columns so every database has the same shape"""
+    for sql in BASE_TABLES.values():
+        await db.execute(sql)
+    for table, columns in BASE_COLUMNS.items():
+        await _add_missing_columns(db, table, columns)
+
+
+async def migration_8_hot_path_indexes(db):
+    """Composite indexes for the queue, trip, rating and log lookups"""
+    await _execute_all(db, [
+        "CREATE INDEX IF NOT EXISTS idx_clients_direction_status_queue "
+        "ON clients(direction, status, queue_position)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_parent_status "
+        "ON clients(parent_user_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_driver_status "
+        "ON clients(assigned_driver_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_drivers_direction_active "
+        "ON drivers(direction, is_active)",
+        "CREATE INDEX IF NOT EXISTS idx_trips_driver_status "
+        "ON trips(driver_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_trips_client_status "
+        "ON trips(client_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_ratings_from_trip "
+        "ON ratings(from_user_id, trip_id)",
+        "CREATE INDEX IF NOT EXISTS idx_ratings_to_type "
+        "ON ratings(to_user_id, user_type)",
+        "CREATE INDEX IF NOT EXISTS idx_actions_log_created "
+        "ON actions_log(created_at)",
+        # Single-column indexes now covered by the composite ones above
+        "DROP INDEX IF EXISTS idx_clients_direction",
+        "DROP INDEX IF EXISTS idx_drivers_direction",
+        "DROP INDEX IF EXISTS idx_trips_driver",
+        "DROP INDEX IF EXISTS idx_trips_client",
+    ])
+
+
+async def migration_9_queue_sequences(db):
+    """Per-direction counters that hand out queue positions"""
+    await _execute_all(db, [
+        '''CREATE TABLE IF NOT EXISTS queue_sequences
+           (queue TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            last_value INTEGER NOT NULL,
+            PRIMARY KEY (queue, direction)) WITHOUT ROWID''',
+        # Start above every existing (possibly fractional) position
+        '''INSERT OR IGNORE INTO queue_sequences (queue, direction, last_value)
+           SELECT 'clients', direction, CAST(MAX(queue_position) AS INTEGER) + 1
+           FROM clients GROUP BY direction''',
+        '''INSERT OR IGNORE INTO queue_sequences (queue, direction, last_value)
+           SELECT 'drivers', direction, CAST(MAX(queue_position) AS INTEGER) + 1
+           FROM drivers GROUP BY direction''',
+    ])
+
+
+async def migration_10_rating_sums(db):
+    """Running rating sum per driver, seeded from the ratings history"""
+    await _add_missing_columns(db, "drivers", [("rating_sum", "INTEGER DEFAULT 0")])
+    await _execute_all(db, [
+        "UPDATE drivers SET rating_sum = 0, rating_count = 0, avg_rating = 0",
+        '''UPDATE drivers
+           SET rating_sum = r.total, rating_count = r.cnt, avg_rating = r.average
+           FROM (SELECT to_user_id, SUM(rating) AS total, COUNT(*) AS cnt,
+                        AVG(rating) AS average
+                 FROM ratings WHERE user_type='driver'
+                 GROUP BY to_user_id) AS r
+           WHERE drivers.user_id = r.to_user_id''',
+    ])
+
+
+# Contribution of one row of each table to stats_counters. Written with IS
+# so a NULL column counts as 0 instead of turning the counter into NULL.
+_DRIVER_SEATS = ("(CASE WHEN {r}.is_active IS 1 "
+                 "THEN {r}.total_seats - COALESCE({r}.occupied_seats, 0) ELSE 0 END)")
+
+_STATS_TRIGGERS = {
+    "drivers": {
+        "insert": "drivers = drivers + 1, free_seats = free_seats + " + _DRIVER_SEATS.format(r="NEW"),
+        "delete": "drivers = drivers - 1, free_seats = free_seats - " + _DRIVER_SEATS.format(r="OLD"),
+        "update OF is_active, total_seats, occupied_seats":
+            "free_seats = free_seats - " + _DRIVER_SEATS.format(r="OLD")
+            + " + " + _DRIVER_SEATS.format(r="NEW"),
+    },
+    "clients": {
+        "insert": "waiting_clients = waiting_clients + (NEW.status IS 'waiting'), "
+                  "accepted_clients = accepted_clients + (NEW.status IS 'accepted')",
+        "delete": "waiting_clients = waiting_clients - (OLD.status IS 'waiting'), "
+                  "accepted_clients = accepted_clients - (OLD.status IS 'accepted')",
+        "update OF status":
+            "waiting_clients = waiting_clients - (OLD.status IS 'waiting') + (NEW.status IS 'waiting'), "
+            "accepted_clients = accepted_clients - (OLD.status IS 'accepted') + (NEW.status IS 'accepted')",
+    },
+    "trips": {
+        "insert": "completed_trips = completed_trips + (NEW.status IS 'completed'), "
+                  "cancelled_trips = cancelled_trips + (NEW.cancelled_by IS NOT NULL)",
+        "delete": "completed_trips = completed_trips - (OLD.status IS 'completed'), "
+                  "cancelled_trips = cancelled_trips - (OLD.cancelled_by IS NOT NULL)",
+        "update OF status, cancelled_by":
+            "completed_trips = completed_trips - (OLD.status IS 'completed') + (NEW.status IS 'completed'), "
+            "cancelled_trips = cancelled_trips - (OLD.cancelled_by IS NOT NULL) + (NEW.cancelled_by IS NOT NULL)",
+    },
+    "ratings": {
+        "insert": "rating_sum = rating_sum + COALESCE(NEW.rating, 0), "
+                  "rating_count = rating_count + (NEW.rating IS NOT NULL)",
+        "delete": "rating_sum = rating_sum - COALESCE(OLD.rating, 0), "
+                  "rating_count = rating_count - (OLD.rating IS NOT NULL)",
+        "update OF rating":
+            "rating_sum = rating_sum - COALESCE(OLD.rating, 0) + COALESCE(NEW.rating, 0), "
+            "rating_count = rating_count - (OLD.rating IS NOT NULL) + (NEW.rating IS NOT NULL)",
+    },
+    "blacklist": {
+        "insert": "blacklisted = blacklisted + 1",
+        "delete": "blacklisted = blacklisted - 1",
+    },
+}
+
+
+def _stats_recompute_sql(orders_table: str) -> str:
+    """Full recount of stats_counters from the source tables (seed and repair)"""
+    return f'''INSERT OR REPLACE INTO stats_counters
+    (id, drivers, free_seats, waiting_clients, accepted_clients,
+     completed_trips, cancelled_trips, rating_sum, rating_count, blacklisted)
+    SELECT 1,
+           (SELECT COUNT(*) FROM drivers),
+           (SELECT COALESCE(SUM(total_seats - COALESCE(occupied_seats, 0)), 0)
+              FROM drivers WHERE is_active=1),
+           (SELECT COUNT(*) FROM {orders_table} WHERE status='waiting'),
+           (SELECT COUNT(*) FROM {orders_table} WHERE status='accepted'),
+           (SELECT COUNT(*) FROM trips WHERE status='completed'),
+           (SELECT COUNT(*) FROM trips WHERE cancelled_by IS NOT NULL),
+           (SELECT COALESCE(SUM(rating), 0) FROM ratings),
+           (SELECT COUNT(rating) FROM ratings),
+           (SELECT COUNT(*) FROM blacklist)'''
+
+
+def _stats_trigger_names(table: str, events: dict) -> list:
+    return [f"trg_stats_{table}_{event.split()[0].lower()}" for event in events]
+
+
+async def _create_stats_triggers(db, table: str, events: dict):
+    for name, (event, assignments) in zip(_stats_trigger_names(table, events),
+                                          events.items()):
+        await db.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event.upper()} ON {table} "
+            f"BEGIN UPDATE stats_counters SET {assignments} WHERE id = 1; END")
+
+
+STATS_RECOMPUTE_SQL = _stats_recompute_sql("orders")
+
+
+async def migration_11_stats_counters(db):
+    """Single-row stats_counters table kept current by triggers"""
+    await db.execute('''CREATE TABLE IF NOT EXISTS stats_counters
+                        (id INTEGER PRIMARY KEY CHECK (id = 1),
+                         drivers INTEGER NOT NULL DEFAULT 0,
+                         free_seats INTEGER NOT NULL DEFAULT 0,
+                         waiting_clients INTEGER NOT NULL DEFAULT 0,
+                         accepted_clients INTEGER NOT NULL DEFAULT 0,
+                         completed_trips INTEGER NOT NULL DEFAULT 0,
+                         cancelled_trips INTEGER NOT NULL DEFAULT 0,
+                         rating_sum INTEGER NOT NULL DEFAULT 0,
+                         rating_count INTEGER NOT NULL DEFAULT 0,
+                         blacklisted INTEGER NOT NULL DEFAULT 0)''')
+
+    for table, events in _STATS_TRIGGERS.items():
+        await _create_stats_triggers(db, table, events)
+
+    await db.execute(_stats_recompute_sql("clients"))
+
+
+async def migration_12_orders_table(db):
+    """Move live orders out of clients into an orders table with integer ids"""
+    await db.execute('''CREATE TABLE IF NOT EXISTS orders
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         client_id INTEGER NOT NULL
+                             REFERENCES clients(user_id) ON DELETE CASCADE,
+                         direction TEXT NOT NULL,
+                         from_city TEXT DEFAULT '',
+                         to_city TEXT DEFAULT '',
+                         passengers_count INTEGER NOT NULL DEFAULT 1,
+                         queue_position REAL NOT NULL,
+                         status TEXT NOT NULL DEFAULT 'waiting',
+                         assigned_driver_id INTEGER,
+                         order_number INTEGER DEFAULT 1,
+                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    await _add_missing_columns(db, "trips", [("order_id", "INTEGER")])
+
+    # Every non-profile row of clients is an order: either a sub-order with a
+    # synthetic user_id and parent_user_id, or an old-style row where the
+    # profile itself was the order
+    async with db.execute(
+            '''SELECT user_id, full_name, phone, direction, from_city, to_city,
+                      COALESCE(passengers_count, 1), queue_position, status,
+                      assigned_driver_id, COALESCE(order_number, 1),
+                      parent_user_id, created_at
+               FROM clients WHERE status IS NOT 'registered'
+               ORDER BY created_at, user_id''') as cursor:
+        rows = await cursor.fetchall()
+
+    for (row_id, full_name, phone, direction, from_city, to_city, passengers,
+         queue_position, status, driver_id, order_number, parent_id,
+         created_at) in rows:
+        owner_id = parent_id or row_id
+        if parent_id:
+            await db.execute(
+                '''INSERT OR IGNORE INTO clients
+                   (user_id, full_name, phone, direction, queue_position,
+                    passengers_count, is_verified, status,
+                    pickup_location, dropoff_location)
+                   VALUES (?, ?, ?, '', 0, 0, 1, 'registered', '', '')''',
+                (owner_id, full_name, phone))
+
+        async with db.execute(
+                '''INSERT INTO orders
+                   (client_id, direction, from_city, to_city, passengers_count,
+                    queue_position, status, assigned_driver_id, order_number,
+                    created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))''',
+            (owner_id, direction or '', from_city or '', to_city or '',
+             passengers, queue_position or 0, status or 'waiting', driver_id,
+             order_number, created_at)) as cursor:
+            order_id = cursor.lastrowid
+
+        # Trips and ratings pointed at the order row; point them at the
+        # order and profile
+        if parent_id:
+            await db.execute(
+                "UPDATE trips SET order_id=?, client_id=? WHERE client_id=?",
+                (order_id, owner_id, row_id))
+            await db.execute(
+                '''UPDATE ratings SET from_user_id=?
+                   WHERE user_type IS NOT 'client' AND from_user_id=?''',
+                (owner_id, row_id))
+            await db.execute(
+                '''UPDATE ratings SET to_user_id=?
+                   WHERE user_type IS 'client' AND to_user_id=?''',
+                (owner_id, row_id))
+            await db.execute("DELETE FROM clients WHERE user_id=?", (row_id, ))
+        else:
+            await db.execute(
+                '''UPDATE trips SET order_id=?
+                   WHERE client_id=? AND order_id IS NULL
+                   AND status IN ('waiting', 'accepted', 'driver_arrived')''',
+                (order_id, owner_id))
+            await db.execute(
+                '''UPDATE clients SET status='registered', assigned_driver_id=NULL
+                   WHERE user_id=?''', (owner_id, ))
+
+    # Queue counters, stats triggers (same counters clients had) and
+    # indexes move to the new table
+    for name in _stats_trigger_names("clients", _STATS_TRIGGERS["clients"]):
+        await db.execute(f"DROP TRIGGER IF EXISTS {name}")
+    await _create_stats_triggers(db, "orders", _STATS_TRIGGERS["clients"])
+
+    await _execute_all(db, [
+        "UPDATE OR REPLACE queue_sequences SET queue='orders' WHERE queue='clients'",
+        "CREATE INDEX IF NOT EXISTS idx_orders_direction_status_queue "
+        "ON orders(direction, status, queue_position)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_client_status "
+        "ON orders(client_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_driver_status "
+        "ON orders(assigned_driver_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_trips_order ON trips(order_id)",
+        "DROP INDEX IF EXISTS idx_clients_direction_status_queue",
+        "DROP INDEX IF EXISTS idx_clients_parent_status",
+        "DROP INDEX IF EXISTS idx_clients_driver_status",
+        STATS_RECOMPUTE_SQL,
+    ])
+
+
+async def migration_13_notification_outbox(db):
+    """Outbox of notifications written together with the state change they report"""
+    await _execute_all(db, [
+        '''CREATE TABLE IF NOT EXISTS notification_outbox
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedup_key TEXT UNIQUE,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            parse_mode TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP)''',
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status_next "
+        "ON notification_outbox(status, next_attempt_at)",
+    ])
+
+
+async def migration_14_fsm_state(db):
+    """FSM state and data of each user, so unfinished forms survive a restart"""
+    await _execute_all(db, [
+        '''CREATE TABLE IF NOT EXISTS fsm_state
+           (key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    ])
+
+
+def _epoch_triggers(table: str, columns: str, epoch: str) -> list:
+    """Triggers bumping cache_epochs.version of ``epoch`` on any change to ``table``"""
+    bump = f"UPDATE cache_epochs SET version = version + 1 WHERE name = '{epoch}';"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{epoch}_insert AFTER INSERT ON {table} "
+        f"BEGIN {bump} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{epoch}_update "
+        f"AFTER UPDATE OF {columns} ON {table} BEGIN {bump} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{epoch}_delete AFTER DELETE ON {table} "
+        f"BEGIN {bump} END",
+    ]
+
+
+# (table, key column, columns services/dispatch.py keeps in memory)
+_DISPATCH_TABLES = (
+    ("orders", "id", "status, direction, queue_position, passengers_count, client_id"),
+    ("drivers", "user_id", "direction, total_seats, occupied_seats, is_active"),
+    ("clients", "user_id", "full_name"),
+)
+
+
+async def migration_15_cache_epochs(db):
+    """Change counters that tell other processes their in-memory copy is stale"""
+    await _execute_all(db, [
+        '''CREATE TABLE IF NOT EXISTS cache_epochs
+           (name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0)''',
+        "INSERT OR IGNORE INTO cache_epochs (name) VALUES ('dispatch')",
+        *(sql for table, _, columns in _DISPATCH_TABLES
+          for sql in _epoch_triggers(table, columns, "dispatch")),
+    ])
+
+
+async def migration_16_idempotency_keys(db):
+    """Answers of state-changing callbacks, so a repeated tap does the work once"""
+    await _execute_all(db, [
+        '''CREATE TABLE IF NOT EXISTS idempotency_keys
+           (key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            created_at REAL NOT NULL)''',
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created "
+        "ON idempotency_keys(created_at)",
+    ])
+
+
+# Changed rows kept per epoch; a process further behind reloads everything
+CACHE_CHANGES_KEPT = 5000
+
+
+def _change_triggers(table: str, key: str, columns: str, epoch: str) -> list:
+    """Triggers bumping ``epoch`` and logging the key of the changed row"""
+    def body(row: str) -> str:
+        version = f"(SELECT version FROM cache_epochs WHERE name = '{epoch}')"
+        return (f"BEGIN UPDATE cache_epochs SET version = version + 1 WHERE name = '{epoch}'; "
+                f"INSERT INTO cache_changes (name, version, tbl, row_id) "
+                f"VALUES ('{epoch}', {version}, '{table}', {row}.{key}); "
+                f"DELETE FROM cache_changes WHERE name = '{epoch}' "
+                f"AND version <= {version} - {CACHE_CHANGES_KEPT}; END")
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{epoch}_change_insert "
+        f"AFTER INSERT ON {table} {body('NEW')}",
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{epoch}_change_update "
+        f"AFTER UPDATE OF {columns} ON {table} {body('NEW')}",
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{epoch}_change_delete "
+        f"AFTER DELETE ON {table} {body('OLD')}",
+    ]
+
+
+async def migration_17_cache_changes(db):
+    """Which rows each epoch bump changed, so caches re-read only those"""
+    await _execute_all(db, [
+        '''CREATE TABLE IF NOT EXISTS cache_changes
+           (name TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            tbl TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            PRIMARY KEY (name, version)) WITHOUT ROWID''',
+        *(f"DROP TRIGGER IF EXISTS trg_{table}_dispatch_{event}"
+          for table, _, _ in _DISPATCH_TABLES for event in ("insert", "update", "delete")),
+        *(sql for table, key, columns in _DISPATCH_TABLES
+          for sql in _change_triggers(table, key, columns, "dispatch")),
+    ])
+
+
+# (version, migration) in ascending order; never renumber or edit applied ones
+MIGRATIONS = [
+    (7, migration_7_baseline),
+    (8, migration_8_hot_path_indexes),
+    (9, migration_9_queue_sequences),
+    (10, migration_10_rating_sums),
+    (11, migration_11_stats_counters),
+    (12, migration_12_orders_table),
+    (13, migration_13_notification_outbox),
+    (14, migration_14_fsm_state),
+    (15, migration_15_cache_epochs),
+    (16, migration_16_idempotency_keys),
+    (17, migration_17_cache_changes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def get_user_version(db) -> int:
+    async with db.execute("PRAGMA user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def migrate(db) -> tuple:
+    """Apply pending migrations on ``db`` inside the caller's transaction.
+
+    Returns (old_version, new_version).
+    """
+    old_version = await get_user_version(db)
+    version = old_version
+
+    for target, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        logger.info(f"Applying migration {target}: {migration.__doc__}")
+        await migration(db)
+        version = target
+
+    if version != old_version:
+        await db.execute(f"PRAGMA user_version = {version}")
+        logger.info(f"✅ Database migrated: v{old_version} → v{version}")
+
+    return (old_version, version)
+
+
+async def migrate_file(path: str) -> tuple:
+    """Migrate a database file in one transaction (for setup.py and scripts)"""
+    async with aiosqlite.connect(path, isolation_level=None) as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            result = await migrate(db)
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+    return result
@@ -0,0 +1,147 @@
+from typing import NamedTuple, Optional
+
+# Orders in these states are still in play (queue, seats, cancellation)
+ACTIVE_ORDER_STATUSES = ('waiting', 'accepted', 'driver_arrived')
+
+# Column names per table, read once from PRAGMA table_info by load_schema()
+SCHEMA = {}
+
+# Cached SELECT lists per record type, built from SCHEMA
+_select_lists = {}
+
+
+class DriverRow(NamedTuple):
+    user_id: int
+    full_name: str
+    phone: str
+    car_number: str
+    car_model: str
+    total_seats: int
+    direction: str
+    queue_position: int
+    is_active: int
+    avg_rating: float
+    rating_count: int
+    occupied_seats: int
+    is_on_trip: int
+
+    @property
+    def available_seats(self) -> int:
+        return self.total_seats - self.occupied_seats
+
+
+class ClientRow(NamedTuple):
+    """Client profile; orders live in the orders table"""
+    user_id: int
+    full_name: str
+    phone: str
+    avg_rating: float
+    rating_count: int
+    cancellation_count: int
+
+
+class OrderRow(NamedTuple):
+    id: int
+    client_id: int
+    direction: str
+    from_city: str
+    to_city: str
+    passengers_count: int
+    queue_position: float
+    status: str
+    assigned_driver_id: Optional[int]
+    order_number: int
+    created_at: Optional[str]
+
+
+class TripRow(NamedTuple):
+    id: int
+    driver_id: int
+    client_id: int
+    order_id: Optional[int]
+    direction: str
+    passengers_count: int
+    status: str
+    trip_completed_at: Optional[str]
+    cancelled_by: Optional[str]
+    created_at: Optional[str]
+
+
+class StatsRow(NamedTuple):
+    drivers: int
+    free_seats: int
+    waiting_clients: int
+    accepted_clients: int
+    completed_trips: int
+    cancelled_trips: int
+    rating_sum: int
+    rating_count: int
+    blacklisted: int
+
+    @property
+    def avg_rating(self) -> float:
+        return self.rating_sum / self.rating_count if self.rating_count else 0
+
+
+TABLES = {
+    DriverRow: "drivers",
+    ClientRow: "clients",
+    OrderRow: "orders",
+    TripRow: "trips",
+}
+
+# SQL used for a column that is NULL or missing in an older database
+COLUMN_DEFAULTS = {
+    "occupied_seats": "0",
+    "is_on_trip": "0",
+    "avg_rating": "0",
+    "rating_count": "0",
+    "cancellation_count": "0",
+    "order_number": "1",
+    "passengers_count": "1",
+    "from_city": "''",
+    "to_city": "''",
+}
+
+
+async def load_schema(db):
+    """Read the column list of every table once (call at startup and after migrations)"""
+    async with db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'") as cursor:
+        tables = [row[0] for row in await cursor.fetchall()]
+
+    schema = {}
+    for table in tables:
+        async with db.execute(f"PRAGMA table_info({table})") as cursor:
+            schema[table] = tuple(col[1] for col in await cursor.fetchall())
+
+    SCHEMA.clear()
+    SCHEMA.update(schema)
+    _select_lists.clear()
+
+
+def has_column(table: str, column: str) -> bool:
+    return column in SCHEMA.get(table, ())
+
+
+def select_list(record_cls, alias: str = "") -> str:
+    """SELECT list that returns rows in the field order of ``record_cls``"""
+    key = (record_cls, alias)
+    if key in _select_lists:
+        return _select_lists[key]
+
+    table = TABLES[record_cls]
+    prefix = f"{alias}." if alias else ""
+    parts = []
+    for field in record_cls._fields:
+        default = COLUMN_DEFAULTS.get(field, "NULL")
+        if has_column(table, field):
+            if default == "NULL":
+                parts.append(f"{prefix}{field}")
+            else:
+                parts.append(f"COALESCE({prefix}{field}, {default})")
+        else:
+            parts.append(default)
+
+    _select_lists[key] = ", ".join(parts)
+    return _select_lists[key]
@@ -0,0 +1,305 @@
+from database.migrations import STATS_RECOMPUTE_SQL
+from database.models import (SCHEMA, ACTIVE_ORDER_STATUSES, DriverRow,
+                             ClientRow, OrderRow, TripRow, StatsRow,
+                             load_schema, select_list)
+
+ACTIVE_SQL = ", ".join(f"'{status}'" for status in ACTIVE_ORDER_STATUSES)
+
+# queue_position is only a sort key: new entries go to the end, cancels leave
+# gaps and admin moves may use fractions, so a queue is never renumbered.
+# The 1, 2, 3… shown to users is computed on read.
+QUEUE_KEYS = {"drivers": "user_id", "orders": "id"}
+
+
+def queue_order(table: str, alias: str = "") -> str:
+    """ORDER BY list for a queue: sort key, then primary key to break ties"""
+    prefix = f"{alias}." if alias else ""
+    return f"{prefix}queue_position, {prefix}{QUEUE_KEYS[table]}"
+
+
+def queue_rank(table: str, alias: str = "") -> str:
+    """Displayed 1-based place within the direction"""
+    prefix = f"{alias}." if alias else ""
+    return (f"ROW_NUMBER() OVER (PARTITION BY {prefix}direction "
+            f"ORDER BY {queue_order(table, alias)})")
+
+
+async def waiting_place(db, direction: str, queue_position: int, order_id: int) -> int:
+    """Displayed place of a waiting order: waiting orders of its direction
+    ahead of it in queue order, plus itself"""
+    async with db.execute(
+            f'''SELECT COUNT(*) FROM orders
+                WHERE direction=? AND status='waiting'
+                AND ({queue_order("orders")}) <= (?, ?)''',
+        (direction, queue_position, order_id)) as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def next_queue_position(db, queue: str, direction: str) -> int:
+    """Next position at the end of ``queue`` ('orders' or 'drivers') for a direction.
+
+    One primary-key upsert on queue_sequences; call it inside
+    get_db(write=True) so concurrent orders never share a position.
+    """
+    async with db.execute(
+            '''INSERT INTO queue_sequences (queue, direction, last_value)
+               VALUES (?, ?, 1)
+               ON CONFLICT (queue, direction)
+               DO UPDATE SET last_value = last_value + 1
+               RETURNING last_value''', (queue, direction)) as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def _active_neighbours(db, driver_id: int, up: bool) -> list:
+    """Sort keys of the two nearest active drivers ahead of (or behind) a
+    driver in its direction; inactive ones are not shown, so not counted"""
+    compare, order = ("<", "DESC") if up else (">", "")
+    async with db.execute(
+            f'''SELECT d.queue_position FROM drivers d
+                JOIN drivers me ON me.user_id = ? AND d.direction = me.direction
+                WHERE d.is_active = 1
+                AND (d.queue_position, d.user_id) {compare} (me.queue_position, me.user_id)
+                ORDER BY d.queue_position {order}, d.user_id {order} LIMIT 2''',
+        (driver_id, )) as cursor:
+        return [row[0] for row in await cursor.fetchall()]
+
+
+async def move_driver_in_queue(db, driver_id: int, up: bool) -> bool:
+    """Move a driver one displayed place up or down; False if already first
+    (last). One UPDATE of the driver's sort key, however long the queue"""
+    async with db.execute("SELECT direction FROM drivers WHERE user_id=?",
+                          (driver_id, )) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return False
+    direction = row[0]
+
+    for _ in range(2):
+        neighbours = await _active_neighbours(db, driver_id, up)
+        if not neighbours:
+            return False
+        if len(neighbours) == 2:
+            position = (neighbours[0] + neighbours[1]) / 2
+        elif up:
+            position = neighbours[0] - 1
+        else:
+            # To the end, as a newly registered driver
+            position = await next_queue_position(db, "drivers", direction)
+        if position not in neighbours:
+            await db.execute("UPDATE drivers SET queue_position=? WHERE user_id=?",
+                             (position, driver_id))
+            return True
+        # Equal keys or no fraction left between them: renumber the
+        # direction 1, 2, 3… once and try again
+        await db.execute(
+            f'''UPDATE drivers SET queue_position = ranked.place
+                FROM (SELECT user_id, {queue_rank("drivers")} AS place
+                      FROM drivers WHERE direction=?) AS ranked
+                WHERE drivers.user_id = ranked.user_id''', (direction, ))
+    return False
+
+
+async def _ensure_schema(db):
+    if not SCHEMA:
+        await load_schema(db)
+
+
+async def fetch_driver(db, user_id: int):
+    """Returns DriverRow or None"""
+    await _ensure_schema(db)
+    async with db.execute(
+            f"SELECT {select_list(DriverRow)} FROM drivers WHERE user_id=?",
+        (user_id, )) as cursor:
+        row = await cursor.fetchone()
+    return DriverRow._make(row) if row else None
+
+
+async def fetch_client(db, user_id: int):
+    """Returns the client profile as ClientRow or None"""
+    await _ensure_schema(db)
+    async with db.execute(
+            f"SELECT {select_list(ClientRow)} FROM clients WHERE user_id=?",
+        (user_id, )) as cursor:
+        row = await cursor.fetchone()
+    return ClientRow._make(row) if row else None
+
+
+async def fetch_order(db, order_id: int):
+    """Returns OrderRow or None"""
+    await _ensure_schema(db)
+    async with db.execute(
+            f"SELECT {select_list(OrderRow)} FROM orders WHERE id=?",
+        (order_id, )) as cursor:
+        row = await cursor.fetchone()
+    return OrderRow._make(row) if row else None
+
+
+async def fetch_client_orders(db, client_id: int) -> list:
+    """Active orders of one client, oldest first"""
+    await _ensure_schema(db)
+    async with db.execute(
+            f"SELECT {select_list(OrderRow)} FROM orders "
+            f"WHERE client_id=? AND status IN ({ACTIVE_SQL}) ORDER BY id",
+        (client_id, )) as cursor:
+        return [OrderRow._make(row) for row in await cursor.fetchall()]
+
+
+async def count_client_orders(db, client_id: int) -> int:
+    async with db.execute(
+            f"SELECT COUNT(*) FROM orders WHERE client_id=? AND status IN ({ACTIVE_SQL})",
+        (client_id, )) as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def fetch_trip(db, trip_id: int):
+    """Returns TripRow or None"""
+    await _ensure_schema(db)
+    async with db.execute(
+            f"SELECT {select_list(TripRow)} FROM trips WHERE id=?",
+        (trip_id, )) as cursor:
+        row = await cursor.fetchone()
+    return TripRow._make(row) if row else None
+
+
+# Keep IN (...) lists under SQLite's bound-parameter limit
+_IN_CHUNK = 500
+
+
+def _chunks(ids) -> list:
+    ids = list(dict.fromkeys(ids))
+    return [ids[i:i + _IN_CHUNK] for i in range(0, len(ids), _IN_CHUNK)]
+
+
+async def get_drivers_by_ids(db, user_ids) -> dict:
+    """{user_id: DriverRow} for the given ids, in one query per 500 ids"""
+    await _ensure_schema(db)
+    drivers = {}
+    for chunk in _chunks(user_ids):
+        marks = ", ".join("?" * len(chunk))
+        async with db.execute(
+                f"SELECT {select_list(DriverRow)} FROM drivers "
+                f"WHERE user_id IN ({marks})", chunk) as cursor:
+            for row in await cursor.fetchall():
+                driver = DriverRow._make(row)
+                drivers[driver.user_id] = driver
+    return drivers
+
+
+async def get_client_names_by_ids(db, user_ids) -> dict:
+    """{user_id: full_name} for the given client ids"""
+    names = {}
+    for chunk in _chunks(user_ids):
+        marks = ", ".join("?" * len(chunk))
+        async with db.execute(
+                f"SELECT user_id, full_name FROM clients WHERE user_id IN ({marks})",
+                chunk) as cursor:
+            names.update(await cursor.fetchall())
+    return names
+
+
+async def fetch_all_drivers(db, active_only: bool = False) -> list:
+    """All (or all active) drivers with queue_position replaced by the displayed place"""
+    await _ensure_schema(db)
+    where = "WHERE is_active=1 " if active_only else ""
+    async with db.execute(
+            f"SELECT {select_list(DriverRow)}, {queue_rank('drivers')} FROM drivers "
+            f"{where}ORDER BY direction, {queue_order('drivers')}") as cursor:
+        return [DriverRow._make(row[:-1])._replace(queue_position=row[-1])
+                for row in await cursor.fetchall()]
+
+
+async def fetch_active_orders(db) -> list:
+    """[(OrderRow, client name)] for every active order, queue_position as displayed place"""
+    await _ensure_schema(db)
+    async with db.execute(
+            f"SELECT {select_list(OrderRow, 'o')}, {queue_rank('orders', 'o')}, "
+            "c.full_name FROM orders o JOIN clients c ON c.user_id = o.client_id "
+            f"WHERE o.status IN ({ACTIVE_SQL}) "
+            f"ORDER BY o.direction, {queue_order('orders', 'o')}") as cursor:
+        return [(OrderRow._make(row[:-2])._replace(queue_position=row[-2]), row[-1])
+                for row in await cursor.fetchall()]
+
+
+# ==================== CONDITIONAL WRITES ====================
+# Each returns True only if the row was still in the expected state, so two
+# drivers pressing "accept" at the same time can never both win.
+
+
+async def claim_order(db, order_id: int, driver_id: int) -> bool:
+    """waiting → accepted for one order"""
+    async with db.execute(
+            "UPDATE orders SET status='accepted', assigned_driver_id=? "
+            "WHERE id=? AND status='waiting'",
+        (driver_id, order_id)) as cursor:
+        return cursor.rowcount == 1
+
+
+async def close_order(db, order_id: int, status: str) -> tuple:
+    """Active order → ``status`` ('cancelled' or 'completed'), only once.
+
+    Returns (assigned_driver_id, passengers_count) as they were when the
+    order closed, or None if it was not active any more
+    """
+    async with db.execute(
+            f"UPDATE orders SET status=? WHERE id=? AND status IN ({ACTIVE_SQL}) "
+            "RETURNING assigned_driver_id, passengers_count",
+        (status, order_id)) as cursor:
+        return await cursor.fetchone()
+
+
+async def reserve_seats(db, driver_id: int, seats: int) -> bool:
+    """Take ``seats`` from the driver only if that many are still free"""
+    async with db.execute(
+            '''UPDATE drivers
+               SET occupied_seats = COALESCE(occupied_seats, 0) + ?
+               WHERE user_id=? AND total_seats - COALESCE(occupied_seats, 0) >= ?''',
+        (seats, driver_id, seats)) as cursor:
+        return cursor.rowcount == 1
+
+
+# ==================== RATINGS ====================
+# drivers.rating_sum / rating_count are kept up to date on every rating, so
+# avg_rating is always readable without touching the ratings table.
+
+
+async def add_driver_rating(db, driver_id: int, rating: int):
+    """Fold one new rating into the driver's aggregates (same transaction as the INSERT)"""
+    await db.execute(
+        '''UPDATE drivers
+           SET rating_sum = COALESCE(rating_sum, 0) + ?,
+               rating_count = COALESCE(rating_count, 0) + 1,
+               avg_rating = CAST(COALESCE(rating_sum, 0) + ? AS REAL)
+                            / (COALESCE(rating_count, 0) + 1)
+           WHERE user_id=?''', (rating, rating, driver_id))
+
+
+async def recompute_driver_ratings(db) -> int:
+    """Rebuild every driver's aggregates from the ratings table (repair only)"""
+    await db.execute(
+        "UPDATE drivers SET rating_sum = 0, rating_count = 0, avg_rating = 0")
+    async with db.execute(
+            '''UPDATE drivers
+               SET rating_sum = r.total, rating_count = r.cnt, avg_rating = r.average
+               FROM (SELECT to_user_id, SUM(rating) AS total, COUNT(*) AS cnt,
+                            AVG(rating) AS average
+                     FROM ratings WHERE user_type='driver'
+                     GROUP BY to_user_id) AS r
+               WHERE drivers.user_id = r.to_user_id''') as cursor:
+        return cursor.rowcount
+
+
+# ==================== STATS ====================
+# stats_counters is a single row maintained by triggers (migration 11).
+
+
+async def fetch_stats(db) -> StatsRow:
+    async with db.execute(
+            f"SELECT {', '.join(StatsRow._fields)} FROM stats_counters WHERE id = 1"
+    ) as cursor:
+        row = await cursor.fetchone()
+    return StatsRow._make(row) if row else StatsRow(*([0] * len(StatsRow._fields)))
+
+
+async def recompute_stats(db):
+    """Recount stats_counters from the source tables (reconciliation)"""
+    await db.execute(STATS_RECOMPUTE_SQL)
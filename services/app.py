@@ -0,0 +1,202 @@
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import cached_property
+
+from aiogram import Bot, Dispatcher
+
+from config import Config
+from database.db import ConnectionPool, get_db, use_pool
+from database.fsm_storage import SQLiteStorage
+from database.migrations import migrate
+from database.models import load_schema
+from services.dispatch import DispatchState
+from services.idempotency import IdempotencyKeys
+from services.lifecycle import UpdateTracker, remaining
+from services.notifications import Broadcaster
+from services.outbox import NotificationOutbox
+from services.throttling import CallbackThrottle
+from utils.callbacks import copy_router
+from utils.logging import ActionLogBuffer
+
+logger = logging.getLogger(__name__)
+
+_current_app: ContextVar = ContextVar("current_app", default=None)
+
+
+def current_app() -> "App":
+    app = _current_app.get()
+    if app is None:
+        raise RuntimeError("No app in this context, use create_app() and app.bound()")
+    return app
+
+
+class AppAttr:
+    """Module-level name for an attribute of the current app.
+
+    ``outbox = AppAttr("outbox")`` lets handlers keep calling
+    ``outbox.add(...)`` while every app has its own outbox.
+    """
+    __slots__ = ("_name", )
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(getattr(current_app(), self._name), attr)
+
+    def __repr__(self) -> str:
+        return f"<current app's {self._name}>"
+
+
+class AppDispatcher(Dispatcher):
+    """Dispatcher that handles every update bound to its app, middlewares
+    (FSM storage included) and background tasks they start alike"""
+
+    def __init__(self, app: "App", **kwargs):
+        super().__init__(**kwargs)
+        self.app = app
+
+    async def feed_update(self, bot: Bot, update, **kwargs):
+        with self.app.bound():
+            # Ahead of aiogram's middlewares: a shed tap costs no FSM lookup
+            throttle = self.app.throttle
+            if throttle is not None and await throttle.shed(bot, update):
+                return None
+            return await super().feed_update(bot, update, **kwargs)
+
+
+class App:
+    """One bot instance: its config, database pool, dispatcher and services.
+
+    Everything is built on first use; constructing an App opens no file,
+    connection or session. Code running for the app finds it through
+    current_app(): inside ``bound()``, in tasks started there and while
+    ``dp`` handles an update. Several apps can live in one process, each with
+    its own database.
+    """
+
+    def __init__(self, config: Config, routers=(), callback_index=None,
+                 throttle_groups=(), throttle_default=None):
+        self.config = config
+        self.routers = routers
+        self.callback_index = callback_index
+        self.throttle_groups = throttle_groups
+        self.throttle_default = throttle_default
+        self.pool = ConnectionPool(config.database_file, readers=config.db_readers)
+        # Dashboard counters, see get_cached_stats()
+        self.stats_cache = {"expires": 0.0, "stats": None}
+
+    def _built(self, name: str) -> bool:
+        return name in self.__dict__
+
+    @contextmanager
+    def bound(self):
+        """Make this the current app (and its pool get_db()'s) in the block"""
+        token = _current_app.set(self)
+        try:
+            with use_pool(self.pool):
+                yield self
+        finally:
+            _current_app.reset(token)
+
+    # ----- built on first use -----
+
+    @cached_property
+    def bot(self) -> Bot:
+        return Bot(token=self.config.bot_token)
+
+    @cached_property
+    def storage(self) -> SQLiteStorage:
+        # FSM state lives in the database so unfinished forms survive a restart
+        return SQLiteStorage(cache_size=self.config.fsm_cache_size,
+                             interval=self.config.fsm_flush_interval)
+
+    @cached_property
+    def update_tracker(self) -> UpdateTracker:
+        # Knows which updates are running, so shutdown can wait for them
+        return UpdateTracker()
+
+    @cached_property
+    def throttle(self) -> CallbackThrottle:
+        """Per-user limit on button taps; None when switched off"""
+        if not self.config.throttle:
+            return None
+        return CallbackThrottle(self.throttle_groups, self.throttle_default,
+                                index=self.callback_index)
+
+    @cached_property
+    def dp(self) -> Dispatcher:
+        dp = AppDispatcher(self, storage=self.storage)
+        dp.update.outer_middleware(self.update_tracker)
+        if self.callback_index is not None:
+            dp.callback_query.outer_middleware(self.callback_index)
+        dp.include_routers(*map(copy_router, self.routers))
+        return dp
+
+    @cached_property
+    def action_log(self) -> ActionLogBuffer:
+        # actions_log rows are buffered and written in batches
+        return ActionLogBuffer(batch_size=self.config.log_batch_size,
+                               interval=self.config.log_flush_interval)
+
+    @cached_property
+    def dispatch(self) -> DispatchState:
+        # Waiting orders and driver seats per direction, loaded by open()
+        return DispatchState()
+
+    @cached_property
+    def idempotency(self) -> IdempotencyKeys:
+        # Answers of state-changing callbacks, for repeated taps
+        return IdempotencyKeys()
+
+    @cached_property
+    def broadcaster(self) -> Broadcaster:
+        # Fan-out of one event to many chats, within Telegram's rate limits
+        return Broadcaster(self.bot, global_rate=self.config.broadcast_rate)
+
+    @cached_property
+    def outbox(self) -> NotificationOutbox:
+        # Notifications that must survive a restart, written with the state change
+        return NotificationOutbox(self.broadcaster)
+
+    # ----- lifecycle -----
+
+    async def open(self):
+        """Open the pool, bring the schema up to date and load the dispatch
+        state; call inside ``bound()``"""
+        await self.pool.open()
+        async with get_db(write=True) as db:
+            old_version, new_version = await migrate(db)
+            await load_schema(db)
+
+        async with get_db() as db:
+            await self.dispatch.load(db)
+
+        if old_version == new_version:
+            logger.info(f"ℹ️ Database schema is up to date (v{new_version}).")
+
+    async def shutdown(self, deadline: float):
+        """Let running handlers finish, then write out everything buffered.
+
+        Order matters: handlers still enqueue notifications, log records and
+        FSM data, so they are drained first; the pool goes last, after a WAL
+        checkpoint. ``deadline`` (time.monotonic()) bounds the waiting parts.
+        Parts never built are skipped.
+        """
+        if self._built("update_tracker"):
+            self.update_tracker.close()
+            left = await self.update_tracker.join(remaining(deadline))
+            if left:
+                logger.warning(f"Shutdown: {left} updates still running, abandoned")
+        if self._built("broadcaster"):
+            await self.broadcaster.join(timeout=remaining(deadline))
+        if self._built("outbox"):
+            await self.outbox.stop(drain_timeout=remaining(deadline))
+        if self._built("storage"):
+            await self.storage.close()
+        if self._built("action_log"):
+            await self.action_log.stop()
+        await self.pool.close()
+        if self._built("bot"):
+            await self.bot.session.close()
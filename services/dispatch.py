@@ -0,0 +1,210 @@
+import bisect
+import logging
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class WaitingOrder(NamedTuple):
+    """A waiting order; tuples sort in queue order (queue_position, id)"""
+    queue_position: float
+    id: int
+    direction: str
+    client_id: int
+    client_name: str
+    passengers_count: int
+
+
+class DriverSeats(NamedTuple):
+    user_id: int
+    direction: str
+    total_seats: int
+    occupied_seats: int
+    is_active: int
+
+    @property
+    def available_seats(self) -> int:
+        return self.total_seats - self.occupied_seats
+
+
+_ORDERS_SQL = '''SELECT o.queue_position, o.id, o.direction, o.client_id,
+                        COALESCE(c.full_name, ''), COALESCE(o.passengers_count, 1)
+                 FROM orders o JOIN clients c ON c.user_id = o.client_id
+                 WHERE o.status = 'waiting' '''
+
+# A NULL is_active is inactive, as for the is_active=1 queries and triggers
+_DRIVERS_SQL = '''SELECT user_id, COALESCE(direction, ''), COALESCE(total_seats, 0),
+                         COALESCE(occupied_seats, 0), COALESCE(is_active, 0)
+                  FROM drivers'''
+
+
+def _marks(ids) -> str:
+    return ", ".join("?" * len(ids))
+
+
+class DispatchState:
+    """In-memory copy of each direction's waiting orders and drivers' seats.
+
+    Filled once by ``load()``, then kept current by the handlers that change
+    those rows: they queue the matching update with ``on_commit()`` so it is
+    applied only after, and in the same order as, the database commit.
+    Reads are plain dict/list lookups with no database round trip.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._queues = {}    # direction -> [WaitingOrder] in queue order
+        self._orders = {}    # order id -> WaitingOrder
+        self._drivers = {}   # user_id -> DriverSeats
+        self._by_direction = {}  # direction -> {user_id}
+
+    # ----- loading and checking -----
+
+    async def load(self, db):
+        """Replace everything with the current contents of the database"""
+        orders, drivers = await self._read(db)
+        self._queues, self._orders = {}, {}
+        self._drivers, self._by_direction = {}, {}
+        for order in sorted(orders):
+            self._orders[order.id] = order
+            self._queues.setdefault(order.direction, []).append(order)
+        for driver in drivers:
+            self.put_driver(driver)
+        # Reloads (see services/sharding.py) can be frequent
+        log = logger.debug if self.loaded else logger.info
+        self.loaded = True
+        log(f"Dispatch state loaded: {len(self._orders)} waiting orders, "
+            f"{len(self._drivers)} drivers")
+
+    async def refresh(self, db, changes: dict):
+        """Re-read only the rows in ``changes`` ({table: {row id}}, see
+        EpochWatcher); a changed client re-reads its waiting orders"""
+        order_ids = set(changes.get("orders", ()))
+        client_ids = set(changes.get("clients", ()))
+        driver_ids = set(changes.get("drivers", ()))
+
+        if order_ids or client_ids:
+            async with db.execute(
+                    f'''{_ORDERS_SQL} AND (o.id IN ({_marks(order_ids)})
+                       OR o.client_id IN ({_marks(client_ids)}))''',
+                (*order_ids, *client_ids)) as cursor:
+                orders = [WaitingOrder._make(row) for row in await cursor.fetchall()]
+            for order in list(self._orders.values()):
+                if order.id in order_ids or order.client_id in client_ids:
+                    self.remove_order(order.id)
+            for order in orders:
+                self.add_order(order)
+
+        if driver_ids:
+            async with db.execute(
+                    f"{_DRIVERS_SQL} WHERE user_id IN ({_marks(driver_ids)})",
+                    tuple(driver_ids)) as cursor:
+                drivers = [DriverSeats._make(row) for row in await cursor.fetchall()]
+            for user_id in driver_ids:
+                self.remove_driver(user_id)
+            for driver in drivers:
+                self.put_driver(driver)
+
+    @staticmethod
+    async def _read(db) -> tuple:
+        async with db.execute(_ORDERS_SQL) as cursor:
+            orders = [WaitingOrder._make(row) for row in await cursor.fetchall()]
+        async with db.execute(_DRIVERS_SQL) as cursor:
+            drivers = [DriverSeats._make(row) for row in await cursor.fetchall()]
+        return orders, drivers
+
+    async def check(self, db) -> list:
+        """Differences between memory and the database; empty when they agree"""
+        orders, drivers = await self._read(db)
+        problems = []
+
+        expected = {}
+        for order in sorted(orders):
+            expected.setdefault(order.direction, []).append(order)
+        for direction in sorted(set(expected) | set(self._queues)):
+            if expected.get(direction, []) != self._queues.get(direction, []):
+                problems.append(f"orders [{direction}]: memory "
+                                f"{[o.id for o in self._queues.get(direction, [])]} "
+                                f"!= db {[o.id for o in expected.get(direction, [])]}")
+
+        db_drivers = {driver.user_id: driver for driver in drivers}
+        for user_id in sorted(set(db_drivers) | set(self._drivers)):
+            if db_drivers.get(user_id) != self._drivers.get(user_id):
+                problems.append(f"driver {user_id}: memory {self._drivers.get(user_id)} "
+                                f"!= db {db_drivers.get(user_id)}")
+        return problems
+
+    # ----- write-through updates (call via on_commit) -----
+
+    def add_order(self, order: WaitingOrder):
+        self.remove_order(order.id)
+        self._orders[order.id] = order
+        bisect.insort(self._queues.setdefault(order.direction, []), order)
+
+    def remove_order(self, order_id: int):
+        """Order left the waiting state (accepted, cancelled, ...)"""
+        order = self._orders.pop(order_id, None)
+        if order is None:
+            return
+        queue = self._queues[order.direction]
+        del queue[bisect.bisect_left(queue, order)]
+
+    def rename_client(self, client_id: int, full_name: str):
+        for order in list(self._orders.values()):
+            if order.client_id == client_id:
+                self.add_order(order._replace(client_name=full_name))
+
+    def put_driver(self, driver: DriverSeats):
+        self.remove_driver(driver.user_id)
+        self._drivers[driver.user_id] = driver
+        self._by_direction.setdefault(driver.direction, set()).add(driver.user_id)
+
+    def remove_driver(self, user_id: int):
+        driver = self._drivers.pop(user_id, None)
+        if driver is not None:
+            self._by_direction[driver.direction].discard(user_id)
+
+    def move_driver(self, user_id: int, direction: str):
+        driver = self._drivers.get(user_id)
+        if driver is not None:
+            self.put_driver(driver._replace(direction=direction))
+
+    def add_occupied(self, user_id: int, seats: int):
+        """Seats taken (positive) or freed (negative), as in the SQL update"""
+        driver = self._drivers.get(user_id)
+        if driver is not None:
+            self._drivers[user_id] = driver._replace(
+                occupied_seats=driver.occupied_seats + seats)
+
+    # ----- reads -----
+
+    def waiting_orders(self, direction: str) -> list:
+        """Waiting orders of a direction in queue order (a copy)"""
+        return list(self._queues.get(direction, ()))
+
+    def waiting_count(self, direction: str) -> int:
+        return len(self._queues.get(direction, ()))
+
+    def driver(self, user_id: int):
+        """DriverSeats or None"""
+        return self._drivers.get(user_id)
+
+    def _active_drivers(self, direction: str):
+        for user_id in self._by_direction.get(direction, ()):
+            driver = self._drivers[user_id]
+            if driver.is_active == 1:
+                yield driver
+
+    def capacity(self, direction: str) -> tuple:
+        """(active drivers, their free seats in total) for a direction"""
+        drivers = list(self._active_drivers(direction))
+        return len(drivers), sum(driver.available_seats for driver in drivers)
+
+    def drivers_with_seats(self, direction: str, seats: int) -> list:
+        """Active drivers of a direction with at least ``seats`` free"""
+        return [driver for driver in self._active_drivers(direction)
+                if driver.available_seats >= seats]
+
+    def suitable_drivers(self, direction: str, seats: int) -> int:
+        """How many drivers_with_seats() there are"""
+        return len(self.drivers_with_seats(direction, seats))
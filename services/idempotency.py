@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import NamedTuple
+
+from database.db import get_db, on_commit
+
+logger = logging.getLogger(__name__)
+
+# Results kept in memory; older ones are still found in the table
+MAX_IDEMPOTENCY_KEYS = 10000
+# How long a tap is remembered at all
+IDEMPOTENCY_TTL = 3600.0
+PRUNE_INTERVAL = 600.0
+
+
+class _Claim(NamedTuple):
+    keys: "IdempotencyKeys"
+    key: str
+
+
+# The claim of the handler running in this context, for record_result()
+_current_claim: ContextVar = ContextVar("idempotency_claim", default=None)
+
+
+def callback_key(callback, nonce: str = "") -> str:
+    """One tap target: the user, the message with the button and its data.
+
+    ``nonce`` names the flow the tap belongs to (an order draft, a trip), so
+    the same button on the same message starts a new key in the next flow.
+    """
+    message_id = callback.message.message_id if callback.message else 0
+    key = f"{callback.from_user.id}:{message_id}:{callback.data}"
+    return f"{key}:{nonce}" if nonce else key
+
+
+async def record_result(db, result: str):
+    """Remember ``result`` as the answer to repeats of the claimed callback.
+
+    Call it inside the handler's get_db(write=True) block, next to the
+    work: the key commits with the work or not at all. Does nothing
+    outside ``IdempotencyKeys.claim()``.
+    """
+    claim = _current_claim.get()
+    if claim is None:
+        return
+    now = time.time()
+    await db.execute(
+        '''INSERT INTO idempotency_keys (key, result, created_at) VALUES (?, ?, ?)
+           ON CONFLICT (key) DO UPDATE
+           SET result = excluded.result, created_at = excluded.created_at''',
+        (claim.key, result, now))
+    await claim.keys._prune(db, now)
+    on_commit(claim.keys.remember, claim.key, result, now)
+
+
+class IdempotencyKeys:
+    """Results of state-changing callbacks, so a repeated tap gets the
+    first tap's answer instead of doing the work again.
+
+    ``claim(key)`` waits while the same key is being handled, then looks
+    the result up in memory (the last ``max_entries`` keys) and in the
+    idempotency_keys table. Results are written by record_result() in the
+    handler's own transaction and live ``ttl`` seconds. A handler that
+    records nothing (an error, a lost race) leaves the key free, so the
+    next tap runs it again.
+    """
+
+    def __init__(self, max_entries: int = MAX_IDEMPOTENCY_KEYS,
+                 ttl: float = IDEMPOTENCY_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.repeats = 0
+        self._results = OrderedDict()  # key -> (result, created_at), oldest first
+        self._running = {}             # key -> [asyncio.Lock, holders]
+        self._pruned_at = 0.0
+
+    def stats(self) -> dict:
+        return {"cached": len(self._results), "running": len(self._running),
+                "repeats": self.repeats}
+
+    def remember(self, key: str, result: str, created_at: float):
+        self._results[key] = (result, created_at)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    async def lookup(self, key: str) -> str:
+        """The recorded result of ``key``, or None"""
+        cutoff = time.time() - self.ttl
+        entry = self._results.get(key)
+        if entry is not None:
+            if entry[1] >= cutoff:
+                return entry[0]
+            del self._results[key]
+
+        async with get_db() as db:
+            async with db.execute(
+                    "SELECT result, created_at FROM idempotency_keys "
+                    "WHERE key = ? AND created_at >= ?", (key, cutoff)) as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        self.remember(key, *row)
+        return row[0]
+
+    async def _prune(self, db, now: float):
+        if now - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        await db.execute("DELETE FROM idempotency_keys WHERE created_at < ?",
+                         (now - self.ttl, ))
+
+    @asynccontextmanager
+    async def claim(self, key: str):
+        """Yields the earlier result of ``key`` (a repeat), or None: then
+        the block does the work and may call record_result()"""
+        slot = self._running.setdefault(key, [asyncio.Lock(), 0])
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                result = await self.lookup(key)
+                if result is not None:
+                    self.repeats += 1
+                    yield result
+                    return
+                token = _current_claim.set(_Claim(self, key))
+                try:
+                    yield None
+                finally:
+                    _current_claim.reset(token)
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._running[key]
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import signal
+import time
+
+from aiogram.dispatcher.event.bases import UNHANDLED
+
+logger = logging.getLogger(__name__)
+
+
+def remaining(deadline: float) -> float:
+    """Seconds left until ``deadline`` (a time.monotonic() value), never negative"""
+    return max(0.0, deadline - time.monotonic())
+
+
+class UpdateTracker:
+    """Outer update middleware that knows which updates are being handled.
+
+    After ``close()`` new updates are dropped, and ``join()`` waits for the
+    ones already running, so shutdown never cuts a handler in half unless
+    it outlives the deadline.
+    """
+
+    def __init__(self):
+        self.closed = False
+        self.dropped = 0
+        self._tasks = set()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def __call__(self, handler, event, data: dict):
+        if self.closed:
+            self.dropped += 1
+            return UNHANDLED
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self._tasks.discard(task)
+
+    def close(self):
+        self.closed = True
+
+    async def join(self, timeout: float = None) -> int:
+        """Wait for running updates; returns how many are still running"""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+        return self.in_flight
+
+
+def stop_on_signals(stop):
+    """Call ``stop()`` on the first SIGTERM or SIGINT; later ones are ignored
+    so they can't interrupt the shutdown itself"""
+    loop = asyncio.get_running_loop()
+    stopping = False
+
+    def handle(sig: signal.Signals):
+        nonlocal stopping
+        if stopping:
+            logger.warning(f"{sig.name} received, already shutting down")
+            return
+        stopping = True
+        logger.info(f"{sig.name} received, shutting down")
+        stop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, handle, sig)
+        except NotImplementedError:
+            # Windows: only Ctrl+C, as KeyboardInterrupt
+            pass
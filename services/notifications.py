@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+from typing import NamedTuple
+
+from aiogram.exceptions import (TelegramNetworkError, TelegramRetryAfter,
+                                TelegramServerError)
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall and about one per
+# second to the same chat (short bursts are tolerated)
+GLOBAL_RATE = 30.0
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+MAX_CONCURRENCY = 20
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 1.0
+# Idle per-chat buckets are forgotten once there are more than this many
+MAX_CHAT_BUCKETS = 10000
+
+
+class OutgoingMessage(NamedTuple):
+    chat_id: int
+    text: str
+    reply_markup: object = None
+    parse_mode: str = None
+
+
+class SendResult(NamedTuple):
+    chat_id: int
+    ok: bool
+    attempts: int
+    error: str = None
+    permanent: bool = False  # failed in a way retrying won't fix
+
+
+class TokenBucket:
+    """``rate`` tokens per second, at most ``capacity`` saved up.
+
+    ``reserve()`` always takes a token and may go into debt; the returned
+    delay is how long the caller must wait for it. Waiters are therefore
+    served in the order they asked, without a lock.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        self._refill(time.monotonic())
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def take(self) -> bool:
+        """Take a token if one is there; never goes into debt"""
+        self._refill(time.monotonic())
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    @property
+    def idle(self) -> bool:
+        """Full again, so forgetting it changes nothing"""
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Broadcaster:
+    """Sends many messages concurrently within Telegram's rate limits.
+
+    ``broadcast()`` waits for every message and returns one SendResult per
+    recipient. ``submit()`` runs the same thing as a background task so the
+    handler can answer the user straight away.
+    """
+
+    def __init__(self, bot, global_rate: float = GLOBAL_RATE,
+                 chat_rate: float = CHAT_RATE, chat_burst: int = CHAT_BURST,
+                 max_concurrency: int = MAX_CONCURRENCY,
+                 max_attempts: int = MAX_ATTEMPTS):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.failed = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+
+    @property
+    def pending(self) -> int:
+        """Background broadcasts still running"""
+        return len(self._tasks)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._chats = {key: value for key, value in self._chats.items()
+                               if not value.idle}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate,
+                                                        self.chat_burst)
+        return bucket
+
+    async def send(self, message: OutgoingMessage) -> SendResult:
+        """Send one message, retrying on RetryAfter and transient errors"""
+        error, permanent = None, False
+        for attempt in range(1, self.max_attempts + 1):
+            await self._chat_bucket(message.chat_id).acquire()
+            await self._global.acquire()
+            try:
+                async with self._semaphore:
+                    await self.bot.send_message(message.chat_id, message.text,
+                                                reply_markup=message.reply_markup,
+                                                parse_mode=message.parse_mode)
+                self.sent += 1
+                return SendResult(message.chat_id, True, attempt)
+            except TelegramRetryAfter as e:
+                error, delay = str(e), e.retry_after
+            except (TelegramNetworkError, TelegramServerError) as e:
+                error, delay = str(e), RETRY_DELAY * attempt
+            except Exception as e:
+                # Blocked bot, deleted chat, bad request: retrying won't help
+                error, permanent = str(e), True
+                break
+            if attempt < self.max_attempts:
+                await asyncio.sleep(delay)
+
+        self.failed += 1
+        return SendResult(message.chat_id, False, attempt, error, permanent)
+
+    async def broadcast(self, messages: list, label: str = "broadcast") -> list:
+        """Send all messages concurrently; returns their SendResults in order"""
+        results = await asyncio.gather(*(self.send(message) for message in messages))
+        failed = [result for result in results if not result.ok]
+        if failed:
+            logger.warning(f"{label}: {len(results) - len(failed)} sent, "
+                           f"{len(failed)} failed "
+                           f"({', '.join(f'{r.chat_id}: {r.error}' for r in failed)})")
+        return results
+
+    def submit(self, messages: list, label: str = "broadcast") -> asyncio.Task:
+        """Start ``broadcast()`` in the background and return its task"""
+        task = asyncio.create_task(self.broadcast(list(messages), label))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def join(self, timeout: float = None):
+        """Wait for background broadcasts (e.g. before shutdown)"""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
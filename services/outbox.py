@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+
+from aiogram.types import InlineKeyboardMarkup
+
+from database.db import get_db, on_commit
+from services.notifications import OutgoingMessage
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_INTERVAL = 1.0
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BASE_DELAY = 2.0
+OUTBOX_MAX_DELAY = 600.0
+OUTBOX_KEEP_DAYS = 7
+PRUNE_INTERVAL = 3600
+
+
+class NotificationOutbox:
+    """Notifications stored in notification_outbox and sent by a worker.
+
+    ``enqueue()`` inserts the message in the caller's write transaction, so
+    it exists exactly when the state change it reports was committed, and
+    survives a restart until it is delivered. Rows go pending → sent; a
+    failed send is retried with exponential backoff and ends as 'dead'
+    after ``max_attempts`` or on an error retrying can't fix. Delivery is
+    at least once: a crash between sending and marking the row sent sends
+    it again on the next start.
+    """
+
+    def __init__(self, broadcaster, batch_size: int = OUTBOX_BATCH_SIZE,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 base_delay: float = OUTBOX_BASE_DELAY,
+                 max_delay: float = OUTBOX_MAX_DELAY,
+                 keep_days: int = OUTBOX_KEEP_DAYS):
+        self.broadcaster = broadcaster
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.keep_days = keep_days
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self._pruned_at = 0.0
+
+    async def enqueue(self, db, message: OutgoingMessage, dedup_key: str = None):
+        """Store ``message`` in the current write transaction.
+
+        A second message with the same ``dedup_key`` is ignored, so a
+        handler that runs twice for one event notifies only once.
+        """
+        markup = message.reply_markup
+        await db.execute(
+            '''INSERT INTO notification_outbox
+               (dedup_key, chat_id, text, reply_markup, parse_mode)
+               VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT (dedup_key) DO NOTHING''',
+            (dedup_key, message.chat_id, message.text,
+             markup.model_dump_json(exclude_none=True) if markup else None,
+             message.parse_mode))
+        on_commit(self._wakeup.set)
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+
+    async def deliver_due(self) -> int:
+        """Send one batch of due messages; returns how many were tried"""
+        async with get_db() as db:
+            async with db.execute(
+                    '''SELECT id, chat_id, text, reply_markup, parse_mode, attempts
+                       FROM notification_outbox
+                       WHERE status = 'pending' AND next_attempt_at <= ?
+                       ORDER BY id LIMIT ?''', (time.time(), self.batch_size)) as cursor:
+                rows = await cursor.fetchall()
+
+        if not rows:
+            return 0
+
+        results = await asyncio.gather(*(
+            self.broadcaster.send(OutgoingMessage(
+                chat_id, text,
+                InlineKeyboardMarkup.model_validate_json(markup) if markup else None,
+                parse_mode))
+            for _, chat_id, text, markup, parse_mode, _ in rows))
+
+        now = time.time()
+        sent, failed = [], []
+        for (row_id, chat_id, _, _, _, attempts), result in zip(rows, results):
+            if result.ok:
+                sent.append((row_id, ))
+                continue
+            attempts += 1
+            dead = result.permanent or attempts >= self.max_attempts
+            failed.append(('dead' if dead else 'pending', attempts,
+                           now + self._backoff(attempts), result.error, row_id))
+            if dead:
+                logger.error(f"Notification {row_id} to {chat_id} is dead after "
+                             f"{attempts} attempts: {result.error}")
+
+        async with get_db(write=True) as db:
+            await db.executemany(
+                '''UPDATE notification_outbox
+                   SET status = 'sent', attempts = attempts + 1,
+                       sent_at = CURRENT_TIMESTAMP
+                   WHERE id = ?''', sent)
+            await db.executemany(
+                '''UPDATE notification_outbox
+                   SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+                   WHERE id = ?''', failed)
+        return len(rows)
+
+    async def prune(self) -> int:
+        """Delete sent rows older than ``keep_days``; dead ones are kept"""
+        async with get_db(write=True) as db:
+            async with db.execute(
+                    '''DELETE FROM notification_outbox
+                       WHERE status = 'sent' AND sent_at < datetime('now', ?)''',
+                (f"-{self.keep_days} days", )) as cursor:
+                return cursor.rowcount
+
+    async def counts(self) -> dict:
+        """{status: rows}"""
+        async with get_db() as db:
+            async with db.execute(
+                    "SELECT status, COUNT(*) FROM notification_outbox GROUP BY status"
+            ) as cursor:
+                return dict(await cursor.fetchall())
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                delivered = await self.deliver_due()
+                if time.monotonic() - self._pruned_at >= PRUNE_INTERVAL:
+                    self._pruned_at = time.monotonic()
+                    await self.prune()
+            except Exception as e:
+                logger.error(f"Outbox delivery failed: {e}")
+                delivered = 0
+
+            # A full batch means there is probably more waiting
+            if delivered < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 0):
+        """Finish the batch in progress, then keep sending due rows for up to
+        ``drain_timeout`` seconds; the rest waits for the next start"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+        deadline = time.monotonic() + drain_timeout
+        while time.monotonic() < deadline:
+            try:
+                delivered = await asyncio.wait_for(self.deliver_due(),
+                                                   deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                # Rows of the cut batch are still pending and go out next start
+                break
+            except Exception as e:
+                logger.error(f"Outbox drain failed: {e}")
+                break
+            if delivered < self.batch_size:
+                break
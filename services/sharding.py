@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import time
+from contextlib import asynccontextmanager
+
+from database.db import get_db, get_pool, on_commit
+
+logger = logging.getLogger(__name__)
+
+WORKER_MAX_TASKS = 50
+# Updates a worker takes off its queue before the running ones finish
+WORKER_MAX_PENDING = 500
+EPOCH_POLL_INTERVAL = 0.5
+# More changed rows than this are re-read with a full reload
+EPOCH_REFRESH_MAX_ROWS = 500
+WORKER_STOP_TIMEOUT = 30.0
+
+
+def user_id_of(update: dict) -> int:
+    """Telegram user an update comes from (else its chat, else 0)"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return 0
+
+
+def shard_of(user_id: int, workers: int) -> int:
+    return user_id % workers
+
+
+class UserLanes:
+    """Runs jobs of one user in order and jobs of different users concurrently.
+
+    Each user's job waits for the previous one of the same user; at most
+    ``max_tasks`` jobs run handlers at once.
+    """
+
+    def __init__(self, max_tasks: int = WORKER_MAX_TASKS):
+        self._slots = asyncio.Semaphore(max_tasks)
+        self._tails = {}   # user_id -> last task of that user
+        self._tasks = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, user_id: int, job) -> asyncio.Task:
+        """Schedule ``await job()`` after the user's previous job"""
+        task = asyncio.create_task(self._run(self._tails.get(user_id), job))
+        self._tails[user_id] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(
+            lambda done: self._tails.get(user_id) is done and self._tails.pop(user_id))
+        return task
+
+    async def _run(self, previous, job):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self._slots:
+            try:
+                await job()
+            except Exception as e:
+                logger.error(f"Update failed: {e}", exc_info=True)
+
+    async def join(self, timeout: float = None):
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+
+class EpochWatcher:
+    """Refreshes an in-memory cache after other processes changed its tables.
+
+    Triggers (migrations 15 and 17) bump cache_epochs.version of ``name``
+    whenever the mirrored rows change, in any process, and log each changed
+    row in cache_changes. The watcher polls that row and calls
+    ``refresh(db, {table: {row id}})`` with the rows changed since the
+    version it saw, or ``reload(db)`` when there is no ``refresh``, nothing
+    seen yet, too many changes or the log no longer reaches back. Both run
+    in one read transaction on a reader connection, so the version and the
+    rows come from the same snapshot and writers are not held up.
+
+    This process's own writes keep the cache current through their
+    on_commit() hooks. The watcher reads the version at the start and the
+    end of each of them (no other process commits in between); if the
+    cache had the start, the end counts as seen and causes no reload.
+    """
+
+    def __init__(self, name: str, reload, refresh=None,
+                 interval: float = EPOCH_POLL_INTERVAL,
+                 max_rows: int = EPOCH_REFRESH_MAX_ROWS):
+        self.name = name
+        self.reload = reload
+        self.refresh = refresh
+        self.interval = interval
+        self.max_rows = max_rows
+        self.seen = None
+        self.reloads = 0
+        self.refreshes = 0
+        self.skipped = 0
+        self._task = None
+        self._pool = None
+
+    async def _version(self, db) -> int:
+        async with db.execute("SELECT version FROM cache_epochs WHERE name = ?",
+                              (self.name, )) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+    async def _changes(self, db, version: int):
+        """{table: {row id}} changed after ``seen`` up to ``version``, or
+        None if a full reload is needed"""
+        if self.refresh is None or self.seen is None:
+            return None
+        if not 0 < version - self.seen <= self.max_rows:
+            return None
+        async with db.execute(
+                '''SELECT tbl, row_id FROM cache_changes
+                   WHERE name = ? AND version > ? AND version <= ?''',
+            (self.name, self.seen, version)) as cursor:
+            rows = await cursor.fetchall()
+        # Every bump logs one row; fewer means the log was pruned past ``seen``
+        if len(rows) != version - self.seen:
+            return None
+        changes = {}
+        for table, row_id in rows:
+            changes.setdefault(table, set()).add(row_id)
+        return changes
+
+    async def check(self) -> bool:
+        """Refresh if the epoch moved; returns True if it did"""
+        async with get_db() as db:
+            await db.execute("BEGIN")
+            try:
+                version = await self._version(db)
+                if version == self.seen:
+                    return False
+                changes = await self._changes(db, version)
+                if changes is None:
+                    await self.reload(db)
+                else:
+                    await self.refresh(db, changes)
+            finally:
+                await db.rollback()
+        self.seen = version
+        if changes is None:
+            self.reloads += 1
+        else:
+            self.refreshes += 1
+        return True
+
+    @asynccontextmanager
+    async def _watch_write(self, db):
+        """Pool write hook: the version before and after this process's write"""
+        before = await self._version(db)
+        yield
+        on_commit(self._own_commit, before, await self._version(db))
+
+    def _own_commit(self, before: int, after: int):
+        # The cache had ``before``; our on_commit hooks brought it to ``after``
+        if self.seen == before and before != after:
+            self.seen = after
+            self.skipped += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Reloading {self.name} failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._pool = get_pool()
+            self._pool.write_hooks.append(self._watch_write)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._pool.write_hooks.remove(self._watch_write)
+            self._pool = None
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+async def consume_updates(queue, handle, lanes: UserLanes,
+                          max_pending: int = WORKER_MAX_PENDING):
+    """Feed raw updates from a multiprocessing queue to ``handle(update)``
+    until the front sends None; the caller then waits for ``lanes``"""
+    loop = asyncio.get_running_loop()
+    room = asyncio.Semaphore(max_pending)
+    while True:
+        await room.acquire()
+        payload = await loop.run_in_executor(None, queue.get)
+        if payload is None:
+            room.release()
+            break
+        update = json.loads(payload)
+        task = lanes.submit(user_id_of(update), lambda update=update: handle(update))
+        task.add_done_callback(lambda _: room.release())
+
+
+class ShardedFront:
+    """Starts N worker processes and hands each update to its user's worker.
+
+    All updates of one user go to the same worker, which keeps them in
+    order and keeps that user's FSM cache in one place.
+    ``target(index, workers, queue)`` runs in each child; the queue yields
+    raw update JSON and finally None.
+    """
+
+    def __init__(self, target, workers: int):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue() for _ in range(workers)]
+        self.processes = [
+            context.Process(target=target, args=(index, workers, queue),
+                            name=f"worker-{index}")
+            for index, queue in enumerate(self.queues)]
+        self.routed = [0] * workers
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info(f"Started {len(self.processes)} workers")
+
+    def route(self, payload: str, update: dict):
+        index = shard_of(user_id_of(update), len(self.queues))
+        self.routed[index] += 1
+        self.queues[index].put(payload)
+
+    async def stop(self, timeout: float = WORKER_STOP_TIMEOUT):
+        """Let workers finish their queues, then wait for them to exit"""
+        for queue in self.queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join,
+                                       max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in time, terminating")
+                process.terminate()
+        logger.info(f"Workers stopped; updates per worker: {self.routed}")
+
+
+async def poll_into(front: ShardedFront, bot, allowed_updates: list = None,
+                    timeout: int = 30):
+    """Long-poll getUpdates and route every update to its worker"""
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=timeout,
+                                                allowed_updates=allowed_updates)
+            except Exception as e:
+                logger.error(f"getUpdates failed: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                data = update.model_dump(mode="json", exclude_unset=True)
+                front.route(json.dumps(data, ensure_ascii=False), data)
+                offset = update.update_id + 1
+    finally:
+        # Confirm what was routed, or Telegram sends it again on the next start
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0, limit=1,
+                                      allowed_updates=allowed_updates)
+            except Exception as e:
+                logger.warning(f"Could not confirm updates up to {offset}: {e}")
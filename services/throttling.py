@@ -0,0 +1,92 @@
+import logging
+from collections import OrderedDict
+from typing import NamedTuple
+
+from aiogram.exceptions import TelegramAPIError
+
+from services.notifications import TokenBucket
+from utils.callbacks import callback_keys
+
+logger = logging.getLogger(__name__)
+
+# Buckets kept at most; the least recently used user is forgotten first
+MAX_THROTTLE_BUCKETS = 10000
+THROTTLE_NOTICE = "⏳ Сәл күте тұрыңыз..."
+
+
+class ThrottleGroup(NamedTuple):
+    """Callbacks that share one bucket per user"""
+    name: str
+    rate: float         # taps per second, sustained
+    burst: int          # taps in a row before the rate applies
+    keys: tuple = ()    # callback_data strings or CallbackData classes
+
+
+class CallbackThrottle:
+    """Per-user token buckets for button taps, one per user and group.
+
+    ``shed()`` runs before aiogram's own middlewares: a tap without a token
+    is answered with a short notice and goes no further, so it costs no
+    FSM lookup, no database query and no handler. Callbacks of no group
+    fall into ``default`` (None: not throttled). At most ``max_buckets``
+    buckets are kept; a forgotten one only means a fresh burst for that user.
+    """
+
+    def __init__(self, groups=(), default: ThrottleGroup = None,
+                 index=None, max_buckets: int = MAX_THROTTLE_BUCKETS,
+                 notice: str = THROTTLE_NOTICE):
+        self.default = default
+        self.index = index
+        self.max_buckets = max_buckets
+        self.notice = notice
+        self._groups = {}  # callback key -> ThrottleGroup
+        for group in groups:
+            for key in group.keys:
+                for each in callback_keys(key):
+                    self._groups[each] = group
+        self._buckets = OrderedDict()  # (user_id, group name) -> TokenBucket
+        self.passed = 0
+        self.rejected = 0
+        self.rejected_by_group = {}
+
+    def stats(self) -> dict:
+        return {"buckets": len(self._buckets), "passed": self.passed,
+                "rejected": self.rejected, "by_group": dict(self.rejected_by_group)}
+
+    def group_of(self, data: str) -> ThrottleGroup:
+        if self.index is not None:
+            key, _ = self.index.resolve(data)
+        else:
+            key = data.partition(":")[0]
+        return self._groups.get(key, self.default)
+
+    def allow(self, user_id: int, group: ThrottleGroup) -> bool:
+        """Take a token from the user's bucket of ``group``, if there is one"""
+        key = (user_id, group.name)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(group.rate, group.burst)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        if bucket.take():
+            self.passed += 1
+            return True
+        self.rejected += 1
+        self.rejected_by_group[group.name] = self.rejected_by_group.get(group.name, 0) + 1
+        return False
+
+    async def shed(self, bot, update) -> bool:
+        """True if ``update`` is a tap over the limit; it is answered here"""
+        callback = update.callback_query
+        if callback is None:
+            return False
+        group = self.group_of(callback.data or "")
+        if group is None or self.allow(callback.from_user.id, group):
+            return False
+        try:
+            await bot.answer_callback_query(callback.id, text=self.notice)
+        except TelegramAPIError as e:
+            logger.debug(f"Throttle notice to {callback.from_user.id} failed: {e}")
+        return True
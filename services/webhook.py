@@ -0,0 +1,116 @@
+import asyncio
+import json
+import logging
+import secrets
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_MAX_TASKS = 50
+# Updates waiting for a free task before Telegram is told to retry later
+WEBHOOK_MAX_PENDING = 1000
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Webhook handler that answers Telegram at once and works in the background.
+
+    Each update becomes a task, but at most ``max_tasks`` of them run
+    handlers at the same time. With more than ``max_pending`` updates
+    waiting the request is refused with 503, so Telegram keeps the update
+    and sends it again later instead of it piling up in memory.
+    """
+
+    def __init__(self, dispatcher, bot, secret_token: str = None,
+                 max_tasks: int = WEBHOOK_MAX_TASKS,
+                 max_pending: int = WEBHOOK_MAX_PENDING, **data):
+        super().__init__(dispatcher, bot, handle_in_background=True,
+                         secret_token=secret_token, **data)
+        self.max_pending = max_pending
+        self.received = 0
+        self.refused = 0
+        self.failed = 0
+        self._slots = asyncio.Semaphore(max_tasks)
+
+    @property
+    def pending(self) -> int:
+        """Updates accepted and not finished yet"""
+        return len(self._background_feed_update_tasks)
+
+    async def _background_feed_update(self, bot, update: dict):
+        async with self._slots:
+            try:
+                await super()._background_feed_update(bot, update)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Update {update.get('update_id')} failed: {e}", exc_info=True)
+
+    async def _handle_request_background(self, bot, request: web.Request) -> web.Response:
+        if self.pending >= self.max_pending:
+            self.refused += 1
+            return web.Response(status=503, text="Busy")
+        self.received += 1
+        return await super()._handle_request_background(bot, request)
+
+    async def join(self, timeout: float = None) -> int:
+        """Wait for the updates accepted so far, those still waiting for a
+        task included; returns how many are not finished"""
+        if self._background_feed_update_tasks:
+            await asyncio.wait(set(self._background_feed_update_tasks), timeout=timeout)
+        return self.pending
+
+    async def close(self):
+        # Runs when the server stops; the updates in progress still need the
+        # bot session; the caller joins them, then closes it in its shutdown
+        pass
+
+
+def build_webhook_app(dispatcher, bot, path: str = WEBHOOK_PATH,
+                      secret_token: str = None, max_tasks: int = WEBHOOK_MAX_TASKS,
+                      max_pending: int = WEBHOOK_MAX_PENDING) -> tuple:
+    """(aiohttp app, handler) serving Telegram updates on ``path``"""
+    app = web.Application()
+    handler = BoundedRequestHandler(dispatcher, bot, secret_token=secret_token,
+                                    max_tasks=max_tasks, max_pending=max_pending)
+    handler.register(app, path=path)
+    setup_application(app, dispatcher, bot=bot)
+    return app, handler
+
+
+def build_forwarding_app(front, path: str = WEBHOOK_PATH,
+                         secret_token: str = None) -> web.Application:
+    """aiohttp app that only checks the secret and routes updates to workers"""
+    async def receive(request: web.Request) -> web.Response:
+        if secret_token and not secrets.compare_digest(
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret_token):
+            return web.Response(status=401, text="Unauthorized")
+        payload = await request.text()
+        front.route(payload, json.loads(payload))
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    return app
+
+
+async def serve_webhook(app: web.Application, bot, url: str, host: str, port: int,
+                        path: str, secret_token: str, max_connections: int = 40,
+                        allowed_updates: list = None):
+    """Serve ``app`` and point Telegram's webhook at it until cancelled.
+
+    The webhook is left registered on exit, so Telegram keeps the updates
+    that arrive during a restart and delivers them to the next process.
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        await bot.set_webhook(f"{url.rstrip('/')}{path}", secret_token=secret_token,
+                              allowed_updates=allowed_updates,
+                              max_connections=max_connections)
+        logger.info(f"Webhook listening on {host}:{port}{path}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -3,166 +3,73 @@
 Шетпе-Ақтау Такси Бот - Бастапқы орнату скрипті
 """
 
+import asyncio
 import sqlite3
 import sys
 import os
 
-DATABASE_FILE = 'taxi_bot.db'
+DATABASE_FILE = os.getenv("DATABASE_FILE", "taxi_bot.db")
 
 def init_database():
-    """Дерекқорды инициализациялау - СОВМЕСТИМО С bot.py"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    c = conn.cursor()
-    
-    # Водители (из migration_v1 + v4)
-    c.execute('''CREATE TABLE IF NOT EXISTS drivers
-                 (user_id INTEGER PRIMARY KEY,
-                  full_name TEXT NOT NULL,
-                  phone TEXT NOT NULL,
-                  car_number TEXT NOT NULL,
-                  car_model TEXT NOT NULL,
-                  total_seats INTEGER NOT NULL,
-                  direction TEXT NOT NULL,
-                  queue_position INTEGER NOT NULL,
-                  is_active INTEGER DEFAULT 0,
-                  is_verified INTEGER DEFAULT 0,
-                  verification_code TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  avg_rating REAL DEFAULT 0,
-                  rating_count INTEGER DEFAULT 0,
-                  occupied_seats INTEGER DEFAULT 0,
-                  is_on_trip INTEGER DEFAULT 0)''')
-    
-    # Клиенты (из migration_v1 + v2 + v5 + v6 + НОВЫЕ ГОРОДА)
-    c.execute('''CREATE TABLE IF NOT EXISTS clients
-                 (user_id INTEGER PRIMARY KEY,
-                  full_name TEXT NOT NULL,
-                  phone TEXT NOT NULL,
-                  direction TEXT NOT NULL,
-                  queue_position INTEGER NOT NULL,
-                  passengers_count INTEGER DEFAULT 1,
-                  pickup_location TEXT NOT NULL,
-                  dropoff_location TEXT NOT NULL,
-                  is_verified INTEGER DEFAULT 0,
-                  verification_code TEXT,
-                  status TEXT DEFAULT 'waiting',
-                  assigned_driver_id INTEGER,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  avg_rating REAL DEFAULT 0,
-                  rating_count INTEGER DEFAULT 0,
-                  cancellation_count INTEGER DEFAULT 0,
-                  order_for TEXT DEFAULT 'self',
-                  order_number INTEGER DEFAULT 1,
-                  parent_user_id INTEGER,
-                  from_city TEXT NOT NULL,
-                  to_city TEXT NOT NULL)''')
-    
-    # Админы
-    c.execute('''CREATE TABLE IF NOT EXISTS admins
-                 (user_id INTEGER PRIMARY KEY,
-                  added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Рейтинги (из migration_v2)
-    c.execute('''CREATE TABLE IF NOT EXISTS ratings
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  from_user_id INTEGER,
-                  to_user_id INTEGER,
-                  user_type TEXT,
-                  trip_id INTEGER,
-                  rating INTEGER CHECK(rating >= 1 AND rating <= 5),
-                  review TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Поездки (из migration_v3)
-    c.execute('''CREATE TABLE IF NOT EXISTS trips
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  driver_id INTEGER,
-                  client_id INTEGER,
-                  direction TEXT,
-                  pickup_location TEXT,
-                  dropoff_location TEXT,
-                  passengers_count INTEGER,
-                  status TEXT,
-                  driver_arrived_at TIMESTAMP,
-                  trip_started_at TIMESTAMP,
-                  trip_completed_at TIMESTAMP,
-                  cancelled_by TEXT,
-                  cancelled_at TIMESTAMP,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Логи действий (из migration_v3)
-    c.execute('''CREATE TABLE IF NOT EXISTS actions_log
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  action TEXT,
-                  details TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    """Дерекқорды инициализациялау - bot.py-мен бірдей миграциялар"""
+    from database.migrations import migrate_file
     
-    # Черный список (из migration_v5)
-    c.execute('''CREATE TABLE IF NOT EXISTS blacklist
-                 (user_id INTEGER PRIMARY KEY,
-                  reason TEXT,
-                  cancellation_count INTEGER DEFAULT 0,
-                  banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Устанавливаем версию БД на 6 (все миграции применены)
-    c.execute("PRAGMA user_version = 6")
-    
-    conn.commit()
-    conn.close()
+    old_version, new_version = asyncio.run(migrate_file(DATABASE_FILE))
     
     print("✅ Дерекқор сәтті құрылды!")
     print("\n📋 Құрылған кестелер:")
     print("  • drivers (с occupied_seats, avg_rating)")
-    print("  • clients (с from_city, to_city, status, cancellation_count)")
+    print("  • clients (профиль: full_name, phone, cancellation_count)")
+    print("  • orders (client_id, direction, status, queue_position)")
     print("  • admins")
     print("  • ratings")
     print("  • trips")
     print("  • actions_log")
     print("  • blacklist")
-    print("\n✅ DB Version: 6 (все миграции применены)")
+    print(f"\n✅ DB Version: {new_version} (все миграции применены)")
 
 def migrate_existing_database():
-    """Бар дерекқорды жаңарту (departure_date қосу)"""
+    """Бар дерекқорды жаңарту (PRAGMA user_version бойынша миграциялар)"""
     if not os.path.exists(DATABASE_FILE):
         print(f"❌ {DATABASE_FILE} файлы табылмады!")
         return
     
-    conn = sqlite3.connect(DATABASE_FILE)
-    c = conn.cursor()
-    conn = sqlite3.connect('taxi_bot.db')
-    c = conn.cursor()
+    from database.migrations import migrate_file
     
     try:
-        # Drivers кестесіне departure_date бағанын қосу
-        c.execute("PRAGMA table_info(drivers)")
-        columns = [column[1] for column in c.fetchall()]
-        
-        if 'departure_date' not in columns:
-            print("  • drivers кестесіне departure_date қосылуда...")
-            c.execute("ALTER TABLE drivers ADD COLUMN departure_date TEXT DEFAULT '2025-01-01'")
-            print("  ✅ drivers кестесі жаңартылды")
-        else:
-            print("  ✅ drivers кестесінде departure_date бар")
-        
-        # Bookings кестесіне departure_date бағанын қосу
-        c.execute("PRAGMA table_info(bookings)")
-        columns = [column[1] for column in c.fetchall()]
+        old_version, new_version = asyncio.run(migrate_file(DATABASE_FILE))
         
-        if 'departure_date' not in columns:
-            print("  • bookings кестесіне departure_date қосылуда...")
-            c.execute("ALTER TABLE bookings ADD COLUMN departure_date TEXT DEFAULT '2025-01-01'")
-            print("  ✅ bookings кестесі жаңартылды")
+        if old_version == new_version:
+            print(f"  ✅ Дерекқор жаңартуды қажет етпейді (v{new_version})")
         else:
-            print("  ✅ bookings кестесінде departure_date бар")
-        
-        conn.commit()
+            print(f"  ✅ v{old_version} → v{new_version}")
         print("\n✅ Миграция сәтті аяқталды!")
         
     except Exception as e:
         print(f"\n❌ Миграция қатесі: {e}")
-    finally:
-        conn.close()
+
+def recompute_ratings():
+    """Жүргізуші рейтингтерін ratings кестесінен қайта есептеу (жөндеу үшін)"""
+    if not os.path.exists(DATABASE_FILE):
+        print(f"❌ {DATABASE_FILE} файлы табылмады!")
+        return
+
+    from database.db import init_pool, close_pool, get_db
+    from database.queries import recompute_driver_ratings
+
+    async def run():
+        await init_pool(DATABASE_FILE, readers=1)
+        try:
+            async with get_db(write=True) as db:
+                return await recompute_driver_ratings(db)
+        finally:
+            await close_pool()
+
+    try:
+        updated = asyncio.run(run())
+        print(f"✅ Рейтингтер қайта есептелді: {updated} жүргізуші")
+    except Exception as e:
+        print(f"\n❌ Қате: {e}")
 
 def add_admin():
     """Бірінші админді қосу"""
@@ -269,7 +176,7 @@ def check_database_structure():
     conn = sqlite3.connect('taxi_bot.db')
     c = conn.cursor()
     
-    tables = ['drivers', 'clients', 'bookings', 'admins', 'payment_history', 'notification_log']
+    tables = ['drivers', 'clients', 'orders', 'bookings', 'admins', 'payment_history', 'notification_log']
     
     print("\n📊 Кестелер мен бағандар:")
     for table in tables:
@@ -296,6 +203,7 @@ def show_menu():
     print("5. .env файлын құру")
     print("6. Дерекқор құрылымын тексеру")
     print("7. Толық орнату (барлығы)")
+    print("8. Рейтингтерді қайта есептеу")
     print("0. Шығу")
     print("\n" + "─"*50)
 
@@ -347,7 +255,7 @@ def main():
     """Басты функция"""
     while True:
         show_menu()
-        choice = input("Таңдау (0-7): ").strip()
+        choice = input("Таңдау (0-8): ").strip()
         
         if choice == '1':
             init_database()
@@ -364,11 +272,13 @@ def main():
         elif choice == '7':
             full_setup()
             break
+        elif choice == '8':
+            recompute_ratings()
         elif choice == '0':
             print("\n👋 Сау болыңыз!")
             sys.exit(0)
         else:
-            print("\n❌ Қате таңдау! 0-7 арасынан таңдаңыз.")
+            print("\n❌ Қате таңдау! 0-8 арасынан таңдаңыз.")
         
         input("\nЖалғастыру үшін Enter басыңыз...")
 
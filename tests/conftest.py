@@ -0,0 +1,100 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+from aiogram import Bot
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Update
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+from database.db import get_db  # noqa: E402
+
+ROUTE = ("Ақтау → Жаңаөзен", "Ақтау", "Жаңаөзен")
+
+
+@pytest.fixture
+def config(tmp_path) -> Config:
+    return Config(bot_token="123456:ABCdef", database_file=str(tmp_path / "taxi_bot.db"),
+                  db_readers=2, log_file="", throttle=False)
+
+
+@pytest.fixture
+def telegram(monkeypatch) -> list:
+    """Bot API calls made by the handlers; none of them leaves the process"""
+    calls = []
+
+    async def call(self, method, request_timeout=None):
+        calls.append(method)
+        return True
+
+    monkeypatch.setattr(Bot, "__call__", call)
+    return calls
+
+
+@pytest.fixture
+def run(config, telegram):
+    """run(body): await body(app) in a fresh app, bound and opened"""
+    import bot
+
+    def run(body):
+        async def main():
+            app = bot.create_app(config)
+            with app.bound():
+                await app.open()
+                try:
+                    return await body(app)
+                finally:
+                    await app.shutdown(time.monotonic() + 1)
+        return asyncio.run(main())
+    return run
+
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> Update:
+    return Update.model_validate({"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "c", "data": data,
+        "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+        "message": {"message_id": message_id, "date": 0, "text": "x",
+                    "chat": {"id": user_id, "type": "private"}}}})
+
+
+async def fetch(sql: str, *args) -> list:
+    async with get_db() as db:
+        async with db.execute(sql, args) as cursor:
+            return await cursor.fetchall()
+
+
+async def add_client(user_id: int, name: str = "Client"):
+    async with get_db(write=True) as db:
+        await db.execute(
+            '''INSERT INTO clients (user_id, full_name, phone, direction, queue_position,
+                                    is_verified, status)
+               VALUES (?, ?, '+77000000000', '', 0, 1, 'registered')''', (user_id, name))
+
+
+async def add_driver(user_id: int, seats: int = 4, direction: str = ROUTE[0]):
+    async with get_db(write=True) as db:
+        await db.execute(
+            '''INSERT INTO drivers (user_id, full_name, phone, car_number, car_model,
+                                    total_seats, direction, queue_position, is_active,
+                                    is_verified, occupied_seats)
+               VALUES (?, 'Driver', '+77000000001', '123ABC', 'Camry', ?, ?, 1, 1, 1, 0)''',
+            (user_id, seats, direction))
+    await reload_dispatch()
+
+
+async def reload_dispatch():
+    from services.app import current_app
+    async with get_db() as db:
+        await current_app().dispatch.load(db)
+
+
+async def start_order(app, user_id: int, direction: str = ROUTE[0]):
+    """Put the client at the passengers_count step of an order"""
+    key = StorageKey(bot_id=app.bot.id, chat_id=user_id, user_id=user_id)
+    await app.storage.set_state(key, "ClientOrder:passengers_count")
+    await app.storage.set_data(key, {"direction": direction, "from_city": ROUTE[1],
+                                     "to_city": ROUTE[2]})
@@ -0,0 +1,32 @@
+from aiogram.methods import AnswerCallbackQuery, EditMessageText
+
+from database.db import get_db
+
+from conftest import add_driver, callback_update
+
+ADMIN = 1
+
+
+def test_admin_reorders_the_driver_queue(run, telegram):
+    async def body(app):
+        async with get_db(write=True) as db:
+            await db.execute("INSERT INTO admins (user_id) VALUES (?)", (ADMIN, ))
+        for user_id, position in ((9, 1), (10, 2)):
+            await add_driver(user_id)
+            async with get_db(write=True) as db:
+                await db.execute("UPDATE drivers SET queue_position = ?, full_name = ? "
+                                 "WHERE user_id = ?", (position, f"D{user_id}", user_id))
+        await app.dp.feed_update(app.bot, callback_update(1, ADMIN, "admin_queue"))
+        await app.dp.feed_update(app.bot, callback_update(2, ADMIN, "qmove:10:1"))
+        await app.dp.feed_update(app.bot, callback_update(3, ADMIN, "qmove:10:1"))
+        await app.dp.feed_update(app.bot, callback_update(4, 5, "admin_queue"))
+
+    run(body)
+    edits = [call.text for call in telegram if isinstance(call, EditMessageText)]
+    assert [line for line in edits[0].splitlines() if line.startswith("№")] == [
+        "№1 - D9 (123ABC)", "№2 - D10 (123ABC)"]
+    assert [line for line in edits[1].splitlines() if line.startswith("№")] == [
+        "№1 - D10 (123ABC)", "№2 - D9 (123ABC)"]
+    answers = [call.text for call in telegram if isinstance(call, AnswerCallbackQuery)]
+    assert answers[-2:] == ["❌ Бұл бірінші орында!", "❌ Тыйым салынған"]
+    assert len(edits) == 2
@@ -0,0 +1,47 @@
+import pytest
+
+from utils.callbacks import (AcceptClientOrders, AcceptOrder, CancelOrder, PickRoute,
+                             QuickRate)
+from utils.routes import route_by_key
+
+
+@pytest.mark.parametrize("data, expected", [
+    ("accept_client_12", AcceptOrder(order_id=12)),
+    ("acc:12", AcceptOrder(order_id=12)),
+    ("cancel_order_7", CancelOrder(order_id=7)),
+    ("quick_rate_31_4", QuickRate(trip_id=31, rating=4)),
+    ("dir_aktau_janaozen", PickRoute(route="aktau_janaozen")),
+    ("dacc:5:aj:2", AcceptClientOrders(client_id=5, route="aj", count=2)),
+    ("driver_accept_5_Ақтау_Жаңаөзен_2",
+     AcceptClientOrders(client_id=5, route="Ақтау → Жаңаөзен", count=2)),
+])
+def test_unpack_old_and_new_callback_data(data, expected):
+    assert type(expected).unpack(data) == expected
+
+
+@pytest.mark.parametrize("factory, data", [
+    (QuickRate, "quick_rate_31"),
+    (AcceptOrder, "accept_client_x"),
+    (AcceptOrder, "rej:12"),
+    (AcceptClientOrders, "driver_accept_5_Ақтау_Жаңаөзен"),
+])
+def test_unpack_rejects_malformed_data(factory, data):
+    with pytest.raises((TypeError, ValueError)):
+        factory.unpack(data)
+
+
+def test_old_and_new_route_keys_name_the_same_route():
+    old = AcceptClientOrders.unpack("driver_accept_5_Ақтау_Жаңаөзен_2")
+    new = AcceptClientOrders.unpack("dacc:5:aj:2")
+    assert route_by_key(old.route) == route_by_key(new.route) == route_by_key("aktau_janaozen")
+
+
+def test_index_resolves_old_and_new_keys():
+    import bot
+
+    index = bot.callback_index
+    assert index.resolve("accept_client_12") == ("accept_client", {"driver"})
+    assert index.resolve("driver_accept_5_Ақтау_Жаңаөзен_2") == ("driver_accept", {"driver"})
+    assert index.resolve("acc:12")[0] == "acc"
+    assert index.resolve("confirm_order")[0] == "confirm_order"
+    assert index.resolve("no_such_button_1") == (None, set())
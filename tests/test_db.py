@@ -0,0 +1,38 @@
+import asyncio
+
+from database.db import ConnectionPool
+
+
+def test_close_waits_for_borrowed_readers(tmp_path):
+    async def main():
+        pool = ConnectionPool(str(tmp_path / "pool.db"), readers=2)
+        await pool.open()
+        async with pool.reader() as db:
+            closing = asyncio.create_task(pool.close())
+            await asyncio.sleep(0.05)
+            assert not closing.done()
+            async with db.execute("SELECT 1") as cursor:
+                row = await cursor.fetchone()
+        await asyncio.wait_for(closing, 1)
+        return row, pool.is_open
+
+    assert asyncio.run(main()) == ((1, ), False)
+
+
+def test_close_waits_for_the_writer(tmp_path):
+    async def main():
+        pool = ConnectionPool(str(tmp_path / "pool.db"), readers=1)
+        await pool.open()
+        async with pool.writer() as db:
+            closing = asyncio.create_task(pool.close())
+            await asyncio.sleep(0.05)
+            await db.execute("CREATE TABLE t (x)")
+        await asyncio.wait_for(closing, 1)
+        await pool.open()
+        async with pool.reader() as db:
+            async with db.execute("SELECT COUNT(*) FROM t") as cursor:
+                count = await cursor.fetchone()
+        await pool.close()
+        return count
+
+    assert asyncio.run(main()) == (0, )
@@ -0,0 +1,16 @@
+from database.db import get_db
+
+from conftest import ROUTE, add_driver, reload_dispatch
+
+
+def test_driver_without_is_active_is_not_suitable(run):
+    async def body(app):
+        await add_driver(9, seats=4)
+        await add_driver(10, seats=4)
+        async with get_db(write=True) as db:
+            await db.execute("UPDATE drivers SET is_active = NULL WHERE user_id = 10")
+        await reload_dispatch()
+        return ([driver.user_id for driver in app.dispatch.drivers_with_seats(ROUTE[0], 2)],
+                app.dispatch.suitable_drivers(ROUTE[0], 2), app.dispatch.capacity(ROUTE[0]))
+
+    assert run(body) == ([9], 1, (1, 4))
@@ -0,0 +1,102 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from database.fsm_storage import SQLiteStorage
+
+from conftest import fetch
+
+
+def key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+async def stored() -> list:
+    return await fetch("SELECT key, state, data FROM fsm_state ORDER BY key")
+
+
+def test_writes_wait_for_flush(run):
+    async def body(app):
+        storage = SQLiteStorage(interval=60)
+        await storage.set_state(key(1), "Form:name")
+        await storage.set_data(key(1), {"a": 1})
+        await storage.update_data(key(1), {"b": 2})
+        before = await stored()
+        written = await storage.flush()
+        return before, written, await stored(), await storage.get_data(key(1))
+
+    before, written, after, data = run(body)
+    assert before == []
+    assert written == 1
+    assert after == [("fsm:1:1", "Form:name", '{"a": 1, "b": 2}')]
+    assert data == {"a": 1, "b": 2}
+
+
+def test_clear_writes_through(run):
+    async def body(app):
+        storage = SQLiteStorage(interval=60)
+        await storage.set_state(key(1), "Form:name")
+        await storage.flush()
+        await storage.set_state(key(1), None)
+        await storage.set_data(key(1), {})
+        return await stored(), storage.stats()["dirty"]
+
+    assert run(body) == ([], 0)
+
+
+def test_full_batch_is_written_in_the_background(run):
+    async def body(app):
+        storage = SQLiteStorage(interval=60, batch_size=3)
+        storage.start()
+        try:
+            for user_id in range(3):
+                await storage.set_state(key(user_id), "Form:name")
+            for _ in range(50):
+                if len(await stored()) == 3:
+                    break
+                await asyncio.sleep(0.01)
+            return len(await stored()), storage.stats()["dirty"]
+        finally:
+            await storage.close()
+
+    assert run(body) == (3, 0)
+
+
+def test_close_flushes_dirty_keys(run):
+    async def body(app):
+        storage = SQLiteStorage(interval=60)
+        storage.start()
+        await storage.update_data(key(1), {"step": 2})
+        await storage.close()
+        return await stored()
+
+    assert run(body) == [("fsm:1:1", None, '{"step": 2}')]
+
+
+def test_lru_evicts_the_oldest_key(run):
+    async def body(app):
+        storage = SQLiteStorage(cache_size=2, interval=60)
+        for user_id in (1, 2, 3):
+            await storage.set_data(key(user_id), {"user": user_id})
+        await storage.flush()
+        # 1 was evicted: read back from the database
+        first = await storage.get_data(key(1))
+        misses = storage.stats()["misses"]
+        await storage.get_data(key(3))
+        return first, misses, storage.stats()
+
+    first, misses, stats = run(body)
+    assert first == {"user": 1}
+    assert stats["cached"] == 2
+    assert stats["misses"] == misses
+    assert stats["hits"] >= 1
+
+
+def test_evicted_dirty_key_is_not_lost(run):
+    async def body(app):
+        storage = SQLiteStorage(cache_size=1, interval=60)
+        await storage.update_data(key(1), {"step": 1})
+        await storage.update_data(key(2), {"step": 1})
+        return await storage.get_data(key(1)), await stored()
+
+    assert run(body) == ({"step": 1}, [])
@@ -0,0 +1,95 @@
+import asyncio
+
+from aiogram.methods import AnswerCallbackQuery, SendMessage
+
+from conftest import add_client, add_driver, callback_update, fetch, start_order
+
+CLIENT, DRIVER = 5, 9
+
+
+def answers(telegram) -> list:
+    return [call.text for call in telegram if isinstance(call, AnswerCallbackQuery)]
+
+
+def test_repeated_confirm_places_one_order(run, telegram):
+    async def body(app):
+        await add_client(CLIENT)
+        await start_order(app, CLIENT)
+        await app.dp.feed_update(app.bot, callback_update(1, CLIENT, "seats:2", 10))
+        await asyncio.gather(*(app.dp.feed_update(
+            app.bot, callback_update(2 + i, CLIENT, "confirm_order", 10)) for i in range(3)))
+        return await fetch("SELECT order_number FROM orders")
+
+    assert run(body) == [(1, )]
+    assert answers(telegram)[-2:] == ["✅ Тапсырыс #1 жасалды!"] * 2
+
+
+def test_two_orders_in_a_row_on_one_message(run, telegram):
+    async def body(app):
+        await add_client(CLIENT)
+        for n, seats in enumerate((2, 1)):
+            await start_order(app, CLIENT)
+            await app.dp.feed_update(app.bot, callback_update(10 * n + 1, CLIENT, f"seats:{seats}", 10))
+            await app.dp.feed_update(app.bot, callback_update(10 * n + 2, CLIENT, "confirm_order", 10))
+            await app.dp.feed_update(app.bot, callback_update(10 * n + 3, CLIENT, "confirm_order", 10))
+        return await fetch("SELECT order_number, passengers_count FROM orders ORDER BY id")
+
+    assert run(body) == [(1, 2), (2, 1)]
+    assert answers(telegram).count("✅ Тапсырыс #2 жасалды!") == 1
+
+
+async def accept_new_order(app, n: int) -> int:
+    """Client orders a seat, the driver accepts it; returns the trip id"""
+    await start_order(app, CLIENT)
+    await app.dp.feed_update(app.bot, callback_update(10 * n + 1, CLIENT, "seats:1", 10))
+    await app.dp.feed_update(app.bot, callback_update(10 * n + 2, CLIENT, "confirm_order", 10))
+    (order_id, ), = await fetch("SELECT MAX(id) FROM orders")
+    await app.dp.feed_update(app.bot, callback_update(10 * n + 3, DRIVER, f"acc:{order_id}", 30))
+    (trip_id, ), = await fetch("SELECT MAX(id) FROM trips")
+    return trip_id
+
+
+def complete_trip_button(telegram) -> str:
+    """callback_data of "Сапарды аяқтау" in the last driver menu sent"""
+    menu = [call for call in telegram if isinstance(call, SendMessage)][-1]
+    return next(button.callback_data for row in menu.reply_markup.inline_keyboard
+                for button in row if button.text == "✅ Сапарды аяқтау")
+
+
+def test_complete_trip_taps_at_once(run, telegram):
+    async def body(app):
+        await add_client(CLIENT)
+        await add_driver(DRIVER)
+        buttons = []
+        for n in range(2):
+            await accept_new_order(app, n)
+            # Each ride from a menu sent while it was active
+            await app.dp.feed_update(app.bot, callback_update(10 * n + 4, DRIVER, "driver_menu", 30))
+            buttons.append(complete_trip_button(telegram))
+            await asyncio.gather(*(app.dp.feed_update(app.bot, callback_update(
+                10 * n + 5 + i, DRIVER, buttons[-1], 31 + n)) for i in range(3)))
+        return (buttons, await fetch("SELECT id, status FROM trips ORDER BY id"),
+                await fetch("SELECT occupied_seats FROM drivers"))
+
+    buttons, trips, seats = run(body)
+    assert buttons == [f"done:{trip_id}" for trip_id, _ in trips]
+    assert [status for _, status in trips] == ["completed", "completed"]
+    assert seats == [(0, )]
+    assert answers(telegram).count("✅ Сапар аяқталды! 1 орын босады") == 6
+
+
+def test_old_complete_trip_button_on_one_menu_message(run, telegram):
+    async def body(app):
+        await add_client(CLIENT)
+        await add_driver(DRIVER)
+        for n in range(2):
+            await accept_new_order(app, n)
+            await app.dp.feed_update(app.bot, callback_update(10 * n + 4, DRIVER, "driver_complete_trip", 31))
+            await app.dp.feed_update(app.bot, callback_update(10 * n + 5, DRIVER, "driver_complete_trip", 31))
+        return (await fetch("SELECT status FROM trips ORDER BY id"),
+                await fetch("SELECT occupied_seats FROM drivers"))
+
+    trips, seats = run(body)
+    assert trips == [("completed", ), ("completed", )]
+    assert seats == [(0, )]
+    assert answers(telegram).count("✅ Сапар аяқталды! 1 орын босады") == 4
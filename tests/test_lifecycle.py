@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+from aiogram import Router
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import Update
+
+from database.db import get_db
+from services.app import App
+from services.lifecycle import UpdateTracker, remaining
+
+
+def message_update(update_id: int, user_id: int) -> Update:
+    return Update.model_validate({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "hi",
+        "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+        "chat": {"id": user_id, "type": "private"}}})
+
+
+def gated_app(config) -> tuple:
+    """An app whose handler waits for ``gate`` and then writes a log row"""
+    router = Router(name="gated")
+    gate = asyncio.Event()
+    started = []
+
+    @router.message()
+    async def handle(message):
+        started.append(message.from_user.id)
+        await gate.wait()
+        async with get_db(write=True) as db:
+            await db.execute("INSERT INTO actions_log (user_id, action) VALUES (?, 'gated')",
+                             (message.from_user.id, ))
+
+    return App(config, (router, )), gate, started
+
+
+async def logged(app) -> list:
+    await app.pool.open()
+    try:
+        async with get_db() as db:
+            async with db.execute("SELECT user_id FROM actions_log WHERE action = 'gated'") as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+    finally:
+        await app.pool.close()
+
+
+def test_remaining_never_negative():
+    assert remaining(time.monotonic() - 5) == 0.0
+    assert 4 < remaining(time.monotonic() + 5) <= 5
+
+
+def test_tracker_drops_updates_after_close():
+    tracker = UpdateTracker()
+
+    async def handler(event, data):
+        return "done"
+
+    async def scenario():
+        assert await tracker(handler, None, {}) == "done"
+        tracker.close()
+        assert await tracker(handler, None, {}) is UNHANDLED
+        assert await tracker.join(timeout=0) == 0
+
+    asyncio.run(scenario())
+    assert tracker.dropped == 1
+
+
+def test_shutdown_waits_for_running_updates(config, telegram):
+    app, gate, started = gated_app(config)
+
+    async def scenario():
+        with app.bound():
+            await app.open()
+            running = asyncio.create_task(app.dp.feed_update(app.bot, message_update(1, 1)))
+            while not started:
+                await asyncio.sleep(0)
+            shutdown = asyncio.create_task(app.shutdown(time.monotonic() + 5))
+            await asyncio.sleep(0.05)
+            assert not shutdown.done() and app.update_tracker.in_flight == 1
+            # Closed: a new update is dropped before any handler runs
+            await app.dp.feed_update(app.bot, message_update(2, 2))
+            gate.set()
+            await shutdown
+            await running
+            return await logged(app)
+
+    assert asyncio.run(scenario()) == [1]
+    assert started == [1]
+    assert app.update_tracker.dropped == 1
+
+
+def test_shutdown_abandons_updates_past_the_deadline(config, telegram, caplog):
+    app, gate, started = gated_app(config)
+
+    async def scenario():
+        with app.bound():
+            await app.open()
+            running = asyncio.create_task(app.dp.feed_update(app.bot, message_update(1, 1)))
+            while not started:
+                await asyncio.sleep(0)
+            await app.shutdown(time.monotonic() + 0.05)
+            assert app.update_tracker.in_flight == 1
+            running.cancel()
+            return await logged(app)
+
+    assert asyncio.run(scenario()) == []
+    assert "1 updates still running, abandoned" in caplog.text
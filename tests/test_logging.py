@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+from database.db import get_db
+from services.app import App
+from utils import logging as log_module
+from utils.logging import ActionLogBuffer, archive_old_actions, search_archives
+
+from conftest import fetch
+
+
+def in_app(config, body):
+    """await body(app) in a fresh app without routers, then shut it down"""
+    async def main():
+        app = App(config)
+        with app.bound():
+            await app.open()
+            try:
+                return await body(app)
+            finally:
+                await app.shutdown(time.monotonic() + 1)
+    return asyncio.run(main())
+
+
+async def logged() -> list:
+    return await fetch("SELECT user_id, action, details FROM actions_log ORDER BY id")
+
+
+def test_records_wait_for_a_full_batch(config):
+    async def body(app):
+        log = ActionLogBuffer(batch_size=3, interval=60)
+        log.start()
+        log.add(1, "a")
+        log.add(2, "b")
+        await asyncio.sleep(0.05)
+        before = await logged()
+        log.add(3, "c", "x")
+        await asyncio.sleep(0.05)
+        after = await logged()
+        await log.stop()
+        return before, after, log.stats()
+
+    before, after, stats = in_app(config, body)
+    assert before == []
+    assert after == [(1, "a", ""), (2, "b", ""), (3, "c", "x")]
+    assert stats == {"queued": 0, "written": 3, "dropped": 0}
+
+
+def test_shutdown_writes_what_is_still_queued(config):
+    async def body(app):
+        app.action_log.start()
+        for i in range(5):
+            app.action_log.add(i, "queued")
+        await asyncio.sleep(0.05)
+        return app.action_log.queued, await logged()
+
+    # Neither a full batch nor the interval: only shutdown writes them
+    assert in_app(config._replace(log_batch_size=100, log_flush_interval=60), body) == (5, [])
+
+    async def after(app):
+        return await logged()
+
+    assert in_app(config, after) == [(i, "queued", "") for i in range(5)]
+
+
+def test_failed_flush_keeps_records_up_to_the_limit(config, monkeypatch):
+    @asynccontextmanager
+    async def unavailable(write=False):
+        raise RuntimeError("database is locked")
+        yield
+
+    async def body(app):
+        log = ActionLogBuffer(batch_size=2, max_queued=3)
+        for i in range(4):
+            log.add(i, "a")
+        with monkeypatch.context() as m:
+            m.setattr(log_module, "get_db", unavailable)
+            assert await log.flush() == 0
+        stats = log.stats()
+        assert await log.flush() == 3
+        return stats, await logged()
+
+    stats, rows = in_app(config, body)
+    assert stats == {"queued": 3, "written": 0, "dropped": 1}
+    assert rows == [(i, "a", "") for i in range(3)]
+
+
+async def insert_actions(*rows):
+    async with get_db(write=True) as db:
+        await db.executemany(
+            "INSERT INTO actions_log (user_id, action, details, created_at) VALUES (?, ?, '', ?)",
+            rows)
+
+
+def test_archive_moves_only_old_rows(config, tmp_path):
+    archive = str(tmp_path / "archive")
+    recent = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+    async def body(app):
+        await insert_actions((1, "start", "2020-01-01 10:00:00"),
+                             (2, "order", "2020-01-01 11:00:00"),
+                             (1, "order", "2020-01-02 09:00:00"),
+                             (1, "order", recent))
+        moved = await archive_old_actions(archive, days=30, batch_size=2)
+        again = await archive_old_actions(archive, days=30, batch_size=2)
+        return moved, again, await fetch("SELECT user_id, created_at FROM actions_log")
+
+    moved, again, left = in_app(config, body)
+    assert (moved, again) == (3, 0)
+    assert left == [(1, recent)]
+    assert sorted(os.listdir(archive)) == ["actions-2020-01-01.jsonl.gz",
+                                           "actions-2020-01-02.jsonl.gz"]
+
+
+def test_search_archives_newest_first(config, tmp_path):
+    archive = str(tmp_path / "archive")
+
+    async def body(app):
+        await insert_actions((1, "start", "2020-01-01 10:00:00"),
+                             (2, "order", "2020-01-01 11:00:00"),
+                             (1, "order", "2020-01-01 12:00:00"),
+                             (1, "cancel", "2020-01-03 09:00:00"))
+        # A second run appends to an existing day file
+        await archive_old_actions(archive, days=30)
+        await insert_actions((1, "order", "2020-01-01 13:00:00"))
+        await archive_old_actions(archive, days=30)
+        return (await search_archives(archive, user_id=1),
+                await search_archives(archive, action="order", limit=2),
+                await search_archives(str(tmp_path / "none")))
+
+    by_user, by_action, nothing = in_app(config, body)
+    assert [(r["action"], r["created_at"]) for r in by_user] == [
+        ("cancel", "2020-01-03 09:00:00"), ("order", "2020-01-01 13:00:00"),
+        ("order", "2020-01-01 12:00:00"), ("start", "2020-01-01 10:00:00")]
+    assert [(r["user_id"], r["created_at"]) for r in by_action] == [
+        (1, "2020-01-01 13:00:00"), (1, "2020-01-01 12:00:00")]
+    assert nothing == []
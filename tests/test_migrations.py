@@ -0,0 +1,224 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from database import migrations
+from database.db import get_db
+from database.migrations import LATEST_VERSION, migrate_file
+from database.queries import fetch_stats, recompute_stats
+
+DIRECTION = "Ақтау → Жаңаөзен"
+
+# The shape setup.py left at user_version 6: no orders table, orders are
+# clients rows (sub-orders with parent_user_id), no from/to cities yet
+V6_SCHEMA = [
+    '''CREATE TABLE drivers
+       (user_id INTEGER PRIMARY KEY, full_name TEXT NOT NULL, phone TEXT NOT NULL,
+        car_number TEXT NOT NULL, car_model TEXT NOT NULL,
+        total_seats INTEGER NOT NULL, direction TEXT NOT NULL,
+        queue_position INTEGER NOT NULL, is_active INTEGER DEFAULT 0,
+        is_verified INTEGER DEFAULT 0, verification_code TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        avg_rating REAL DEFAULT 0, rating_count INTEGER DEFAULT 0,
+        occupied_seats INTEGER DEFAULT 0)''',
+    '''CREATE TABLE clients
+       (user_id INTEGER PRIMARY KEY, full_name TEXT NOT NULL, phone TEXT NOT NULL,
+        direction TEXT NOT NULL, queue_position INTEGER NOT NULL,
+        passengers_count INTEGER DEFAULT 1, is_verified INTEGER DEFAULT 0,
+        verification_code TEXT, status TEXT DEFAULT 'waiting',
+        assigned_driver_id INTEGER, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        order_number INTEGER DEFAULT 1, parent_user_id INTEGER)''',
+    '''CREATE TABLE trips
+       (id INTEGER PRIMARY KEY AUTOINCREMENT, driver_id INTEGER, client_id INTEGER,
+        direction TEXT, passengers_count INTEGER, status TEXT,
+        driver_arrived_at TIMESTAMP, trip_started_at TIMESTAMP,
+        trip_completed_at TIMESTAMP, cancelled_by TEXT, cancelled_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE ratings
+       (id INTEGER PRIMARY KEY AUTOINCREMENT, from_user_id INTEGER,
+        to_user_id INTEGER, user_type TEXT, trip_id INTEGER,
+        rating INTEGER CHECK(rating >= 1 AND rating <= 5), review TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE admins (user_id INTEGER PRIMARY KEY,
+                            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    "PRAGMA user_version = 6",
+]
+
+
+def make_v6_database(path: str):
+    with sqlite3.connect(path) as db:
+        for sql in V6_SCHEMA:
+            db.execute(sql)
+
+
+def rows(db, sql: str) -> list:
+    return db.execute(sql).fetchall()
+
+
+def indexes(db) -> set:
+    return {name for name, in rows(db, "SELECT name FROM sqlite_master WHERE type='index'")}
+
+
+@pytest.mark.parametrize("prepare", [make_v6_database, lambda path: None],
+                         ids=["setup.py v6", "empty file"])
+def test_migrates_to_latest_once(tmp_path, prepare):
+    path = str(tmp_path / "taxi_bot.db")
+    prepare(path)
+    with sqlite3.connect(path) as db:
+        old_version, = db.execute("PRAGMA user_version").fetchone()
+
+    assert asyncio.run(migrate_file(path)) == (old_version, LATEST_VERSION)
+    assert asyncio.run(migrate_file(path)) == (LATEST_VERSION, LATEST_VERSION)
+
+    with sqlite3.connect(path) as db:
+        assert rows(db, "PRAGMA user_version") == [(LATEST_VERSION, )]
+        assert {"idx_drivers_direction_active", "idx_trips_driver_status",
+                "idx_ratings_to_type", "idx_actions_log_created"} <= indexes(db)
+        # Replaced by the composite indexes
+        assert not {"idx_drivers_direction", "idx_trips_driver"} & indexes(db)
+
+
+def test_failed_migration_leaves_the_database_untouched(tmp_path, monkeypatch):
+    path = str(tmp_path / "v6.db")
+    make_v6_database(path)
+
+    async def broken(db):
+        """Always fails"""
+        raise sqlite3.OperationalError("broken")
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS[:2] + [(9, broken)])
+    with pytest.raises(sqlite3.OperationalError):
+        asyncio.run(migrate_file(path))
+
+    with sqlite3.connect(path) as db:
+        assert rows(db, "PRAGMA user_version") == [(6, )]
+        assert "idx_drivers_direction_active" not in indexes(db)
+        assert "actions_log" not in {name for name, in rows(
+            db, "SELECT name FROM sqlite_master WHERE type='table'")}
+
+
+def add_v6_orders(path: str):
+    """Orders as v6 stored them: an old-style profile row that is itself
+    the order, and a sub-order with a synthetic user_id"""
+    with sqlite3.connect(path) as db:
+        db.executemany(
+            '''INSERT INTO drivers (user_id, full_name, phone, car_number, car_model,
+                                    total_seats, direction, queue_position, is_active,
+                                    occupied_seats)
+               VALUES (?, 'Driver', '+7', 'N', 'M', 4, ?, ?, ?, ?)''',
+            [(9, DIRECTION, 1, 1, 2), (10, DIRECTION, 2, 0, 0)])
+        db.executemany(
+            '''INSERT INTO clients (user_id, full_name, phone, direction, queue_position,
+                                    passengers_count, status, assigned_driver_id,
+                                    order_number, parent_user_id)
+               VALUES (?, ?, '+7', ?, ?, ?, ?, ?, ?, ?)''',
+            [(5, "Old style", DIRECTION, 2.5, 1, "waiting", None, 1, None),
+             (6, "Registered", "", 0, 1, "registered", None, 1, None),
+             (900001, "Old style", DIRECTION, 1, 2, "accepted", 9, 2, 5)])
+        db.executemany(
+            "INSERT INTO trips (driver_id, client_id, direction, passengers_count, status) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(9, 900001, DIRECTION, 2, "accepted"), (9, 6, DIRECTION, 1, "completed")])
+        db.executemany(
+            "INSERT INTO ratings (from_user_id, to_user_id, user_type, trip_id, rating) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(6, 9, "driver", 2, 5), (6, 9, "driver", 2, 3),
+             (900001, 9, "driver", 1, 4), (9, 900001, "client", 1, 5)])
+
+
+def test_v6_orders_move_to_the_orders_table(tmp_path):
+    path = str(tmp_path / "v6.db")
+    make_v6_database(path)
+    add_v6_orders(path)
+
+    assert asyncio.run(migrate_file(path)) == (6, LATEST_VERSION)
+
+    with sqlite3.connect(path) as db:
+        orders = rows(db, '''SELECT id, client_id, direction, queue_position, status,
+                                    assigned_driver_id, passengers_count, order_number
+                             FROM orders ORDER BY status DESC''')
+        waiting, accepted = orders
+        assert waiting[1:] == (5, DIRECTION, 2.5, "waiting", None, 1, 1)
+        assert accepted[1:] == (5, DIRECTION, 1, "accepted", 9, 2, 2)
+
+        # The sub-order row is gone, its profile, trip and ratings now point
+        # at the owner; the driver's user_id is left alone
+        assert rows(db, "SELECT user_id, status FROM clients ORDER BY user_id") == [
+            (5, "registered"), (6, "registered")]
+        assert rows(db, "SELECT client_id, order_id FROM trips ORDER BY id") == [
+            (5, accepted[0]), (6, None)]
+        assert rows(db, "SELECT from_user_id, to_user_id FROM ratings ORDER BY id") == [
+            (6, 9), (6, 9), (5, 9), (9, 5)]
+
+        assert rows(db, "SELECT rating_sum, rating_count, avg_rating FROM drivers "
+                        "WHERE user_id = 9") == [(12, 3, 4.0)]
+        assert rows(db, '''SELECT drivers, free_seats, waiting_clients, accepted_clients,
+                                  completed_trips, rating_sum, rating_count
+                           FROM stats_counters''') == [(2, 2, 1, 1, 1, 17, 4)]
+        assert rows(db, "SELECT queue, last_value FROM queue_sequences "
+                        f"WHERE direction = '{DIRECTION}' ORDER BY queue") == [
+            ("drivers", 3), ("orders", 3)]
+
+        # Stats triggers moved with the orders
+        db.execute("INSERT INTO orders (client_id, direction, queue_position) VALUES (6, ?, 4)",
+                   (DIRECTION, ))
+        assert rows(db, "SELECT waiting_clients FROM stats_counters") == [(2, )]
+
+
+def test_migrated_database_opens(tmp_path, run, config):
+    make_v6_database(config.database_file)
+    add_v6_orders(config.database_file)
+
+    async def body(app):
+        return ([order.id for order in app.dispatch.waiting_orders(DIRECTION)],
+                app.dispatch.driver(9).occupied_seats)
+
+    assert run(body) == ([1], 2)
+
+
+STATS_WRITES = [
+    # NULL occupied_seats and is_active count as 0, not as NULL counters
+    "INSERT INTO drivers (user_id, full_name, phone, car_number, car_model, total_seats, "
+    "direction, queue_position, is_active, occupied_seats) "
+    "VALUES (1, 'D', '+7', '1', 'Camry', 4, 'x', 1, 1, NULL)",
+    "INSERT INTO drivers (user_id, full_name, phone, car_number, car_model, total_seats, "
+    "direction, queue_position, is_active, occupied_seats) "
+    "VALUES (2, 'D', '+7', '2', 'Camry', 6, 'x', 2, NULL, 1)",
+    "UPDATE drivers SET is_active = 1 WHERE user_id = 2",
+    "UPDATE drivers SET occupied_seats = 3 WHERE user_id = 1",
+    "INSERT INTO clients (user_id, full_name, phone, direction, queue_position) "
+    "VALUES (5, 'C', '+7', '', 0)",
+    "INSERT INTO orders (client_id, direction, queue_position) VALUES (5, 'x', 1)",
+    "INSERT INTO orders (client_id, direction, queue_position) VALUES (5, 'x', 2)",
+    "UPDATE orders SET status = 'accepted' WHERE queue_position = 1",
+    "INSERT INTO trips (driver_id, client_id, status) VALUES (1, 5, 'in_progress')",
+    "INSERT INTO trips (driver_id, client_id, status) VALUES (2, 5, 'in_progress')",
+    "UPDATE trips SET status = 'completed' WHERE driver_id = 1",
+    "UPDATE trips SET status = 'cancelled', cancelled_by = 'client' WHERE driver_id = 2",
+    "INSERT INTO ratings (from_user_id, to_user_id, user_type, rating) VALUES (5, 1, 'driver', 4)",
+    "INSERT INTO ratings (from_user_id, to_user_id, user_type, rating) VALUES (5, 2, 'driver', NULL)",
+    "UPDATE ratings SET rating = 2 WHERE to_user_id = 2",
+    "INSERT INTO blacklist (user_id) VALUES (7)",
+    "INSERT INTO blacklist (user_id) VALUES (8)",
+    "DELETE FROM blacklist WHERE user_id = 7",
+    "DELETE FROM orders WHERE status = 'waiting'",
+    "DELETE FROM drivers WHERE user_id = 2",
+]
+
+
+def test_stats_triggers_match_a_full_recount(run):
+    async def body(app):
+        async with get_db(write=True) as db:
+            for sql in STATS_WRITES:
+                await db.execute(sql)
+        async with get_db() as db:
+            counted = await fetch_stats(db)
+        async with get_db(write=True) as db:
+            await recompute_stats(db)
+        async with get_db() as db:
+            return counted, await fetch_stats(db)
+
+    counted, recounted = run(body)
+    assert counted == recounted
+    assert tuple(counted) == (1, 1, 0, 1, 1, 1, 6, 2, 1)
@@ -0,0 +1,77 @@
+import asyncio
+
+from database.db import get_db
+
+from conftest import add_client, add_driver, callback_update, fetch, start_order
+
+DRIVER = 9
+
+
+async def place_order(app, client_id: int, seats: int) -> int:
+    await add_client(client_id)
+    await start_order(app, client_id)
+    await app.dp.feed_update(app.bot, callback_update(1, client_id, f"seats:{seats}", 10))
+    await app.dp.feed_update(app.bot, callback_update(2, client_id, "confirm_order", 10))
+    (order_id, ), = await fetch("SELECT MAX(id) FROM orders")
+    return order_id
+
+
+async def consistent(app) -> tuple:
+    """(driver's occupied seats, seats of its accepted orders, dispatch differences)"""
+    (occupied, ), = await fetch("SELECT occupied_seats FROM drivers WHERE user_id = ?", DRIVER)
+    (accepted, ), = await fetch(
+        '''SELECT COALESCE(SUM(passengers_count), 0) FROM orders
+           WHERE assigned_driver_id = ? AND status = 'accepted\'''', DRIVER)
+    async with get_db() as db:
+        problems = await app.dispatch.check(db)
+    return occupied, accepted, problems
+
+
+def test_cancel_and_accept_race(run):
+    async def body(app):
+        await add_driver(DRIVER, seats=4)
+        results = []
+        for n in range(6):
+            client_id = 100 + n
+            order_id = await place_order(app, client_id, 2)
+            cancel = callback_update(10 * n + 3, client_id, f"cnc:{order_id}", 11)
+            accept = callback_update(10 * n + 4, DRIVER, f"acc:{order_id}", 30)
+            # Both orders of arrival, and both at once
+            updates = [(cancel, accept), (accept, cancel)][n % 2]
+            if n < 2:
+                for update in updates:
+                    await app.dp.feed_update(app.bot, update)
+            else:
+                await asyncio.gather(*(app.dp.feed_update(app.bot, update)
+                                       for update in updates))
+            (status, ), = await fetch("SELECT status FROM orders WHERE id = ?", order_id)
+            active_trips = await fetch(
+                "SELECT COUNT(*) FROM trips WHERE order_id = ? AND status = 'accepted'", order_id)
+            results.append((status, active_trips[0][0], await consistent(app)))
+        return results
+
+    for status, active_trips, (occupied, accepted, problems) in run(body):
+        # The client always wins: accepting first only delays the cancel
+        assert status == "cancelled"
+        assert active_trips == 0
+        assert occupied == accepted == 0
+        assert problems == []
+
+
+
+def test_old_accept_buttons_still_claim_orders(run):
+    async def body(app):
+        await add_driver(DRIVER, seats=4)
+        single = await place_order(app, 5, 1)
+        await app.dp.feed_update(app.bot, callback_update(3, DRIVER, f"accept_client_{single}", 30))
+        # One client's orders on a route, from a new-order notification
+        await place_order(app, 6, 2)
+        await app.dp.feed_update(app.bot, callback_update(
+            4, DRIVER, "driver_accept_6_Ақтау_Жаңаөзен_2", 31))
+        return (await fetch("SELECT client_id, status, assigned_driver_id FROM orders ORDER BY id"),
+                await consistent(app))
+
+    orders, (occupied, accepted, problems) = run(body)
+    assert orders == [(5, "accepted", DRIVER), (6, "accepted", DRIVER)]
+    assert occupied == accepted == 3
+    assert problems == []
@@ -0,0 +1,121 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from database.db import get_db
+from services import outbox as outbox_module
+from services.notifications import OutgoingMessage, SendResult
+from services.outbox import NotificationOutbox
+
+from conftest import fetch
+
+
+class ScriptedBroadcaster:
+    """Sends succeed unless ``failures[chat_id]`` still lists an outcome:
+    "retry" (transient) or "dead" (permanent)"""
+
+    def __init__(self, **failures):
+        self.failures = {int(chat.lstrip("c")): list(outcomes)
+                         for chat, outcomes in failures.items()}
+        self.sent = []
+
+    async def send(self, message: OutgoingMessage) -> SendResult:
+        outcomes = self.failures.get(message.chat_id)
+        if outcomes:
+            outcome = outcomes.pop(0)
+            return SendResult(message.chat_id, False, 1, f"{outcome} error",
+                              permanent=outcome == "dead")
+        self.sent.append((message.chat_id, message.text))
+        return SendResult(message.chat_id, True, 1)
+
+
+async def enqueue(outbox, chat_id: int, text: str, dedup_key: str = None):
+    async with get_db(write=True) as db:
+        await outbox.enqueue(db, OutgoingMessage(chat_id, text), dedup_key)
+
+
+async def rows() -> list:
+    return await fetch("SELECT chat_id, status, attempts FROM notification_outbox ORDER BY id")
+
+
+def test_messages_exist_only_with_their_transaction(run):
+    async def body(app):
+        outbox = NotificationOutbox(ScriptedBroadcaster())
+        with pytest.raises(RuntimeError):
+            async with get_db(write=True) as db:
+                await outbox.enqueue(db, OutgoingMessage(1, "rolled back"))
+                raise RuntimeError
+        await enqueue(outbox, 2, "first", "event:1")
+        await enqueue(outbox, 2, "same event again", "event:1")
+        await outbox.deliver_due()
+        return outbox.broadcaster.sent, await rows()
+
+    assert run(body) == ([(2, "first")], [(2, "sent", 1)])
+
+
+def test_failed_sends_back_off_then_die(run):
+    async def body(app):
+        outbox = NotificationOutbox(ScriptedBroadcaster(c1=["retry"], c2=["dead"],
+                                                        c3=["retry"] * 3),
+                                    max_attempts=2, base_delay=60)
+        for chat_id in (1, 2, 3):
+            await enqueue(outbox, chat_id, f"to {chat_id}")
+        await outbox.deliver_due()
+        first = await rows()
+        # Not due again before the backoff runs out
+        tried_early = await outbox.deliver_due()
+        async with get_db(write=True) as db:
+            await db.execute("UPDATE notification_outbox SET next_attempt_at = 0")
+        await outbox.deliver_due()
+        return first, tried_early, await rows(), outbox.broadcaster.sent
+
+    first, tried_early, last, sent = run(body)
+    assert first == [(1, "pending", 1), (2, "dead", 1), (3, "pending", 1)]
+    assert tried_early == 0
+    assert last == [(1, "sent", 2), (2, "dead", 1), (3, "dead", 2)]
+    assert sent == [(1, "to 1")]
+
+
+def test_crash_before_marking_sends_again(run, monkeypatch):
+    async def body(app):
+        outbox = NotificationOutbox(ScriptedBroadcaster())
+        await enqueue(outbox, 1, "hello")
+
+        @asynccontextmanager
+        async def crashing_get_db(write: bool = False):
+            if write:
+                raise ConnectionError("process died")
+            async with get_db() as db:
+                yield db
+
+        monkeypatch.setattr(outbox_module, "get_db", crashing_get_db)
+        with pytest.raises(ConnectionError):
+            await outbox.deliver_due()
+        monkeypatch.setattr(outbox_module, "get_db", get_db)
+
+        # The next start finds the row still pending
+        restarted = NotificationOutbox(outbox.broadcaster)
+        await restarted.deliver_due()
+        return outbox.broadcaster.sent, await rows()
+
+    assert run(body) == ([(1, "hello"), (1, "hello")], [(1, "sent", 1)])
+
+
+def test_worker_sends_on_commit_and_drains_on_stop(run):
+    async def body(app):
+        outbox = NotificationOutbox(ScriptedBroadcaster(), poll_interval=60)
+        outbox.start()
+        await enqueue(outbox, 1, "woken up")
+        for _ in range(100):
+            if outbox.broadcaster.sent:
+                break
+            await asyncio.sleep(0.01)
+        woken = list(outbox.broadcaster.sent)
+
+        # Committed right before shutdown: the worker or the drain sends it
+        await enqueue(outbox, 2, "sent while stopping")
+        await outbox.stop(drain_timeout=1)
+        return woken, outbox.broadcaster.sent
+
+    assert run(body) == ([(1, "woken up")], [(1, "woken up"), (2, "sent while stopping")])
@@ -0,0 +1,123 @@
+from database.db import get_db
+from database.queries import (claim_order, close_order, fetch_all_drivers,
+                              move_driver_in_queue, next_queue_position,
+                              reserve_seats, waiting_place)
+
+from conftest import ROUTE, add_client, add_driver, fetch
+
+
+async def add_order(client_id: int, queue_position: int, status: str = "waiting",
+                    direction: str = ROUTE[0]) -> int:
+    async with get_db(write=True) as db:
+        async with db.execute(
+                '''INSERT INTO orders (client_id, direction, queue_position,
+                                       passengers_count, status)
+                   VALUES (?, ?, ?, 1, ?)''',
+            (client_id, direction, queue_position, status)) as cursor:
+            return cursor.lastrowid
+
+
+def test_waiting_place_follows_queue_order(run):
+    async def body(app):
+        await add_client(5)
+        late = await add_order(5, 30)
+        first = await add_order(5, 10)      # newer row, earlier in the queue
+        await add_order(5, 5, status="accepted")
+        await add_order(5, 1, direction="Жаңаөзен → Ақтау")
+        tie = await add_order(5, 10)
+        async with get_db() as db:
+            return [await waiting_place(db, ROUTE[0], position, order_id)
+                    for position, order_id in ((10, first), (10, tie), (30, late))]
+
+    assert run(body) == [1, 2, 3]
+
+
+def test_claim_order_only_once(run):
+    async def body(app):
+        await add_client(5)
+        order_id = await add_order(5, 1)
+        async with get_db(write=True) as db:
+            claims = [await claim_order(db, order_id, 9), await claim_order(db, order_id, 10)]
+        return claims, await fetch("SELECT status, assigned_driver_id FROM orders")
+
+    assert run(body) == ([True, False], [("accepted", 9)])
+
+
+def test_close_order_returns_the_closed_row_once(run):
+    async def body(app):
+        await add_client(5)
+        waiting, accepted = await add_order(5, 1), await add_order(5, 2)
+        async with get_db(write=True) as db:
+            await claim_order(db, accepted, 9)
+            return [await close_order(db, waiting, "cancelled"),
+                    await close_order(db, waiting, "cancelled"),
+                    await close_order(db, accepted, "completed"),
+                    await close_order(db, accepted, "cancelled")]
+
+    assert run(body) == [(None, 1), None, (9, 1), None]
+
+
+def test_reserve_seats_never_overbooks(run):
+    async def body(app):
+        await add_driver(9, seats=4)
+        async with get_db(write=True) as db:
+            taken = [await reserve_seats(db, 9, seats) for seats in (3, 2, 1, 1)]
+        return taken, await fetch("SELECT occupied_seats FROM drivers")
+
+    assert run(body) == ([True, False, True, False], [(4, )])
+
+
+async def driver_queue(active_only: bool = True) -> list:
+    async with get_db() as db:
+        return [driver.user_id for driver in await fetch_all_drivers(db, active_only)]
+
+
+def test_move_driver_skips_inactive_drivers(run):
+    async def body(app):
+        for user_id in (1, 2, 3, 4):
+            await add_driver(user_id)
+        async with get_db(write=True) as db:
+            for user_id in (1, 2, 3, 4):
+                await db.execute("UPDATE drivers SET queue_position = ? WHERE user_id = ?",
+                                 (user_id, user_id))
+            await db.execute("UPDATE drivers SET is_active = 0 WHERE user_id = 2")
+            # One shown place up: ahead of 1, not just past the hidden 2
+            moves = [await move_driver_in_queue(db, 3, up=True),
+                     await move_driver_in_queue(db, 3, up=True),
+                     await move_driver_in_queue(db, 3, up=False),
+                     await move_driver_in_queue(db, 4, up=False)]
+        return moves, await driver_queue()
+
+    assert run(body) == ([True, False, True, False], [1, 3, 4])
+
+
+def test_move_driver_to_the_end_stays_ahead_of_new_drivers(run):
+    async def body(app):
+        for user_id in (1, 2):
+            await add_driver(user_id)
+        async with get_db(write=True) as db:
+            for user_id in (1, 2):
+                await db.execute("UPDATE drivers SET queue_position = ? WHERE user_id = ?",
+                                 (await next_queue_position(db, "drivers", ROUTE[0]), user_id))
+            await move_driver_in_queue(db, 1, up=False)
+        await add_driver(3)
+        async with get_db(write=True) as db:
+            await db.execute("UPDATE drivers SET queue_position = ? WHERE user_id = 3",
+                             (await next_queue_position(db, "drivers", ROUTE[0]), ))
+        return await driver_queue()
+
+    assert run(body) == [2, 1, 3]
+
+
+def test_move_driver_between_equal_keys_renumbers_once(run):
+    async def body(app):
+        for user_id in (1, 2, 3):
+            await add_driver(user_id)      # all at queue_position 1
+        async with get_db(write=True) as db:
+            moved = await move_driver_in_queue(db, 3, up=True)
+        return moved, await driver_queue(), await fetch(
+            "SELECT user_id, queue_position FROM drivers ORDER BY queue_position")
+
+    moved, queue, positions = run(body)
+    assert moved and queue == [1, 3, 2]
+    assert [user_id for user_id, _ in positions] == [1, 3, 2]
@@ -0,0 +1,148 @@
+import asyncio
+import sqlite3
+
+from database.db import get_db, on_commit
+from services.sharding import EpochWatcher, poll_into
+
+from conftest import ROUTE, add_client, add_driver
+
+
+def test_epoch_watcher_reloads_on_foreign_writes_only(run, config):
+    async def body(app):
+        await add_driver(9, seats=4)
+        watcher = EpochWatcher("dispatch", app.dispatch.load, app.dispatch.refresh,
+                               interval=60)
+        watcher.start()
+        try:
+            assert await watcher.check()
+
+            # Own write: the on_commit hook updates memory, no reload needed
+            async with get_db(write=True) as db:
+                await db.execute("UPDATE drivers SET occupied_seats = 1 WHERE user_id = 9")
+                on_commit(app.dispatch.add_occupied, 9, 1)
+            assert not await watcher.check()
+            assert app.dispatch.driver(9).occupied_seats == 1
+
+            # Another process
+            with sqlite3.connect(config.database_file) as other:
+                other.execute("UPDATE drivers SET occupied_seats = 3 WHERE user_id = 9")
+            assert await watcher.check()
+            assert app.dispatch.driver(9).occupied_seats == 3
+
+            async with get_db(write=True) as db:
+                await db.execute("UPDATE drivers SET occupied_seats = 2 WHERE user_id = 9")
+                on_commit(app.dispatch.add_occupied, 9, -1)
+            assert not await watcher.check()
+            assert app.dispatch.driver(9).occupied_seats == 2
+            return watcher.reloads, watcher.refreshes, watcher.skipped
+        finally:
+            await watcher.stop()
+
+    assert run(body) == (1, 1, 2)
+
+
+def test_epoch_watcher_reload_does_not_block_writers(run, config):
+    async def body(app):
+        reloading, written = asyncio.Event(), asyncio.Event()
+
+        async def slow_reload(db):
+            reloading.set()
+            await asyncio.wait_for(written.wait(), 5)
+            await app.dispatch.load(db)
+
+        watcher = EpochWatcher("dispatch", slow_reload, interval=60)
+        check = asyncio.create_task(watcher.check())
+        await reloading.wait()
+        await add_driver(9)
+        written.set()
+        assert await check
+        # The reload read the snapshot taken before the driver was added
+        return app.dispatch.driver(9)
+
+    assert run(body) is None
+
+
+def test_epoch_watcher_refreshes_changed_rows(run, config):
+    async def body(app):
+        await add_client(5)
+        await add_driver(9, seats=4)
+        await add_driver(10, seats=4)
+        refreshed = []
+
+        async def refresh(db, changes):
+            refreshed.append(changes)
+            await app.dispatch.refresh(db, changes)
+
+        watcher = EpochWatcher("dispatch", app.dispatch.load, refresh, interval=60)
+        await watcher.check()
+        with sqlite3.connect(config.database_file) as other:
+            other.execute("INSERT INTO orders (id, client_id, direction, queue_position) "
+                          "VALUES (1, 5, ?, 1)", (ROUTE[0], ))
+            other.execute("UPDATE clients SET full_name = 'Renamed' WHERE user_id = 5")
+            other.execute("UPDATE drivers SET is_active = 0 WHERE user_id = 10")
+            other.execute("DELETE FROM drivers WHERE user_id = 9")
+        assert await watcher.check()
+        async with get_db() as db:
+            problems = await app.dispatch.check(db)
+        return (refreshed, [order.client_name for order in app.dispatch.waiting_orders(ROUTE[0])],
+                app.dispatch.capacity(ROUTE[0]), problems, watcher.reloads)
+
+    assert run(body) == ([{"orders": {1}, "clients": {5}, "drivers": {9, 10}}], ["Renamed"],
+                         (0, 0), [], 1)
+
+
+def test_epoch_watcher_reloads_when_far_behind(run, config):
+    async def body(app):
+        await add_driver(9, seats=4)
+        watcher = EpochWatcher("dispatch", app.dispatch.load, app.dispatch.refresh,
+                               interval=60, max_rows=2)
+        await watcher.check()
+        with sqlite3.connect(config.database_file) as other:
+            for seats in (1, 2, 3):
+                other.execute("UPDATE drivers SET occupied_seats = ? WHERE user_id = 9",
+                              (seats, ))
+        await watcher.check()
+        return watcher.reloads, watcher.refreshes, app.dispatch.driver(9).occupied_seats
+
+    assert run(body) == (2, 0, 3)
+
+
+class FakePollingBot:
+    """get_updates() hands out two updates, then blocks like a long poll"""
+
+    def __init__(self, updates: list):
+        self.updates = updates
+        self.calls = []
+
+    async def get_updates(self, offset=None, timeout=None, **kwargs):
+        self.calls.append((offset, timeout))
+        if self.updates:
+            updates, self.updates = self.updates, []
+            return updates
+        if timeout:
+            await asyncio.sleep(3600)
+        return []
+
+
+class RecordingFront:
+    def __init__(self):
+        self.routed = []
+
+    def route(self, payload: str, update: dict):
+        self.routed.append(update["update_id"])
+
+
+def test_poll_into_confirms_the_offset_when_stopped():
+    from conftest import callback_update
+
+    async def main():
+        bot = FakePollingBot([callback_update(7, 5, "x"), callback_update(8, 5, "y")])
+        front = RecordingFront()
+        task = asyncio.create_task(poll_into(front, bot))
+        while len(bot.calls) < 2:
+            await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return front.routed, bot.calls
+
+    assert asyncio.run(main()) == ([7, 8], [(None, 30), (9, 30), (9, 0)])
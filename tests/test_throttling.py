@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+from aiogram.methods import AnswerCallbackQuery
+
+from services.app import App
+from services.throttling import THROTTLE_NOTICE, CallbackThrottle, ThrottleGroup
+from utils.callbacks import CallbackIndex, IndexedRouter, PickSeats
+
+from conftest import callback_update
+
+TAPS = ThrottleGroup("taps", rate=0.001, burst=2, keys=("tap", PickSeats))
+
+
+def tap_app(config, throttle: bool = True) -> tuple:
+    """An app whose only router counts the taps that reach it"""
+    index = CallbackIndex()
+    router = IndexedRouter("taps", index)
+    handled = []
+
+    @router.callback("tap")
+    async def tap(callback):
+        handled.append(callback.from_user.id)
+        await callback.answer()
+
+    @router.callback("free")
+    async def free(callback):
+        handled.append(callback.from_user.id)
+
+    app = App(config._replace(throttle=throttle), (router, ), index, (TAPS, ))
+    return app, handled
+
+
+def test_group_of_resolves_static_and_callback_data_keys():
+    index = CallbackIndex()
+    index.add("tap", "taps")
+    index.add(PickSeats.__prefix__, "taps")
+    index.add(PickSeats.__legacy__, "taps")
+    default = ThrottleGroup("default", rate=1, burst=1)
+    throttle = CallbackThrottle((TAPS, ), default, index=index)
+    assert throttle.group_of("tap") is TAPS
+    assert throttle.group_of(PickSeats(count=2).pack()) is TAPS
+    assert throttle.group_of("seats_2") is TAPS
+    assert throttle.group_of("something_else") is default
+    assert CallbackThrottle((TAPS, )).group_of("something_else") is None
+
+
+def test_buckets_are_per_user_and_bounded():
+    throttle = CallbackThrottle((TAPS, ), max_buckets=2)
+    assert [throttle.allow(1, TAPS) for _ in range(3)] == [True, True, False]
+    assert throttle.allow(2, TAPS)
+    # A third user pushes out user 1, who then gets a fresh burst
+    assert throttle.allow(3, TAPS)
+    assert throttle.allow(1, TAPS)
+    assert throttle.stats() == {"buckets": 2, "passed": 5, "rejected": 1,
+                                "by_group": {"taps": 1}}
+
+
+def test_feed_update_sheds_taps_over_the_limit(config, telegram):
+    app, handled = tap_app(config)
+
+    async def scenario():
+        with app.bound():
+            await app.open()
+            try:
+                for i in range(4):
+                    await app.dp.feed_update(app.bot, callback_update(i, 1, "tap"))
+                await app.dp.feed_update(app.bot, callback_update(4, 2, "tap"))
+                # Callbacks of no group are not throttled
+                for i in range(5, 10):
+                    await app.dp.feed_update(app.bot, callback_update(i, 1, "free"))
+            finally:
+                await app.shutdown(time.monotonic() + 1)
+
+    asyncio.run(scenario())
+    assert handled == [1, 1, 2] + [1] * 5
+    notices = [m for m in telegram if isinstance(m, AnswerCallbackQuery) and m.text]
+    assert [(m.callback_query_id, m.text) for m in notices] == [
+        ("2", THROTTLE_NOTICE), ("3", THROTTLE_NOTICE)]
+    assert app.throttle.rejected == 2
+    assert app.throttle.rejected_by_group == {"taps": 2}
+
+
+def test_throttle_switched_off(config, telegram):
+    app, handled = tap_app(config, throttle=False)
+
+    async def scenario():
+        with app.bound():
+            await app.open()
+            try:
+                for i in range(4):
+                    await app.dp.feed_update(app.bot, callback_update(i, 1, "tap"))
+            finally:
+                await app.shutdown(time.monotonic() + 1)
+
+    asyncio.run(scenario())
+    assert app.throttle is None
+    assert handled == [1] * 4
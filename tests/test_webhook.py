@@ -0,0 +1,139 @@
+import asyncio
+import socket
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.methods import SendMessage
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot
+from services.webhook import WEBHOOK_PATH, build_forwarding_app, build_webhook_app
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": text,
+        "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+        "chat": {"id": user_id, "type": "private"}}}
+
+
+def test_shutdown_finishes_accepted_updates(config, tmp_path, monkeypatch):
+    replies = []
+
+    async def slow_call(self, method, request_timeout=None):
+        await asyncio.sleep(0.05)
+        if isinstance(method, SendMessage):
+            replies.append(method.chat_id)
+        return True
+
+    monkeypatch.setattr(Bot, "__call__", slow_call)
+    port = free_port()
+    config = config._replace(webhook_url="https://example.org", webhook_host="127.0.0.1",
+                             webhook_port=port, webhook_secret="s3cret",
+                             webhook_max_tasks=1, log_archive_dir=str(tmp_path / "archive"))
+
+    async def scenario():
+        server = asyncio.create_task(bot.main(config))
+        url = f"http://127.0.0.1:{port}{config.webhook_path}"
+        async with aiohttp.ClientSession() as session:
+            for _ in range(100):
+                try:
+                    async with session.post(url, json=message_update(0, 1, "hi"),
+                                            headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"}):
+                        break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.05)
+            for i in range(1, 5):
+                async with session.post(url, json=message_update(i, 1 + i, "hi"),
+                                        headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"}) as response:
+                    assert response.status == 200
+        # Four updates still queue for the only task slot
+        server.cancel()
+        await server
+
+    asyncio.run(scenario())
+    assert sorted(replies) == [1, 2, 3, 4, 5]
+
+
+SECRET = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+
+
+class BlockingDispatcher:
+    """A dispatcher whose message handler waits until released"""
+
+    def __init__(self):
+        self.dp = Dispatcher()
+        self.started, self.release = asyncio.Event(), asyncio.Event()
+        self.handled = []
+
+        @self.dp.message()
+        async def handle(message):
+            self.started.set()
+            await self.release.wait()
+            self.handled.append(message.message_id)
+
+
+async def post_updates(web_app, updates: list, headers: dict = SECRET) -> list:
+    async with TestClient(TestServer(web_app)) as client:
+        statuses = []
+        for update in updates:
+            async with client.post(WEBHOOK_PATH, json=update, headers=headers) as response:
+                statuses.append(response.status)
+        return statuses
+
+
+def test_webhook_checks_the_secret_and_answers_before_handling():
+    async def scenario():
+        blocking = BlockingDispatcher()
+        web_app, handler = build_webhook_app(blocking.dp, Bot("123456:ABCdef"),
+                                             secret_token="s3cret")
+        refused = await post_updates(web_app, [message_update(1, 1, "hi")],
+                                     headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        # 200 comes back while the handler is still waiting
+        accepted = await post_updates(web_app, [message_update(2, 1, "hi")])
+        await asyncio.wait_for(blocking.started.wait(), 1)
+        unfinished = handler.pending
+        blocking.release.set()
+        left = await handler.join(1)
+        return refused, accepted, unfinished, left, blocking.handled
+
+    assert asyncio.run(scenario()) == ([401], [200], 1, 0, [2])
+
+
+def test_webhook_refuses_updates_beyond_max_pending():
+    async def scenario():
+        blocking = BlockingDispatcher()
+        web_app, handler = build_webhook_app(blocking.dp, Bot("123456:ABCdef"),
+                                             secret_token="s3cret", max_tasks=1,
+                                             max_pending=2)
+        statuses = await post_updates(web_app, [message_update(i, i, "hi") for i in range(4)])
+        blocking.release.set()
+        await handler.join(1)
+        return statuses, handler.refused, sorted(blocking.handled)
+
+    assert asyncio.run(scenario()) == ([200, 200, 503, 503], 2, [0, 1])
+
+
+def test_forwarding_app_checks_the_secret_and_routes():
+    class Front:
+        def __init__(self):
+            self.routed = []
+
+        def route(self, payload: str, update: dict):
+            self.routed.append(update["update_id"])
+
+    front = Front()
+    web_app = build_forwarding_app(front, path=WEBHOOK_PATH, secret_token="s3cret")
+
+    async def scenario():
+        return (await post_updates(web_app, [message_update(1, 1, "hi")], headers={}),
+                await post_updates(web_app, [message_update(2, 1, "hi")]))
+
+    assert asyncio.run(scenario()) == ([401], [200])
+    assert front.routed == [2]
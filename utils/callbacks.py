@@ -0,0 +1,199 @@
+from typing import ClassVar
+
+from aiogram import Router
+from aiogram.filters import Filter
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import CallbackQuery
+
+# ==================== CALLBACK DATA ====================
+
+
+class LegacyCallbackData(CallbackData, prefix="legacy"):
+    """CallbackData that also parses the old ``<legacy>_<a>_<b>`` strings.
+
+    Buttons already sent to users keep their old callback data, so each
+    factory names the prefix it replaces. A last str field takes whatever
+    remains, underscores included (e.g. ``dir_aktau_janaozen``).
+    """
+    __legacy__: ClassVar[str] = ""
+
+    def __init_subclass__(cls, legacy: str = "", **kwargs):
+        cls.__legacy__ = legacy
+        super().__init_subclass__(**kwargs)
+
+    @classmethod
+    def unpack(cls, value: str):
+        legacy = cls.__legacy__
+        if legacy and value == legacy:
+            return cls()    # old button without arguments: the field defaults
+        if not legacy or cls.__separator__ in value or not value.startswith(f"{legacy}_"):
+            return super().unpack(value)
+        names = list(cls.model_fields)
+        parts = cls._legacy_parts(value[len(legacy) + 1:].split("_"))
+        if len(parts) > len(names) and cls.model_fields[names[-1]].annotation is str:
+            parts[len(names) - 1:] = ["_".join(parts[len(names) - 1:])]
+        if len(parts) != len(names):
+            raise TypeError(f"Callback data {cls.__name__!r} takes {len(names)} "
+                            f"arguments but {len(parts)} were given")
+        return cls(**dict(zip(names, parts)))
+
+    @classmethod
+    def _legacy_parts(cls, parts: list) -> list:
+        """Old arguments, reshaped to the fields where the formats differ"""
+        return parts
+
+
+class PickRoute(LegacyCallbackData, prefix="dir", legacy="dir"):
+    route: str      # Route.id (or an old slug)
+
+
+class ChangeRoute(LegacyCallbackData, prefix="chdir", legacy="change_dir"):
+    route: str
+
+
+class AcceptOrder(LegacyCallbackData, prefix="acc", legacy="accept_client"):
+    order_id: int
+
+
+class RejectOrder(LegacyCallbackData, prefix="rej", legacy="driver_reject"):
+    order_id: int
+
+
+class AcceptClientOrders(LegacyCallbackData, prefix="dacc", legacy="driver_accept"):
+    """Every waiting order of one client on one route"""
+    client_id: int
+    route: str      # Route.id (or a direction, from old buttons)
+    count: int
+
+    @classmethod
+    def _legacy_parts(cls, parts: list) -> list:
+        # driver_accept_<client_id>_<from_city>_<to_city>_<count>
+        if len(parts) == 4:
+            return [parts[0], f"{parts[1]} → {parts[2]}", parts[3]]
+        return parts
+
+
+class CancelOrder(LegacyCallbackData, prefix="cnc", legacy="cancel_order"):
+    order_id: int
+
+
+class PickSeats(LegacyCallbackData, prefix="seats", legacy="seats"):
+    count: int
+
+
+class CompleteTrip(LegacyCallbackData, prefix="done", legacy="driver_complete_trip"):
+    trip_id: int = 0    # the driver's newest active trip when the menu was sent
+
+
+class QuickRate(LegacyCallbackData, prefix="qrate", legacy="quick_rate"):
+    trip_id: int
+    rating: int
+
+
+class RateTrip(LegacyCallbackData, prefix="rtrip", legacy="rate_trip"):
+    trip_id: int
+
+
+class PickRating(LegacyCallbackData, prefix="stars", legacy="rating"):
+    rating: int
+
+
+class MoveDriver(LegacyCallbackData, prefix="qmove"):
+    """Admin queue management: one place up or down"""
+    driver_id: int
+    up: bool
+
+
+# ==================== ROUTING ====================
+
+
+class CallbackIndex:
+    """Which routers handle a callback, found with a few dict lookups.
+
+    Routers record the keys they handle: a static callback_data string, or
+    a CallbackData prefix (and its legacy prefix). Installed as an outer
+    middleware on the dispatcher, the index resolves the key of every
+    callback once and passes ``callback_key`` and ``callback_owners`` on,
+    so a router that does not own the key is skipped with one set lookup
+    instead of trying each of its handlers' filters.
+    """
+
+    def __init__(self):
+        self._owners = {}  # key -> {router name}
+
+    def add(self, key: str, owner: str):
+        self._owners.setdefault(key, set()).add(owner)
+
+    def resolve(self, data: str) -> tuple:
+        """(key, owners) for callback data; (None, empty set) if nobody has it"""
+        if ":" in data:
+            key = data.partition(":")[0]
+            return key, self._owners.get(key, set())
+        # Static strings match as a whole, old "<prefix>_<args>" strings
+        # after cutting arguments off the end
+        key = data
+        while True:
+            owners = self._owners.get(key)
+            if owners is not None:
+                return key, owners
+            key, sep, _ = key.rpartition("_")
+            if not sep:
+                return None, set()
+
+    async def __call__(self, handler, event, data: dict):
+        data["callback_key"], data["callback_owners"] = self.resolve(event.data or "")
+        return await handler(event, data)
+
+
+class _OwnedBy(Filter):
+    def __init__(self, name: str):
+        self.name = name
+
+    async def __call__(self, callback: CallbackQuery, callback_owners: set = frozenset()) -> bool:
+        return self.name in callback_owners
+
+
+class _KeyIn(Filter):
+    def __init__(self, *keys: str):
+        self.keys = frozenset(keys)
+
+    async def __call__(self, callback: CallbackQuery, callback_key: str = None) -> bool:
+        return callback_key in self.keys
+
+
+def callback_keys(key) -> tuple:
+    """CallbackIndex keys of a static callback_data string or a CallbackData class"""
+    if isinstance(key, str):
+        return (key, )
+    return tuple(filter(None, (key.__prefix__, getattr(key, "__legacy__", ""))))
+
+
+class IndexedRouter(Router):
+    """Router whose callback handlers are registered through ``callback()``"""
+
+    def __init__(self, name: str, index: CallbackIndex):
+        super().__init__(name=name)
+        self.index = index
+        self.callback_query.filter(_OwnedBy(name))
+
+    def callback(self, key, *filters):
+        """Handle callback ``key``: a static callback_data string or a
+        CallbackData class, whose handler then gets ``callback_data``"""
+        keys = callback_keys(key)
+        parse = () if isinstance(key, str) else (key.filter(), )
+        for each in keys:
+            self.index.add(each, self.name)
+        return self.callback_query(_KeyIn(*keys), *filters, *parse)
+
+
+def copy_router(router: Router) -> Router:
+    """Router with the same handlers, for one more dispatcher (a router
+    can be included only once). The CallbackIndex is shared: it holds no
+    per-dispatcher state"""
+    if isinstance(router, IndexedRouter):
+        copy = IndexedRouter(router.name, router.index)
+    else:
+        copy = Router(name=router.name)
+    for name, observer in router.observers.items():
+        copy.observers[name].handlers.extend(observer.handlers)
+    return copy
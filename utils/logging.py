@@ -0,0 +1,232 @@
+import asyncio
+import glob
+import gzip
+import json
+import logging
+import os
+import time
+from collections import deque
+
+from database.db import get_db
+
+logger = logging.getLogger(__name__)
+
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 2.0
+LOG_MAX_QUEUED = 10000
+
+LOG_RETENTION_DAYS = 30
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_INTERVAL = 6 * 3600
+
+
+def setup_logging(log_file: str = "taxi_bot.log"):
+    """Process-wide logging to stderr and ``log_file`` (none if empty);
+    called by entry points, never on import"""
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.insert(0, logging.FileHandler(log_file))
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=handlers)
+
+
+class ActionLogBuffer:
+    """Write-behind buffer for actions_log.
+
+    ``add()`` only appends to memory. A background task writes the records
+    with one ``executemany`` per transaction, when ``batch_size`` records are
+    queued or every ``interval`` seconds. When more than ``max_queued``
+    records are waiting (e.g. the database is unavailable), new ones are
+    dropped and counted instead of growing memory without bound.
+    """
+
+    def __init__(self, batch_size: int = LOG_BATCH_SIZE,
+                 interval: float = LOG_FLUSH_INTERVAL,
+                 max_queued: int = LOG_MAX_QUEUED):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_queued = max_queued
+        self.written = 0
+        self.dropped = 0
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._stopping = False
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        return {"queued": self.queued, "written": self.written,
+                "dropped": self.dropped}
+
+    def add(self, user_id: int, action: str, details: str = "") -> bool:
+        """Queue one record; returns False if it was dropped"""
+        if len(self._queue) >= self.max_queued:
+            self.dropped += 1
+            return False
+
+        # Time of the action, not of the flush; same format as CURRENT_TIMESTAMP
+        created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        self._queue.append((user_id, action, details, created_at))
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def flush(self) -> int:
+        """Write everything queued so far; returns the number of rows written"""
+        async with self._flush_lock:
+            total = 0
+            while self._queue:
+                batch = [self._queue.popleft()
+                         for _ in range(min(self.batch_size, len(self._queue)))]
+                try:
+                    async with get_db(write=True) as db:
+                        await db.executemany(
+                            '''INSERT INTO actions_log (user_id, action, details, created_at)
+                               VALUES (?, ?, ?, ?)''', batch)
+                except Exception as e:
+                    # Put the batch back (oldest first) and retry on the next flush
+                    room = self.max_queued - len(self._queue)
+                    kept = batch[:max(0, room)]
+                    self._queue.extendleft(reversed(kept))
+                    self.dropped += len(batch) - len(kept)
+                    logger.error(f"Failed to write {len(batch)} log records: {e}")
+                    break
+                self.written += len(batch)
+                total += len(batch)
+            return total
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and write whatever is still queued"""
+        if self._task is not None:
+            # Not cancel(): a flush in progress must finish its transaction
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        await self.flush()
+        logger.info(f"Action log stopped: {self.written} written, "
+                    f"{self.dropped} dropped, {self.queued} left in queue")
+
+
+# ==================== RETENTION / ARCHIVE ====================
+# Rows older than the retention period are moved to append-only
+# <archive_dir>/actions-YYYY-MM-DD.jsonl.gz files, one per day of created_at.
+
+
+def _archive_path(archive_dir: str, created_at: str) -> str:
+    return os.path.join(archive_dir, f"actions-{created_at[:10]}.jsonl.gz")
+
+
+def _append_to_archive(archive_dir: str, rows: list):
+    os.makedirs(archive_dir, exist_ok=True)
+    by_file = {}
+    for row_id, user_id, action, details, created_at in rows:
+        by_file.setdefault(_archive_path(archive_dir, created_at or "unknown"), []).append(
+            json.dumps({"id": row_id, "user_id": user_id, "action": action,
+                        "details": details, "created_at": created_at},
+                       ensure_ascii=False))
+
+    # "at" adds a new gzip member; readers see one continuous file
+    for path, lines in by_file.items():
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+async def archive_old_actions(archive_dir: str, days: int = LOG_RETENTION_DAYS,
+                              batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Move actions_log rows older than ``days`` into the archive.
+
+    Works in batches of ``batch_size`` rows, each deleted in its own short
+    write transaction, so other writers are never held up for long. A
+    crash between writing a batch and deleting it can leave that batch in
+    the archive twice, never lose it.
+    """
+    cutoff = time.strftime("%Y-%m-%d %H:%M:%S",
+                           time.gmtime(time.time() - days * 86400))
+    total = 0
+
+    while True:
+        async with get_db() as db:
+            async with db.execute(
+                    '''SELECT id, user_id, action, details, created_at
+                       FROM actions_log WHERE created_at < ?
+                       ORDER BY id LIMIT ?''', (cutoff, batch_size)) as cursor:
+                rows = await cursor.fetchall()
+
+        if not rows:
+            break
+
+        await asyncio.to_thread(_append_to_archive, archive_dir, rows)
+
+        # Exactly the rows read above: older than cutoff, up to the last id
+        async with get_db(write=True) as db:
+            await db.execute(
+                "DELETE FROM actions_log WHERE created_at < ? AND id <= ?",
+                (cutoff, rows[-1][0]))
+
+        total += len(rows)
+        if len(rows) < batch_size:
+            break
+
+    if total:
+        logger.info(f"Archived {total} actions_log rows older than {cutoff}")
+    return total
+
+
+async def run_log_retention(archive_dir: str, days: int = LOG_RETENTION_DAYS,
+                            interval: float = ARCHIVE_INTERVAL):
+    """Background task: archive old rows every ``interval`` seconds"""
+    while True:
+        try:
+            await archive_old_actions(archive_dir, days)
+        except Exception as e:
+            logger.error(f"Log archiving failed: {e}")
+        await asyncio.sleep(interval)
+
+
+def _search_archives(archive_dir: str, user_id, action, limit: int) -> list:
+    found = []
+    for path in sorted(glob.glob(os.path.join(archive_dir, "actions-*.jsonl.gz")),
+                       reverse=True):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            matches = []
+            for line in f:
+                record = json.loads(line)
+                if user_id is not None and record["user_id"] != user_id:
+                    continue
+                if action is not None and record["action"] != action:
+                    continue
+                matches.append(record)
+        # Newest first, both across and within files
+        found.extend(reversed(matches))
+        if len(found) >= limit:
+            break
+    return found[:limit]
+
+
+async def search_archives(archive_dir: str, user_id: int = None,
+                          action: str = None, limit: int = 20) -> list:
+    """Archived records matching user_id and/or action, newest first"""
+    return await asyncio.to_thread(_search_archives, archive_dir, user_id,
+                                   action, limit)
@@ -0,0 +1,86 @@
+from typing import NamedTuple
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from utils.callbacks import ChangeRoute, PickRoute
+
+# Price of one seat in tenge, the same both ways between two towns
+TARIFFS = {
+    frozenset({"Ақтау", "Жаңаөзен"}): 2500,
+    frozenset({"Ақтау", "Шетпе"}): 2000,
+}
+
+
+class Route(NamedTuple):
+    id: str         # short ASCII id used in callback data
+    slug: str       # old callback suffix, still accepted from old messages
+    from_city: str
+    to_city: str
+
+    @property
+    def direction(self) -> str:
+        """Display name, also the value stored in drivers/orders.direction"""
+        return f"{self.from_city} → {self.to_city}"
+
+    @property
+    def seat_price(self) -> int:
+        return TARIFFS.get(frozenset({self.from_city, self.to_city}), 0)
+
+    def price(self, seats: int) -> int:
+        return self.seat_price * seats
+
+
+# Adding a town is a data change here (plus its TARIFFS entry); keyboards,
+# callback parsing and the info text are all built from this list
+ROUTES = (
+    Route("aj", "aktau_janaozen", "Ақтау", "Жаңаөзен"),
+    Route("ja", "janaozen_aktau", "Жаңаөзен", "Ақтау"),
+    Route("as", "aktau_shetpe", "Ақтау", "Шетпе"),
+    Route("sa", "shetpe_aktau", "Шетпе", "Ақтау"),
+)
+
+ROUTES_BY_ID = {route.id: route for route in ROUTES}
+ROUTES_BY_DIRECTION = {route.direction: route for route in ROUTES}
+_ROUTES_BY_KEY = {**ROUTES_BY_ID, **{route.slug: route for route in ROUTES},
+                  **ROUTES_BY_DIRECTION}
+
+
+def route_by_key(key: str):
+    """Route for an id from callback data (or an old slug or direction), else None"""
+    return _ROUTES_BY_KEY.get(key)
+
+
+def route_by_cities(from_city: str, to_city: str):
+    return ROUTES_BY_DIRECTION.get(f"{from_city} → {to_city}")
+
+
+def _routes_keyboard(factory, back: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        *([InlineKeyboardButton(text=route.direction,
+                                callback_data=factory(route=route.id).pack())]
+          for route in ROUTES),
+        [InlineKeyboardButton(text="🔙 Артқа", callback_data=back)],
+    ])
+
+
+# Built once and shared by every message: never modify them
+DIRECTION_KEYBOARD = _routes_keyboard(PickRoute, "back_main")
+CHANGE_DIRECTION_KEYBOARD = _routes_keyboard(ChangeRoute, "driver_menu")
+
+
+def _tariff_lines() -> str:
+    """Tariff text, one line per town pair:
+    "- Ақтау – Жаңаөзен – Ақтау → 1 орын – 2500 тг"
+    """
+    lines, seen = [], set()
+    for route in ROUTES:
+        pair = frozenset({route.from_city, route.to_city})
+        if pair in seen or not route.seat_price:
+            continue
+        seen.add(pair)
+        lines.append(f"- {route.from_city} – {route.to_city} – {route.from_city} → "
+                     f"1 орын – {route.seat_price} тг")
+    return "\n".join(lines)
+
+
+TARIFF_LINES = _tariff_lines()